@@ -10,11 +10,80 @@ Created on 08/02/2014
 """
 __author__ = 'javier'
 
-import requests
-from rdflib import Graph, URIRef
+import gzip
+import json
+
+from rdflib import Graph, URIRef, BNode, Literal, plugin
+from rdflib.exceptions import UniquenessError
 from rdflib.namespace import RDF, OWL
+from rdflib.parser import Parser
 
 from AgentUtil.ACL import ACL
+from AgentUtil.Deadline import current_deadline, to_literal
+from AgentUtil.HTTPPool import http_request
+from AgentUtil.Tracing import current_span, span
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Metodo HTTP por defecto para enviar los mensajes. Con 'POST' el mensaje viaja en el cuerpo de la peticion (y se
+# puede comprimir); con 'GET' viaja como parametro 'content' de la URL, como en la version original
+TRANSPORT_METHOD = 'POST'
+
+# Compresion por defecto del cuerpo de los mensajes enviados por POST ('gzip', 'zstd' o None)
+COMPRESSION = 'gzip'
+
+# Los mensajes mas pequeños que este tamaño (en bytes) no se comprimen
+COMPRESSION_MIN_SIZE = 1024
+
+# Codificaciones que sabemos descomprimir, por orden de preferencia
+ENCODINGS = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Formatos de serializacion que se pueden usar en la comunicacion entre agentes (formato de rdflib -> tipo MIME).
+# RDF/XML va primero porque es el formato original y el que se usa cuando el otro agente no indica ninguno
+WIRE_FORMATS = {'xml': 'application/rdf+xml',
+                'nt': 'application/n-triples',
+                'turtle': 'text/turtle'}
+
+# JSON-LD solo esta disponible si esta instalado el plugin rdflib-jsonld
+try:
+    plugin.get('json-ld', Parser)
+    WIRE_FORMATS['json-ld'] = 'application/ld+json'
+except plugin.PluginException:
+    pass
+
+# Formato propio (no RDF) de los mensajes entre agentes: el sobre ACL y las tripletas del contenido en JSON. Al
+# recibirlo no se construye ningun grafo de rdflib, sino un ACLMessage (ver mas abajo)
+ACL_JSON = 'acl-json'
+WIRE_FORMATS[ACL_JSON] = 'application/x-acl+json'
+
+# Formato por defecto con el que se envian los mensajes y se piden las respuestas. ACL_JSON es bastante mas rapido
+# de serializar y de leer que cualquier formato RDF (ver Benchmarks/BenchFormatos.py); de los formatos RDF, N-Triples
+# es el mas rapido en rdflib
+WIRE_FORMAT = ACL_JSON
+
+# Propiedades del sobre de los mensajes ACL
+ENVELOPE = {'performative': ACL.performative,
+            'sender': ACL.sender,
+            'receiver': ACL.receiver,
+            'ontology': ACL.ontology,
+            'conversation-id': ACL['conversation-id'],
+            'in-reply-to': ACL['in-reply-to'],
+            'reply-by': ACL['reply-by'],
+            'content': ACL.content}
+
+# Propiedad del sobre -> clave del diccionario de get_message_properties
+ENVELOPE_KEYS = {prop: key for key, prop in ENVELOPE.items()}
+
+# Prefijo de las URIs del namespace ACL en N-Triples. Todas las tripletas del sobre lo contienen
+ACL_NT_PREFIX = ('<%s' % ACL).encode('utf-8')
+
+# Inicio de los mensajes serializados con ACLMessage.to_json, que escribe el sobre antes que el contenido
+ACL_JSON_PREFIX = b'{"envelope":'
 
 
 def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt=0):
@@ -31,8 +100,9 @@ def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt
     :param msgcnt: numero de mensaje
     :return:
     """
-    # Añade los elementos del speech act al grafo del mensaje
-    mssid = f'message-{sender.__hash__()}-{msgcnt:04}'
+    # Añade los elementos del speech act al grafo del mensaje. La URI del mensaje ha de ser absoluta para que se
+    # pueda serializar en N-Triples, asi que la construimos a partir de la URI del sender
+    mssid = f'{sender}-message-{msgcnt:04}'
     # No podemos crear directamente una instancia en el namespace ACL ya que es un ClosedNamedspace
     ms = URIRef(mssid)
     gmess.bind('acl', ACL)
@@ -44,22 +114,147 @@ def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt
         gmess.add((ms, ACL.receiver, receiver))
     if content is not None:
         gmess.add((ms, ACL.content, content))
+    # Contexto de la traza en curso (ver AgentUtil.Tracing)
+    trace = current_span()
+    if trace is not None:
+        gmess.add((ms, ACL['conversation-id'], Literal(trace.trace_id)))
+        gmess.add((ms, ACL['in-reply-to'], Literal(trace.span_id)))
+    # Tiempo límite de la petición en curso (ver AgentUtil.Deadline), que solo tiene sentido en las peticiones
+    limit = current_deadline()
+    if limit is not None and perf == ACL.request:
+        gmess.add((ms, ACL['reply-by'], to_literal(limit)))
     return gmess
 
 
-def send_message(gmess, address):
+def send_message(gmess, address, method=None, compression=None, format=None):
     """
-    Envia un mensaje usando un GET y retorna la respuesta como
-    un grafo RDF
+    Envia un mensaje y retorna la respuesta como un grafo RDF. Las conexiones se reutilizan entre envios a un
+    mismo agente (ver AgentUtil.HTTPPool)
+
+    El formato del mensaje se indica en la cabecera Content-Type y el de la respuesta se pide en la cabecera
+    Accept. En modo GET el mensaje siempre viaja en RDF/XML, como en la version original
+
+    :param gmess: grafo con el mensaje
+    :param address: direccion del agente destino
+    :param method: 'POST' (mensaje en el cuerpo) o 'GET' (mensaje en la URL), por defecto TRANSPORT_METHOD
+    :param compression: compresion del cuerpo en modo POST, por defecto COMPRESSION
+    :param format: formato de serializacion (ver WIRE_FORMATS), por defecto WIRE_FORMAT
+    :return:
     """
-    msg = gmess.serialize(format='xml')
-    r = requests.get(address, params={'content': msg})
+    if method is None:
+        method = TRANSPORT_METHOD
+    if compression is None:
+        compression = COMPRESSION
+    if format is None:
+        format = WIRE_FORMAT
 
-    # Procesa la respuesta y la retorna como resultado como grafo
-    gr = Graph()
-    gr.parse(data=r.text)
+    headers = {'Accept-Encoding': ', '.join(ENCODINGS),
+               'Accept': '%s, %s;q=0.5' % (WIRE_FORMATS[format], WIRE_FORMATS['xml'])}
 
-    return gr
+    with span('send', address=address) as send:
+        # El agente destino continua la traza a partir de este span
+        set_trace_context(gmess, send)
+
+        if method == 'GET':
+            with span('serialize', format='xml'):
+                msg = gmess.serialize(format='xml')
+            r = http_request('GET', address, params={'content': msg}, headers=headers)
+        else:
+            with span('serialize', format=format):
+                msg = serialize_message(gmess, format)
+                headers['Content-Type'] = WIRE_FORMATS[format]
+                if compression in ENCODINGS and len(msg) >= COMPRESSION_MIN_SIZE:
+                    msg = compress(msg, compression)
+                    headers['Content-Encoding'] = compression
+            r = http_request('POST', address, data=msg, headers=headers)
+
+        # Procesa la respuesta, en el formato que indique el agente, y la retorna como resultado como grafo (o como
+        # ACLMessage, si el agente responde en ACL_JSON)
+        res_format = format_from_mimetype(r.headers.get('Content-Type'))
+        with span('parse', format=res_format):
+            return parse_message(decompress_response(r), res_format)
+
+
+def set_trace_context(msg, trace):
+    """
+    Pone en el sobre del mensaje (grafo o ACLMessage) el contexto del span: el identificador de la traza en
+    conversation-id y el del span en in-reply-to
+    """
+    if isinstance(msg, ACLMessage) and msg._graph is None:
+        msg.conversation_id = Literal(trace.trace_id)
+        msg.in_reply_to = Literal(trace.span_id)
+        msg._index = None
+        return
+
+    gr = msg.graph if isinstance(msg, ACLMessage) else msg
+    uri = gr.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+    if uri is not None:
+        gr.set((uri, ACL['conversation-id'], Literal(trace.trace_id)))
+        gr.set((uri, ACL['in-reply-to'], Literal(trace.span_id)))
+
+
+def format_from_mimetype(mimetype, default='xml'):
+    """
+    Retorna el formato de rdflib que corresponde a un tipo MIME (se ignoran los parametros como el charset).
+    Si el tipo no es ninguno de los de WIRE_FORMATS retorna el formato por defecto
+    """
+    if mimetype:
+        mimetype = mimetype.split(';')[0].strip()
+        for format, wire_mimetype in WIRE_FORMATS.items():
+            if wire_mimetype == mimetype:
+                return format
+    return default
+
+
+def compress(data, encoding):
+    """
+    Comprime los datos con la codificacion indicada ('gzip' o 'zstd')
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=5)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError('Codificacion no soportada: %s' % encoding)
+
+
+def decompress(data, encoding):
+    """
+    Descomprime los datos segun la cabecera Content-Encoding recibida. Si no hay codificacion los retorna tal cual
+    """
+    if not encoding or encoding == 'identity':
+        return data
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError('Codificacion no soportada: %s' % encoding)
+
+
+def choose_encoding(accept_encoding):
+    """
+    Escoge, a partir de la cabecera Accept-Encoding de una peticion, la codificacion con la que comprimir la
+    respuesta. Retorna None si no hay ninguna que sepamos usar
+    """
+    if not accept_encoding:
+        return None
+    accepted = [enc.split(';')[0].strip() for enc in accept_encoding.split(',')]
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def decompress_response(r):
+    """
+    Retorna el cuerpo de una respuesta HTTP descomprimido. requests ya descomprime gzip por si solo, pero segun la
+    version de urllib3 las respuestas zstd llegan tal cual
+    """
+    data = r.content
+    if r.headers.get('Content-Encoding') == 'zstd' and data[:4] == ZSTD_MAGIC:
+        data = decompress(data, 'zstd')
+    return data
 
 
 def get_message_properties(msg):
@@ -68,21 +263,300 @@ def get_message_properties(msg):
     Del contenido solo saca el primer objeto al que apunta la propiedad
 
     Los elementos que no estan, no aparecen en el diccionario
+
+    :param msg: grafo con el mensaje o ACLMessage
     """
-    props = {'performative': ACL.performative, 'sender': ACL.sender,
-             'receiver': ACL.receiver, 'ontology': ACL.ontology,
-             'conversation-id': ACL['conversation-id'],
-             'in-reply-to': ACL['in-reply-to'], 'content': ACL.content}
+    if isinstance(msg, ACLMessage):
+        return msg.properties()
 
     msgdic = {} # Diccionario donde se guardan los elementos del mensaje
 
     # Extraemos la parte del FipaAclMessage del mensaje
     valid = msg.value(predicate=RDF.type, object=ACL.FipaAclMessage)
 
-    # Extraemos las propiedades del mensaje
+    # Extraemos las propiedades del mensaje recorriendo una sola vez sus tripletas, en lugar de hacer una consulta
+    # por propiedad
     if valid is not None:
-        for key in props:
-            val = msg.value(subject=valid, predicate=props[key])
-            if val is not None:
+        for _, prop, val in msg.triples((valid, None, None)):
+            key = ENVELOPE_KEYS.get(prop)
+            if key is not None and key not in msgdic:
                 msgdic[key] = val
     return msgdic
+
+
+def parse_envelope(data, format):
+    """
+    Retorna las propiedades del sobre de un mensaje serializado (como get_message_properties) sin leer su contenido.
+
+    En ACL_JSON solo se decodifica el sobre, que va al principio del mensaje, y en N-Triples solo se parsean las
+    lineas con URIs del namespace ACL. En el resto de formatos se parsea el mensaje entero
+
+    :param data: mensaje serializado (sin comprimir)
+    :param format: formato del mensaje, uno de WIRE_FORMATS
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    if format == ACL_JSON:
+        if data.startswith(ACL_JSON_PREFIX):
+            envelope, _ = json.JSONDecoder().raw_decode(data[len(ACL_JSON_PREFIX):].decode('utf-8'))
+        else:
+            envelope = json.loads(data)['envelope']
+        terms = {}
+        return {key: decode_term(envelope[key], terms) for key in ENVELOPE if envelope.get(key) is not None}
+
+    if format == 'nt':
+        gr = Graph()
+        gr.parse(data=b'\n'.join(line for line in data.splitlines() if ACL_NT_PREFIX in line), format='nt')
+        return get_message_properties(gr)
+
+    return get_message_properties(parse_message(data, format))
+
+
+class ACLMessage:
+    """
+    Mensaje ACL sin grafo de rdflib: el sobre se guarda en atributos y el contenido como una lista de tripletas.
+
+    Se puede usar en lugar del grafo del mensaje en las consultas habituales (get_message_properties, value,
+    triples, subjects, objects, predicates, len, in). El grafo de rdflib solo se construye si se pide (atributo
+    graph) o si se usa cualquier otro metodo de Graph (serialize, add, ...), y a partir de ese momento todas las
+    consultas se hacen sobre el grafo.
+
+    crear un mensaje con:
+
+    msg = ACLMessage(ACL.inform, sender=InfoAgent.uri, receiver=msgdic['sender'], msgcnt=mss_cnt,
+                     payload=[(billete, agn.Precio, Literal(120.5)), ...])
+    """
+    __slots__ = ('uri', 'performative', 'sender', 'receiver', 'ontology', 'conversation_id', 'in_reply_to',
+                 'reply_by', 'content', 'payload', '_graph', '_index')
+
+    # Atributo del sobre -> clave del diccionario de get_message_properties
+    FIELDS = (('performative', 'performative'), ('sender', 'sender'), ('receiver', 'receiver'),
+              ('ontology', 'ontology'), ('conversation_id', 'conversation-id'), ('in_reply_to', 'in-reply-to'),
+              ('reply_by', 'reply-by'), ('content', 'content'))
+
+    def __init__(self, performative, sender=None, receiver=None, content=None, msgcnt=0, payload=(), uri=None,
+                 ontology=None, conversation_id=None, in_reply_to=None, reply_by=None):
+        """
+        :param payload: tripletas del contenido del mensaje (sin las del sobre)
+        :param uri: URI del mensaje, por defecto la misma que le daria build_message
+        """
+        self.uri = URIRef(uri) if uri is not None else URIRef(f'{sender}-message-{msgcnt:04}')
+        self.performative = performative
+        self.sender = sender
+        self.receiver = receiver
+        self.ontology = ontology
+        self.conversation_id = conversation_id
+        self.in_reply_to = in_reply_to
+        self.reply_by = reply_by
+        self.content = content
+        self.payload = list(payload)
+        self._graph = None
+        self._index = None
+
+    @classmethod
+    def from_graph(cls, gr):
+        """
+        Retorna el mensaje ACL de un grafo. Las tripletas que no son del sobre forman el contenido
+        """
+        uri = gr.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+        props = get_message_properties(gr)
+        msg = cls(props.get('performative'), uri=uri, payload=[t for t in gr if t[0] != uri],
+                  **{attr: props.get(key) for attr, key in cls.FIELDS[1:]})
+        return msg
+
+    def properties(self):
+        """
+        Retorna las propiedades del sobre, con el mismo formato que get_message_properties
+        """
+        if self._graph is not None:
+            return get_message_properties(self._graph)
+        props = {}
+        for attr, key in self.FIELDS:
+            val = getattr(self, attr)
+            if val is not None:
+                props[key] = val
+        return props
+
+    def envelope_triples(self):
+        """
+        Retorna las tripletas del sobre, las mismas que añade build_message
+        """
+        triples = [(self.uri, RDF.type, OWL.NamedIndividual), (self.uri, RDF.type, ACL.FipaAclMessage)]
+        for attr, key in self.FIELDS:
+            val = getattr(self, attr)
+            if val is not None:
+                triples.append((self.uri, ENVELOPE[key], val))
+        return triples
+
+    @property
+    def graph(self):
+        """
+        Grafo de rdflib del mensaje, que se construye la primera vez que se pide
+        """
+        if self._graph is None:
+            gr = Graph()
+            gr.bind('acl', ACL)
+            gr.addN((s, p, o, gr) for s, p, o in self.payload)
+            gr.addN((s, p, o, gr) for s, p, o in self.envelope_triples())
+            self._graph = gr
+            self._index = None
+        return self._graph
+
+    def __getattr__(self, name):
+        # Cualquier otro metodo de Graph se hace sobre el grafo del mensaje. Los atributos propios que aun no tienen
+        # valor (por ejemplo, al copiar o deserializar el mensaje) y los metodos especiales no se delegan, para no
+        # volver a llamar a __getattr__ indefinidamente
+        if name == 'graph' or name in ACLMessage.__slots__ or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        return getattr(self.graph, name)
+
+    def index(self):
+        """
+        Retorna las tripletas del mensaje agrupadas por sujeto, sin repetidas
+        """
+        if self._index is None:
+            index = {}
+            for s, p, o in self.payload + self.envelope_triples():
+                pairs = index.setdefault(s, {})
+                pairs[(p, o)] = None
+            self._index = index
+        return self._index
+
+    def triples(self, pattern):
+        if self._graph is not None:
+            return self._graph.triples(pattern)
+        return self._triples(*pattern)
+
+    def _triples(self, subject, predicate, object):
+        index = self.index()
+        subjects = (subject,) if subject is not None else list(index)
+        for s in subjects:
+            for p, o in index.get(s, ()):
+                if (predicate is None or p == predicate) and (object is None or o == object):
+                    yield s, p, o
+
+    def value(self, subject=None, predicate=RDF.value, object=None, default=None, any=True):
+        if self._graph is not None:
+            return self._graph.value(subject, predicate, object, default, any)
+        if (subject is None) + (predicate is None) + (object is None) > 1:
+            # Mismo comportamiento que Graph.value
+            return None
+        position = 1 if predicate is None else 0 if subject is None else 2
+        values = [t[position] for t in self._triples(subject, predicate, object)]
+        if not values:
+            return default
+        if not any and len(set(values)) > 1:
+            raise UniquenessError(values)
+        return values[0]
+
+    def subjects(self, predicate=None, object=None):
+        for s, _, _ in self.triples((None, predicate, object)):
+            yield s
+
+    def predicates(self, subject=None, object=None):
+        for _, p, _ in self.triples((subject, None, object)):
+            yield p
+
+    def objects(self, subject=None, predicate=None):
+        for _, _, o in self.triples((subject, predicate, None)):
+            yield o
+
+    def __iter__(self):
+        return self.triples((None, None, None))
+
+    def __len__(self):
+        if self._graph is not None:
+            return len(self._graph)
+        return sum(len(pairs) for pairs in self.index().values())
+
+    def __contains__(self, triple):
+        for _ in self.triples(triple):
+            return True
+        return False
+
+    def to_json(self):
+        """
+        Serializa el mensaje en el formato ACL_JSON
+        """
+        if self._graph is not None:
+            return ACLMessage.from_graph(self._graph).to_json()
+        envelope = {key: encode_term(val) for key, val in self.properties().items()}
+        envelope['uri'] = str(self.uri)
+        payload = [[encode_term(s), encode_term(p), encode_term(o)] for s, p, o in self.payload]
+        return json.dumps({'envelope': envelope, 'payload': payload}, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Retorna el mensaje serializado en el formato ACL_JSON
+        """
+        msg = json.loads(data)
+        envelope = msg['envelope']
+        terms = {}
+        payload = [(decode_term(s, terms), decode_term(p, terms), decode_term(o, terms)) for s, p, o in msg['payload']]
+        return cls(decode_term(envelope.get('performative'), terms), uri=envelope['uri'], payload=payload,
+                   **{attr: decode_term(envelope.get(key), terms) for attr, key in cls.FIELDS[1:]})
+
+
+def encode_term(term):
+    """
+    Codifica un termino RDF en JSON: las URIs como cadenas, los nodos anonimos como {'_': id} y los literales como
+    listas [valor], [valor, tipo] o [valor, None, idioma]
+    """
+    if term is None:
+        return None
+    if isinstance(term, Literal):
+        if term.language:
+            return [str(term), None, term.language]
+        if term.datatype:
+            return [str(term), str(term.datatype)]
+        return [str(term)]
+    if isinstance(term, BNode):
+        return {'_': str(term)}
+    return str(term)
+
+
+def decode_term(value, terms=None):
+    """
+    Decodifica un termino RDF codificado con encode_term. Las URIs decodificadas se guardan en el diccionario terms,
+    de forma que las que se repiten en un mensaje no se vuelven a construir
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if terms is None:
+            return URIRef(value)
+        term = terms.get(value)
+        if term is None:
+            term = terms[value] = URIRef(value)
+        return term
+    if isinstance(value, list):
+        lang = value[2] if len(value) > 2 else None
+        datatype = URIRef(value[1]) if len(value) > 1 and value[1] is not None else None
+        return Literal(value[0], lang=lang, datatype=datatype)
+    return BNode(value['_'])
+
+
+def serialize_message(msg, format):
+    """
+    Serializa un mensaje (grafo o ACLMessage) en el formato indicado, uno de WIRE_FORMATS
+    """
+    if format == ACL_JSON:
+        if not isinstance(msg, ACLMessage):
+            msg = ACLMessage.from_graph(msg)
+        return msg.to_json()
+    return msg.serialize(format=format)
+
+
+def parse_message(data, format):
+    """
+    Retorna el mensaje serializado en el formato indicado, como un ACLMessage si es ACL_JSON y como un grafo si es
+    cualquiera de los formatos RDF
+    """
+    if format == ACL_JSON:
+        return ACLMessage.from_json(data)
+    gr = Graph()
+    gr.parse(data=data, format=format)
+    return gr
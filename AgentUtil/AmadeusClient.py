@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: AmadeusClient
+
+AmadeusClient
+*************
+
+:Description: AmadeusClient
+
+    Cliente de la API Amadeus compartido por todas las peticiones que atiende un agente.
+
+    El cliente se crea una sola vez por proceso y guarda el token de acceso OAuth, que se renueva en segundo plano
+    antes de que caduque, de forma que las peticiones no tienen que volver a autenticarse. Las llamadas a la API
+    se hacen a través de AgentUtil.HTTPPool para reutilizar las conexiones con el servidor de Amadeus.
+
+    Se puede usar desde varios hilos a la vez (el servidor Flask atiende cada petición en su propio hilo).
+
+    obtener el cliente con:
+
+    amadeus = get_amadeus_client()
+    response = amadeus.shopping.flight_offers_search.get(...)
+
+    o, para usar otro servidor con la misma API (por ejemplo el de Benchmarks.ServidoresFalsos):
+
+    amadeus = get_amadeus_client(**amadeus_options('http://localhost:9600'))
+"""
+
+import logging
+import os
+import threading
+import time
+from urllib.error import URLError
+from urllib.parse import urlsplit
+
+import requests
+from amadeus import Client, ResponseError
+from amadeus.client.access_token import AccessToken
+
+from AgentUtil.APIKeys import AMADEUS_KEY, AMADEUS_SECRET
+from AgentUtil.HTTPPool import http_request
+from AgentUtil.Tracing import span
+
+logger = logging.getLogger('log')
+
+# Segundos antes de que caduque el token en los que se pide uno nuevo en segundo plano
+REFRESH_MARGIN = 60
+
+# Cliente compartido del proceso
+_client = None
+_lock = threading.Lock()
+
+
+class PooledResponse:
+    """
+    Adapta una respuesta de requests a la interfaz de las respuestas de urllib que espera la librería de Amadeus
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status_code
+
+    def info(self):
+        return self.response.headers
+
+    def read(self):
+        return self.response.content
+
+
+def pooled_http(request):
+    """
+    Hace la petición HTTP de la librería de Amadeus (un urllib.request.Request) usando el pool de conexiones
+    compartido. Los errores de conexión se retornan como URLError, igual que hace la librería con urlopen, para
+    que lleguen al agente como un ResponseError
+    """
+    try:
+        with span('amadeus', path=urlsplit(request.full_url).path):
+            response = http_request(request.get_method(), request.full_url, data=request.data,
+                                    headers=dict(request.header_items()))
+    except requests.RequestException as error:
+        raise URLError(error)
+    return PooledResponse(response)
+
+
+class CachedAccessToken(AccessToken):
+    """
+    Token de acceso de Amadeus que se puede compartir entre hilos. Solo un hilo pide el token cuando no hay
+    ninguno válido, y se renueva en segundo plano REFRESH_MARGIN segundos antes de que caduque
+    """
+    def __init__(self, client, refresh_margin=None):
+        super().__init__(client)
+        self.refresh_margin = refresh_margin if refresh_margin is not None else REFRESH_MARGIN
+        self.refreshes = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def _bearer_token(self):
+        return 'Bearer {0}'.format(self.token())
+
+    def token(self):
+        """
+        Retorna el token de acceso, pidiendo uno nuevo si no hay ninguno o está a punto de caducar
+        """
+        if self.needs_refresh():
+            with self.lock:
+                if self.needs_refresh():
+                    self.refresh()
+        return self.access_token
+
+    def needs_refresh(self):
+        return self.access_token is None or time.time() + self.TOKEN_BUFFER >= self.expires_at
+
+    def refresh(self):
+        """
+        Pide un token nuevo a la API y programa su renovación
+        """
+        response = self.client._unauthenticated_request(
+            'POST',
+            '/v1/security/oauth2/token',
+            {
+                'grant_type': 'client_credentials',
+                'client_id': self.client.client_id,
+                'client_secret': self.client.client_secret
+            }
+        )
+        expires_in = response.result.get('expires_in', 0)
+        self.access_token = response.result.get('access_token', None)
+        self.expires_at = time.time() + expires_in
+        self.refreshes += 1
+        self.schedule(max(expires_in - self.refresh_margin, self.TOKEN_BUFFER))
+
+    def schedule(self, delay):
+        self.cancel()
+        self.timer = threading.Timer(delay, self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        try:
+            with self.lock:
+                self.refresh()
+        except ResponseError as error:
+            # Si falla, el token se pedirá en la siguiente petición
+            logger.info("No se ha podido renovar el token de Amadeus: %s", error)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def create_amadeus_client(**options):
+    """
+    Crea un cliente de Amadeus con las credenciales de AgentUtil.APIKeys, el token compartido y las conexiones
+    del pool. Las opciones se pasan tal cual al cliente de Amadeus (hostname, host, port, ssl, ...)
+    """
+    options.setdefault('http', pooled_http)
+    client = Client(client_id=AMADEUS_KEY, client_secret=AMADEUS_SECRET, **options)
+    client.access_token = CachedAccessToken(client)
+    return client
+
+
+def amadeus_options(url):
+    """
+    Retorna las opciones del cliente de Amadeus (host, port, ssl) para usar el servidor de la URL indicada en lugar
+    del de Amadeus. Si la URL es None retorna las opciones por defecto
+    """
+    if url is None:
+        return {}
+    parts = urlsplit(url)
+    ssl = parts.scheme == 'https'
+    return {'host': parts.hostname, 'port': parts.port or (443 if ssl else 80), 'ssl': ssl}
+
+
+def get_amadeus_client(**options):
+    """
+    Retorna el cliente de Amadeus del proceso, creándolo la primera vez con las opciones dadas
+    """
+    global _client
+
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = create_amadeus_client(**options)
+    return _client
+
+
+def reset_after_fork():
+    """
+    En cada proceso creado con fork (por ejemplo los workers de AgentUtil.Launcher) el token se sigue usando, pero el
+    hilo que lo renovaba no existe: se renovará en la primera petición que lo encuentre a punto de caducar
+    """
+    global _lock
+
+    _lock = threading.Lock()
+    if _client is not None:
+        _client.access_token.lock = threading.Lock()
+        _client.access_token.timer = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def close_amadeus_client():
+    """
+    Cancela la renovación del token del cliente del proceso
+    """
+    global _client
+
+    with _lock:
+        if _client is not None:
+            _client.access_token.cancel()
+            _client = None
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Cache
+
+Cache
+*****
+
+:Description: Cache
+
+    Caché en memoria con tiempo de vida (TTL) por entrada, número máximo de entradas con expulsión LRU y contadores
+    de aciertos y fallos. Es segura para usarla desde varios hilos.
+
+    crear la caché con:
+
+    cache = TTLCache(maxsize=128, ttl=60)
+
+    usarla con:
+
+    value = cache.get(key)
+    if value is None:
+        value = calcular(key)
+        cache.put(key, value)
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize=128, ttl=60):
+        """
+        :param maxsize: número máximo de entradas, None para no limitarlo
+        :param ttl: tiempo de vida (en segundos) de cada entrada, None para que no caduquen
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Retorna el valor de la clave si está en la caché y no ha caducado. Cuenta como acierto o fallo
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """
+        Como get, pero sin actualizar el orden LRU ni los contadores
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return entry[0]
+            return default
+
+    def put(self, key, value, ttl=None):
+        """
+        Guarda el valor de la clave, expulsando la entrada usada hace más tiempo si la caché está llena
+
+        :param ttl: tiempo de vida de esta entrada, por defecto el de la caché
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Elimina la clave de la caché
+        """
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        """
+        Retorna los contadores de la caché
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.data),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0.0}
@@ -1,3 +1,8 @@
+from math import radians, sin, cos, asin, sqrt
+
+# Radio medio de la Tierra, en kilómetros
+RADIO_TIERRA = 6371.0
+
 COORDENADAS = {
     "BCN": {
         "latitude": 41.390205,
@@ -28,3 +33,13 @@ COORDENADAS = {
         "longitude": 12.496366
     }
 }
+
+
+def distancia(latitude1, longitude1, latitude2, longitude2):
+    """
+    Retorna la distancia en kilómetros entre dos puntos dados por su latitud y longitud (fórmula del haversine)
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (sin((latitude2 - latitude1) / 2) ** 2 +
+         cos(latitude1) * cos(latitude2) * sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * RADIO_TIERRA * asin(sqrt(a))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Deadline
+
+Deadline
+********
+
+:Description: Deadline
+
+    Tiempo límite de las peticiones que recorren la cadena de agentes. AgenteUnificador fija el límite de cada
+    petición de plan y viaja con los mensajes ACL en la propiedad reply-by del sobre (un xsd:dateTime en UTC), de forma
+    que cada agente sabe cuánto tiempo le queda para responder (ver AgentUtil.ACLMessages y AgentUtil.FlaskServer).
+
+    El límite actual se guarda en una variable de contexto (contextvars), igual que el span de la traza (ver
+    AgentUtil.Tracing), así que cada petición atendida y cada rama de AgentUtil.ScatterGather tiene el suyo. Con él se
+    acotan los tiempos de espera de las peticiones HTTP (AgentUtil.HTTPPool), de las ramas de ScatterGather y de las
+    peticiones agrupadas con AgentUtil.SingleFlight. Una vez superado, las peticiones HTTP fallan con DeadlineExceeded
+    sin llegar a enviarse.
+
+    Los agentes que no acaban a tiempo responden con un 'failure' con contenido EXCEEDED, y con los resultados
+    parciales que tengan.
+
+    Cada agente deja de esperar a los agentes a los que llama MARGIN segundos antes del límite de la petición que
+    atiende, para tener tiempo de responder (con los resultados parciales que tenga) antes de que el que le ha llamado
+    deje de esperarle.
+
+    El límite es un instante del reloj del sistema, así que se supone que los relojes de los agentes están
+    sincronizados (como se supone para reply-by en FIPA-ACL).
+
+    fijar el límite de un bloque con:
+
+    with deadline(30):
+        results = scatter_gather.run(...)
+
+    consultar el tiempo que queda con:
+
+    remaining()
+"""
+
+import datetime
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+from rdflib import Literal, URIRef
+
+_deadline = ContextVar('deadline', default=None)
+
+# Tiempo (en segundos) que cada agente se reserva para responder antes del límite de la petición que atiende
+MARGIN = 0.1
+
+# Contenido (el motivo) de los mensajes 'failure' con los que se responde cuando se supera el tiempo límite
+EXCEEDED = URIRef('http://www.agentes.org#TiempoLimiteSuperado')
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Se ha superado el tiempo límite de la petición. Es un requests.Timeout para que los agentes lo traten como
+    cualquier otro timeout de las peticiones HTTP
+    """
+
+
+def current_deadline():
+    """
+    Retorna el instante límite (de time.time()) del contexto actual, o None si no hay ninguno
+    """
+    return _deadline.get()
+
+
+def remaining():
+    """
+    Retorna los segundos que quedan hasta el límite (negativo si ya ha pasado), o None si no hay límite
+    """
+    limit = _deadline.get()
+    if limit is None:
+        return None
+    return limit - time.time()
+
+
+def expired():
+    limit = _deadline.get()
+    return limit is not None and time.time() >= limit
+
+
+def set_deadline(limit):
+    """
+    Fija el instante límite del contexto actual (None para quitarlo). Retorna el token con el que se restaura el
+    anterior (ver reset_deadline)
+    """
+    return _deadline.set(limit)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Fija el límite del bloque a seconds segundos a partir de ahora, o el límite actual si es anterior
+    """
+    limit = time.time() + seconds
+    current = _deadline.get()
+    token = _deadline.set(limit if current is None else min(current, limit))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def limit_timeout(timeout):
+    """
+    Retorna el timeout de una petición de requests (un número, una tupla (conexión, lectura) o None) acotado por el
+    tiempo que queda hasta el límite
+
+    :raise DeadlineExceeded: si ya se ha superado el límite
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded('Se ha superado el tiempo límite de la petición')
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+def to_literal(limit):
+    """
+    Retorna el instante límite como el literal (xsd:dateTime en UTC) de la propiedad reply-by del sobre
+    """
+    return Literal(datetime.datetime.fromtimestamp(limit, datetime.timezone.utc))
+
+
+def from_literal(value):
+    """
+    Retorna el instante límite (de time.time()) del literal de reply-by, o None si no es una fecha válida
+    """
+    value = value.toPython() if isinstance(value, Literal) else value
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
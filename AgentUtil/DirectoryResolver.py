@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: DirectoryResolver
+
+DirectoryResolver
+*****************
+
+:Description: DirectoryResolver
+
+    Resolución de agentes a través del servicio de directorio con una caché local de las respuestas.
+
+    Las respuestas del directorio se guardan por tipo de agente (DSO.AgentType) durante un tiempo (TTL), de forma
+    que las peticiones sucesivas no necesitan hacer una búsqueda en el directorio antes de contactar con el agente.
+    Si la conexión con la dirección guardada falla, la entrada se invalida y se vuelve a preguntar al directorio.
+
+    Cuando hay varios agentes registrados del mismo tipo, las peticiones se reparten entre ellos con un
+    LoadBalancer (ver AgentUtil.LoadBalancer), al que se pasan las asignaciones de cada agente que indica el
+    directorio en sus respuestas.
+
+    crear el resolver con la función que hace la búsqueda en el directorio (recibe el tipo de agente y retorna el
+    grafo de respuesta del directorio):
+
+    resolver = DirectoryResolver(directory_search, ttl=60)
+
+    llamar a un agente con:
+
+    res_graph = resolver.call(DSO.FlightsAgent, infoagent_search, req_graph)
+
+    que llama a infoagent_search(agn_addr, agn_uri, req_graph) con la dirección y la URI del agente encontrado.
+"""
+
+import logging
+import time
+
+import requests
+from rdflib import Namespace
+from rdflib.namespace import RDF
+
+from AgentUtil.ACL import ACL
+from AgentUtil.Cache import TTLCache
+from AgentUtil.DSO import DSO
+from AgentUtil.LoadBalancer import LoadBalancer
+from AgentUtil.Tracing import span
+
+agn = Namespace("http://www.agentes.org#")
+
+logger = logging.getLogger('log')
+
+
+class AgentNotFound(Exception):
+    """
+    No hay ningún agente registrado en el directorio del tipo buscado
+    """
+    pass
+
+
+def parse_directory_response(gr):
+    """
+    Retorna la lista de agentes (dirección, URI) de una respuesta de búsqueda del directorio. Si la respuesta no
+    tiene contenido la lista es vacía
+    """
+    msg = gr.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+    content = gr.value(subject=msg, predicate=ACL.content)
+    if content is None:
+        return []
+
+    # El primer agente está directamente en el objeto de respuesta, el resto como candidatos
+    first = (gr.value(subject=content, predicate=DSO.Address), gr.value(subject=content, predicate=DSO.Uri))
+    candidates = [first]
+    for cand in gr.objects(subject=content, predicate=agn.candidato):
+        candidate = (gr.value(subject=cand, predicate=DSO.Address), gr.value(subject=cand, predicate=DSO.Uri))
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return [candidate for candidate in candidates if candidate[0] is not None]
+
+
+def parse_load_hints(gr):
+    """
+    Retorna, por dirección, las peticiones que el directorio ha asignado a cada candidato de una respuesta de búsqueda
+    (agn.asignaciones). Los candidatos sin ese dato no aparecen
+    """
+    hints = {}
+    for cand in gr.objects(predicate=agn.candidato):
+        address = gr.value(subject=cand, predicate=DSO.Address)
+        assigned = gr.value(subject=cand, predicate=agn.asignaciones)
+        if address is not None and assigned is not None:
+            hints[address] = int(assigned)
+    return hints
+
+
+class DirectoryResolver:
+    def __init__(self, search, ttl=60, maxsize=32, balancer=None):
+        """
+        :param search: función que busca en el directorio un tipo de agente y retorna el grafo de respuesta
+        :param ttl: tiempo (en segundos) que se guardan las respuestas del directorio
+        :param maxsize: número máximo de tipos de agente guardados
+        :param balancer: LoadBalancer con el que se escoge entre varios agentes, por defecto round-robin
+        """
+        self.search = search
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.balancer = balancer if balancer is not None else LoadBalancer()
+
+    def candidates(self, agent_type):
+        """
+        Retorna la lista de agentes (dirección, URI) del tipo dado, consultando el directorio solo si no está en la
+        caché. Las búsquedas sin resultados no se guardan
+
+        :raise AgentNotFound: si no hay ningún agente de ese tipo
+        """
+        with span('directory-lookup', agent_type=str(agent_type)) as lookup:
+            candidates = self.cache.get(agent_type)
+            lookup.set('cached', candidates is not None)
+            if candidates is None:
+                gr = self.search(agent_type)
+                candidates = parse_directory_response(gr)
+                if not candidates:
+                    raise AgentNotFound(str(agent_type))
+                self.balancer.hint(parse_load_hints(gr))
+                self.cache.put(agent_type, candidates)
+            lookup.set('candidates', len(candidates))
+            return candidates
+
+    def resolve(self, agent_type, exclude=()):
+        """
+        Retorna la dirección y la URI de un agente del tipo dado, escogido por el balanceador
+
+        :param exclude: direcciones a evitar, si hay alternativas
+        :raise AgentNotFound: si no hay ningún agente de ese tipo
+        """
+        return self.balancer.choose(self.candidates(agent_type), exclude)
+
+    def invalidate(self, agent_type, address=None):
+        """
+        Elimina de la caché la respuesta guardada para el tipo de agente. Si se indica una dirección, solo se elimina
+        si la respuesta guardada la contiene
+        """
+        candidates = self.cache.peek(agent_type)
+        if candidates is not None and (address is None or address in [addr for addr, _ in candidates]):
+            self.cache.invalidate(agent_type)
+
+    def call(self, agent_type, func, *args):
+        """
+        Llama a func(agn_addr, agn_uri, *args) con un agente del tipo dado. Si no se puede conectar con él, se
+        invalida la caché y se reintenta una vez, con otro agente si lo hay, con la respuesta actualizada del
+        directorio
+
+        :raise AgentNotFound: si no hay ningún agente de ese tipo
+        """
+        agn_addr, agn_uri = self.resolve(agent_type)
+        try:
+            return self.call_agent(agn_addr, agn_uri, func, *args)
+        except requests.ConnectionError:
+            logger.info("No se puede conectar con %s, se vuelve a buscar en el directorio.", agn_addr)
+            self.invalidate(agent_type, agn_addr)
+            agn_addr, agn_uri = self.resolve(agent_type, exclude=(agn_addr,))
+            return self.call_agent(agn_addr, agn_uri, func, *args)
+
+    def call_agent(self, agn_addr, agn_uri, func, *args):
+        """
+        Llama a func(agn_addr, agn_uri, *args) anotando en el balanceador la petición en curso y su duración
+        """
+        self.balancer.start(agn_addr)
+        start = time.monotonic()
+        ok = False
+        try:
+            result = func(agn_addr, agn_uri, *args)
+            ok = True
+            return result
+        finally:
+            self.balancer.finish(agn_addr, time.monotonic() - start, ok)
+
+    def stats(self):
+        """
+        Retorna los contadores de aciertos y fallos de la caché
+        """
+        return self.cache.stats()
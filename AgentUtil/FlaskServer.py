@@ -10,21 +10,92 @@ Diferentes funciones comunes a los agentes implementados en ECSDI
 
 """
 
-from flask import request
+import time
 
-__author__ = 'bejar'
+from flask import request, Response, g
+
+from AgentUtil.ACLMessages import decompress, compress, choose_encoding, format_from_mimetype, COMPRESSION_MIN_SIZE, \
+    WIRE_FORMATS, parse_message, serialize_message, get_message_properties
+from AgentUtil.Deadline import MARGIN, from_literal, reset_deadline, set_deadline
+from AgentUtil.Launcher import request_shutdown
+from AgentUtil.Tracing import Span, activate, deactivate, span
 
+__author__ = 'bejar'
 
 
 def shutdown_server():
     """
-    Funcion que para el servidor web
+    Funcion que para el servidor web. El servidor acaba las peticiones en curso (incluida la que llama a esta
+    funcion) antes de parar (ver AgentUtil.Launcher)
+
+    :raise RuntimeError: si el agente no se ha puesto en marcha con AgentUtil.Launcher.run_agent
+    """
+    request_shutdown()
+
+
+def get_message():
+    """
+    Retorna el mensaje ACL recibido en la peticion actual como un grafo RDF (o como un ACLMessage, si viene en el
+    formato ACL_JSON). Acepta tanto el modo original, con el
+    mensaje en RDF/XML en el parametro 'content' de un GET, como el mensaje en el cuerpo de un POST, posiblemente
+    comprimido y en el formato indicado en la cabecera Content-Type
+
+    La peticion se mide como un span de la traza que indica el sobre del mensaje (conversation-id e in-reply-to, ver
+    AgentUtil.Tracing), que es el span actual hasta que se envia la respuesta con message_response. Del mismo modo, el
+    tiempo limite del sobre (reply-by), menos el margen para responder, es el de la peticion (ver AgentUtil.Deadline),
+    y acota los envios que se hagan para atenderla
+
+    :raise KeyError: si la peticion no contiene ningun mensaje
+    """
+    start = time.perf_counter()
+    if request.method == 'POST':
+        data = decompress(request.get_data(), request.headers.get('Content-Encoding'))
+        format = format_from_mimetype(request.headers.get('Content-Type'))
+    else:
+        data = request.args['content']
+        format = 'xml'
+
+    msg = parse_message(data, format)
+    parse_time = time.perf_counter() - start
+
+    msgdic = get_message_properties(msg)
+    hop = Span(request.path, msgdic.get('conversation-id'), msgdic.get('in-reply-to'), started=start,
+               performative=str(msgdic.get('performative')), sender=str(msgdic.get('sender')))
+    hop.child('parse', started=start, format=format, bytes=len(data)).finish(parse_time)
+    g.trace = (hop, activate(hop))
+
+    # El limite se fija aunque el mensaje no tenga (a None), para no heredar el de la peticion anterior de la misma
+    # conexion
+    limit = from_literal(msgdic['reply-by']) if 'reply-by' in msgdic else None
+    g.deadline = set_deadline(limit - MARGIN if limit is not None else None)
+    return msg
+
+
+def message_response(gr):
+    """
+    Construye la respuesta HTTP con el mensaje serializado en el formato que pida el cliente en la cabecera Accept
+    (RDF/XML si no pide ninguno que conozcamos), comprimiendolo si el cliente lo acepta y el mensaje es
+    suficientemente grande
 
-    :raise RuntimeError:
+    :param gr: grafo (o ACLMessage) con el mensaje de respuesta
     """
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
+    mimetype = request.accept_mimetypes.best_match(list(WIRE_FORMATS.values()), default=WIRE_FORMATS['xml'])
+    with span('serialize', format=format_from_mimetype(mimetype)):
+        data = serialize_message(gr, format_from_mimetype(mimetype))
 
+        headers = {}
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is not None and len(data) >= COMPRESSION_MIN_SIZE:
+            data = compress(data, encoding)
+            headers['Content-Encoding'] = encoding
 
+    # Acaba el span y el limite de la peticion que ha empezado get_message
+    token = g.pop('deadline', None)
+    if token is not None:
+        reset_deadline(token)
+    trace = g.pop('trace', None)
+    if trace is not None:
+        hop, token = trace
+        deactivate(token)
+        hop.finish()
+    return Response(data, mimetype=mimetype, headers=headers)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: FlightOffers
+
+FlightOffers
+************
+
+:Description: FlightOffers
+
+    Tratamiento de las ofertas de vuelos de la API Amadeus (flight_offers_search).
+
+    Las ofertas se convierten una sola vez en un array estructurado de NumPy, con una columna por campo (id, precio,
+    salida, llegada, clase y duración). El filtrado por presupuesto y la ordenación se hacen sobre las columnas, y el
+    grafo de respuesta se construye de una sola vez con todas las tripletas de los billetes.
+
+    usar con:
+
+    offers = parse_offers(response.data)
+    offers = filter_offers(offers, budget)
+    gr = offers_graph(offers, 'Barcelona', 'Paris')
+"""
+
+import math
+import re
+
+import numpy as np
+from rdflib import Namespace
+
+from AgentUtil.GraphBuilder import new_graph, add_entities
+
+agn = Namespace("http://www.agentes.org#")
+
+# Columnas del array de ofertas. La duración es NaN si la oferta no la indica
+OFFER_DTYPE = np.dtype([('id', 'i8'),
+                        ('price', 'f8'),
+                        ('departure', 'U19'),
+                        ('arrival', 'U19'),
+                        ('fare', 'U32'),
+                        ('duration', 'f8')])
+
+# Formato de las duraciones de los itinerarios de Amadeus
+DURATION = re.compile(r'P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?')
+
+
+def duration_minutes(duration):
+    """
+    Retorna en minutos una duración en formato ISO 8601 como las que da la API Amadeus (por ejemplo 'PT2H10M' o
+    'P1DT3H'), o None si no se puede interpretar
+    """
+    match = DURATION.fullmatch(duration or '')
+    if match is None:
+        return None
+    days, hours, minutes = (int(value) if value else 0 for value in match.groups())
+    return (days * 24 + hours) * 60 + minutes
+
+
+def parse_offers(offers):
+    """
+    Retorna las ofertas de la API (en formato JSON) como un array estructurado con OFFER_DTYPE.
+
+    Para determinar la fecha de salida y la fecha de llegada solo consideramos el primer segmento del vuelo, en el caso
+    de un vuelo con escalas. Solo consideramos una tipo (clase) de billete, en el caso que haya más de uno.
+    """
+    rows = []
+    for ticket in offers:
+        itinerary = ticket["itineraries"][0]
+        duration = duration_minutes(itinerary.get("duration"))
+        rows.append((int(ticket["id"]),
+                     float(ticket["price"]["total"]),
+                     itinerary["segments"][0]["departure"]["at"],
+                     itinerary["segments"][0]["arrival"]["at"],
+                     ticket["travelerPricings"][0]["fareOption"],
+                     np.nan if duration is None else duration))
+    return np.array(rows, dtype=OFFER_DTYPE)
+
+
+def filter_offers(offers, budget):
+    """
+    Retorna las ofertas con un precio no superior al presupuesto, ordenadas de más barata a más cara
+    """
+    offers = offers[offers['price'] <= float(budget)]
+    return offers[np.argsort(offers['price'], kind='stable')]
+
+
+def offers_graph(offers, origin, destination, gr=None):
+    """
+    Añade los billetes de las ofertas al grafo (o a uno nuevo) y lo retorna. Todas las tripletas se añaden de una sola
+    vez
+    """
+    if gr is None:
+        gr = new_graph()
+
+    columns = [offers[name].tolist() for name in OFFER_DTYPE.names]
+    tickets = []
+    for ident, price, departure, arrival, fare, duration in zip(*columns):
+        tickets.append((agn["Billete" + str(ident)], {agn.esUn: agn.Billete,
+                                                      agn.Id: ident,
+                                                      agn.origenBillete: origin,
+                                                      agn.destinoBillete: destination,
+                                                      agn.DiaHoraSalida: departure,
+                                                      agn.DiaHoraLlegada: arrival,
+                                                      agn.Asiento: "A23",  # Asiento inventado
+                                                      agn.Clase: fare,
+                                                      agn.Precio: price,
+                                                      agn.Duracion: None if math.isnan(duration) else int(duration)}))
+    return add_entities(gr, tickets)
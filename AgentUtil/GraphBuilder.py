@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: GraphBuilder
+
+GraphBuilder
+************
+
+:Description: GraphBuilder
+
+    Construcción de los grafos de respuesta de los agentes de información.
+
+    En lugar de añadir las tripletas de cada entidad (billete, hotel, actividad) una a una con Graph.add, las entidades
+    se describen como diccionarios predicado -> valor y se añaden todas de una vez con Graph.addN. Los grafos se crean
+    sobre el store Memory de rdflib, que no guarda contextos y es bastante más rápido que el store por defecto para
+    grafos que solo se construyen y se serializan.
+
+    construir un grafo con:
+
+    gr = new_graph()
+    add_entities(gr, [(agn[hotel['hotelId']], {agn.esUn: agn.Hotel,
+                                              agn.Nombre: hotel['name'],
+                                              agn.Precio: precio})
+                      for hotel in hoteles])
+
+    Los valores que no son nodos RDF (URIRef, Literal, ...) se convierten en literales, los valores None se omiten y
+    las listas generan una tripleta por elemento.
+"""
+
+from rdflib import Graph, Literal
+from rdflib.plugins.memory import Memory
+from rdflib.term import Node
+
+
+def new_graph():
+    """
+    Retorna un grafo vacío sobre el store Memory
+    """
+    return Graph(store=Memory())
+
+
+def copy_graph(gr):
+    """
+    Retorna un grafo nuevo sobre el store Memory con las mismas tripletas que gr, para poder modificarlo sin cambiar
+    el original
+    """
+    copy = new_graph()
+    copy.addN((s, p, o, copy) for s, p, o in gr)
+    return copy
+
+
+def entity_triples(subject, properties):
+    """
+    Retorna la lista de tripletas de una entidad a partir del diccionario predicado -> valor de sus propiedades
+    """
+    triples = []
+    for predicate, value in properties.items():
+        if value is None:
+            continue
+        for item in (value if isinstance(value, (list, tuple)) else (value,)):
+            triples.append((subject, predicate, item if isinstance(item, Node) else Literal(item)))
+    return triples
+
+
+def add_entities(gr, entities):
+    """
+    Añade al grafo, de una sola vez, las tripletas de todas las entidades y lo retorna
+
+    :param entities: iterable de (sujeto, diccionario predicado -> valor)
+    """
+    gr.addN((s, p, o, gr) for subject, properties in entities for s, p, o in entity_triples(subject, properties))
+    return gr
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: HTTPPool
+
+HTTPPool
+********
+
+:Description: HTTPPool
+
+    Capa de conexiones HTTP compartida por todos los envíos de mensajes entre agentes.
+
+    Mantiene una sesión de requests por destino (esquema + host + puerto) con su propio pool de conexiones
+    keep-alive, de forma que las peticiones sucesivas a un mismo agente reutilizan la conexión TCP en lugar de
+    abrir una nueva cada vez.
+
+    configurar el pool (antes de enviar el primer mensaje) con:
+
+    configure(pool_size=20, connect_timeout=2, read_timeout=30)
+
+    hacer una petición con:
+
+    r = http_request('POST', address, data=msg)
+
+    consultar las estadísticas de reutilización con:
+
+    pool_stats()
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from AgentUtil.Deadline import DeadlineExceeded, expired, limit_timeout
+from AgentUtil.Metrics import CLIENT_ERRORS, CLIENT_SECONDS
+from AgentUtil.Tracing import span
+
+# Número máximo de conexiones abiertas por destino
+POOL_SIZE = 10
+
+# Tiempos máximos (en segundos) para establecer la conexión y para recibir la respuesta
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+# Si es False se pide al servidor que cierre la conexión después de cada petición
+KEEP_ALIVE = True
+
+# Sesiones por destino
+_sessions = {}
+_lock = threading.Lock()
+
+
+def configure(pool_size=None, connect_timeout=None, read_timeout=None, keep_alive=None):
+    """
+    Cambia la configuración del pool. Solo afecta a las sesiones que se creen a partir de este momento, así que
+    hay que llamarla al arrancar el agente
+
+    :param pool_size: número máximo de conexiones por destino
+    :param connect_timeout: tiempo máximo para establecer una conexión
+    :param read_timeout: tiempo máximo de espera de la respuesta
+    :param keep_alive: mantener las conexiones abiertas entre peticiones
+    """
+    global POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT, KEEP_ALIVE
+
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    if keep_alive is not None:
+        KEEP_ALIVE = keep_alive
+
+
+def destination(address):
+    """
+    Retorna la clave del destino (esquema://host:puerto) de una dirección
+    """
+    parts = urlsplit(address)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+def get_session(address):
+    """
+    Retorna la sesión asociada al destino de la dirección, creándola si todavía no existe
+    """
+    key = destination(address)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=False)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not KEEP_ALIVE:
+                    session.headers['Connection'] = 'close'
+                _sessions[key] = session
+    return session
+
+
+def http_request(method, address, **kwargs):
+    """
+    Hace una petición HTTP usando la sesión del destino. Si no se indica un timeout se usan los del pool. La
+    petición se mide como un span 'http' de la traza en curso (ver AgentUtil.Tracing) y en las métricas del destino
+    (ver AgentUtil.Metrics), que cuentan como error las excepciones y las respuestas 5xx
+
+    Si la petición en curso tiene un tiempo límite (ver AgentUtil.Deadline), los timeouts se acotan al tiempo que queda
+
+    :return: la respuesta de requests
+    :raise DeadlineExceeded: si se ha superado el tiempo límite, antes de enviar la petición o esperando la respuesta
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    key = destination(address)
+    start = time.perf_counter()
+    with span('http', method=method, url=urlsplit(address)._replace(query='').geturl()) as http:
+        try:
+            kwargs['timeout'] = limit_timeout(kwargs['timeout'])
+            response = get_session(address).request(method, address, **kwargs)
+        except requests.Timeout as error:
+            if expired() and not isinstance(error, DeadlineExceeded):
+                # El timeout lo ha causado el tiempo límite
+                CLIENT_ERRORS.inc(key, DeadlineExceeded.__name__)
+                raise DeadlineExceeded('Se ha superado el tiempo límite esperando a %s' % key) from error
+            CLIENT_ERRORS.inc(key, type(error).__name__)
+            raise
+        except requests.RequestException as error:
+            CLIENT_ERRORS.inc(key, type(error).__name__)
+            raise
+        finally:
+            CLIENT_SECONDS.observe(time.perf_counter() - start, key)
+        if response.status_code >= 500:
+            CLIENT_ERRORS.inc(key, str(response.status_code))
+        http.set('status', response.status_code)
+        return response
+
+
+def pool_stats():
+    """
+    Retorna, para cada destino, el número de peticiones hechas, el número de conexiones abiertas para hacerlas
+    y la proporción de peticiones que han reutilizado una conexión existente
+    """
+    stats = {}
+    with _lock:
+        sessions = list(_sessions.items())
+
+    for key, session in sessions:
+        nrequests = nconnections = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    nrequests += pool.num_requests
+                    nconnections += pool.num_connections
+        stats[key] = {
+            'requests': nrequests,
+            'connections': nconnections,
+            'reuse_rate': (nrequests - nconnections) / nrequests if nrequests else 0.0
+        }
+    return stats
+
+
+def reset_after_fork():
+    """
+    Olvida las sesiones heredadas del proceso padre, sin cerrarlas, ya que sus conexiones son las del padre. Se
+    ejecuta en cada proceso creado con fork (por ejemplo los workers de AgentUtil.Launcher)
+    """
+    global _lock
+
+    _sessions.clear()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def close_all():
+    """
+    Cierra todas las sesiones y sus conexiones
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
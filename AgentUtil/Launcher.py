@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Launcher
+
+Launcher
+********
+
+:Description: Launcher
+
+    Puesta en marcha de los agentes en un servidor WSGI con varios procesos (workers) y un pool de hilos fijo en cada
+    uno, en lugar del servidor de desarrollo de Flask (app.run), que atiende todas las peticiones en un único proceso.
+
+    El proceso principal abre el socket del servidor y crea los workers con fork, que aceptan las conexiones del
+    mismo socket. Si un worker acaba inesperadamente se crea otro en su lugar. Al recibir SIGTERM o SIGINT (o al
+    llamar a request_shutdown, por ejemplo desde la entrada /Stop del agente) el proceso principal pide a los workers
+    que paren: cada worker deja de aceptar conexiones, acaba las peticiones en curso y ejecuta la función de parada
+    del agente (tidyup) antes de salir.
+
+    Con un único worker el servidor se ejecuta en el propio proceso principal, sin fork.
+
+    Todos los agentes puestos en marcha con run_agent tienen la entrada /metrics (ver AgentUtil.Metrics), que con
+    varios workers suma las métricas de todos ellos.
+
+    El estado que se crea al importar el agente (antes del fork) se copia en cada worker, así que las cachés en
+    memoria son propias de cada worker. Los contadores que han de ser únicos entre todos los workers (por ejemplo el
+    número de mensaje, que forma parte de la URI de los mensajes) se crean con SharedCounter, que se guarda en memoria
+    compartida.
+
+    poner en marcha el agente con:
+
+    run_agent(app, hostname, port, workers=4, threads=32, on_shutdown=tidyup)
+"""
+
+import contextvars
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from AgentUtil.Metrics import enable_multiprocess, instrument_app
+
+logger = logging.getLogger('log')
+
+# Segundos que una conexión keep-alive puede estar sin recibir ninguna petición antes de que se cierre. Cada conexión
+# abierta ocupa un hilo del pool, así que no se pueden mantener indefinidamente
+KEEP_ALIVE_TIMEOUT = 5
+
+# Segundos que se espera a que los workers acaben las peticiones en curso antes de matarlos
+GRACE_PERIOD = 30
+
+# Pid del proceso principal del agente, al que se envía la señal de parada
+_master_pid = None
+
+
+class SharedCounter:
+    """
+    Contador en memoria compartida, que mantiene su valor entre todos los workers del agente. Se ha de crear antes de
+    poner en marcha el servidor (normalmente como una variable global del agente)
+    """
+    def __init__(self, value=0):
+        self.shared = multiprocessing.Value('q', value)
+
+    def next(self):
+        """
+        Retorna el valor actual del contador y lo incrementa
+        """
+        with self.shared.get_lock():
+            value = self.shared.value
+            self.shared.value += 1
+        return value
+
+    @property
+    def value(self):
+        return self.shared.value
+
+
+class AgentRequestHandler(WSGIRequestHandler):
+    timeout = KEEP_ALIVE_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Servidor WSGI de Werkzeug que atiende las peticiones en un pool de hilos de tamaño fijo, en lugar de crear un
+    hilo por conexión
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app, handler=AgentRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            # Cada conexión se atiende en un contexto nuevo, para que no herede el span de traza (ver
+            # AgentUtil.Tracing) de la anterior que ha atendido el mismo hilo
+            contextvars.Context().run(self.finish_request, request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # Esperamos a que acaben las peticiones en curso
+        self.pool.shutdown(wait=True)
+        super().server_close()
+
+
+def serve(server, on_shutdown=None):
+    """
+    Atiende peticiones hasta recibir SIGTERM o SIGINT, y entonces acaba las peticiones en curso y ejecuta on_shutdown
+    """
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        # server.shutdown espera a que acabe serve_forever, así que no se puede llamar desde el hilo principal
+        if not stopping.is_set():
+            stopping.set()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # serve_forever cierra el servidor (server_close) al acabar
+    server.serve_forever()
+    if on_shutdown is not None:
+        on_shutdown()
+
+
+def start_worker(server, on_shutdown):
+    """
+    Crea un worker que atiende las peticiones del socket del servidor y retorna su pid
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            serve(server, on_shutdown)
+        except BaseException:
+            logger.exception("El worker %d ha acabado con un error.", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def run_agent(app, host, port, workers=1, threads=32, on_shutdown=None):
+    """
+    Pone en marcha el servidor del agente y retorna cuando se ha parado
+
+    :param app: aplicación Flask del agente
+    :param workers: número de procesos que atienden peticiones
+    :param threads: número de hilos de cada proceso
+    :param on_shutdown: función que se ejecuta en cada proceso al pararlo (normalmente tidyup)
+    """
+    global _master_pid
+
+    _master_pid = os.getpid()
+    instrument_app(app)
+    server = PooledWSGIServer(host, port, app, threads)
+    logger.info("Servidor en http://%s:%d con %d workers de %d hilos.", host, port, workers, threads)
+
+    if workers <= 1:
+        serve(server, on_shutdown)
+        return
+
+    metrics_dir = tempfile.mkdtemp(prefix='metrics-')
+    enable_multiprocess(metrics_dir)
+    children = {start_worker(server, on_shutdown) for _ in range(workers)}
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    while not stopping.wait(0.5):
+        # Sustituimos los workers que han acabado sin que se lo pidiésemos
+        for pid in reap(children):
+            logger.error("El worker %d ha acabado inesperadamente, creamos otro.", pid)
+            children.add(start_worker(server, on_shutdown))
+
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    limit = time.monotonic() + GRACE_PERIOD
+    while children and time.monotonic() < limit:
+        reap(children)
+        time.sleep(0.1)
+    for pid in children:
+        logger.error("El worker %d no ha acabado en %d segundos.", pid, GRACE_PERIOD)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    server.socket.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    if on_shutdown is not None:
+        on_shutdown()
+
+
+def reap(children):
+    """
+    Recoge los workers que han acabado, los elimina del conjunto y los retorna
+    """
+    finished = []
+    for pid in list(children):
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            children.discard(pid)
+            finished.append(pid)
+    return finished
+
+
+def request_shutdown():
+    """
+    Pide que se pare el agente (todos sus workers), sin esperar a que acaben las peticiones en curso
+
+    :raise RuntimeError: si el agente no se ha puesto en marcha con run_agent
+    """
+    if _master_pid is None:
+        raise RuntimeError('El agente no se ha puesto en marcha con run_agent')
+    os.kill(_master_pid, signal.SIGTERM)
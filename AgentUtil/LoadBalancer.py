@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: LoadBalancer
+
+LoadBalancer
+************
+
+:Description: LoadBalancer
+
+    Reparto de peticiones entre varios agentes del mismo tipo (por ejemplo, varias instancias de un agente de
+    información registradas en el directorio).
+
+    Estrategias disponibles:
+
+    - 'round-robin': los agentes se usan por turnos
+    - 'least-outstanding': se escoge el agente con menos peticiones en curso
+    - 'latency': se escoge al azar, con probabilidad inversamente proporcional a la latencia media observada
+
+    Las dos últimas usan las asignaciones que indica el directorio para cada agente (ver hint) para deshacer empates y
+    para escoger entre los agentes de los que todavía no se tiene ninguna medida.
+
+    usar el balanceador con:
+
+    balancer = LoadBalancer('least-outstanding')
+    agn_addr, agn_uri = balancer.choose(candidates)
+    balancer.start(agn_addr)
+    ...
+    balancer.finish(agn_addr, elapsed, ok=True)
+"""
+
+import random
+import threading
+
+STRATEGIES = ['round-robin', 'least-outstanding', 'latency']
+
+
+class LoadBalancer:
+    def __init__(self, strategy='round-robin', alpha=0.3):
+        """
+        :param strategy: estrategia de reparto, una de STRATEGIES
+        :param alpha: peso de la última medida en la media móvil exponencial de la latencia
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError('Estrategia de balanceo desconocida: %s' % strategy)
+        self.strategy = strategy
+        self.alpha = alpha
+        self.turn = 0
+        self.outstanding = {}
+        self.latency = {}
+        self.hints = {}
+        self.lock = threading.Lock()
+
+    def choose(self, candidates, exclude=()):
+        """
+        Escoge uno de los candidatos (dirección, URI) según la estrategia. Los candidatos cuya dirección está en
+        exclude solo se escogen si no queda ningún otro
+        """
+        available = [cand for cand in candidates if cand[0] not in exclude] or list(candidates)
+        if len(available) == 1:
+            return available[0]
+
+        with self.lock:
+            if self.strategy == 'least-outstanding':
+                return min(available, key=self.load)
+            if self.strategy == 'latency':
+                # Los agentes que todavía no se han usado se prueban primero, empezando por los menos cargados
+                untried = [cand for cand in available if cand[0] not in self.latency]
+                if untried:
+                    return min(untried, key=self.load)
+                weights = [1.0 / max(self.latency[cand[0]], 1e-3) for cand in available]
+                return random.choices(available, weights=weights)[0]
+            self.turn += 1
+            return available[self.turn % len(available)]
+
+    def load(self, candidate):
+        """
+        Retorna la carga conocida de un candidato: sus peticiones en curso y, para deshacer empates, las asignaciones
+        que indica el directorio
+        """
+        address = candidate[0]
+        return self.outstanding.get(address, 0), self.hints.get(address, 0)
+
+    def hint(self, hints):
+        """
+        Actualiza las asignaciones de cada dirección que indica el directorio en sus respuestas de búsqueda
+        """
+        with self.lock:
+            self.hints.update(hints)
+
+    def start(self, address):
+        """
+        Anota el inicio de una petición a la dirección
+        """
+        with self.lock:
+            self.outstanding[address] = self.outstanding.get(address, 0) + 1
+
+    def finish(self, address, elapsed, ok=True):
+        """
+        Anota el final de una petición a la dirección y su duración (en segundos). Las peticiones fallidas no
+        actualizan la latencia media
+        """
+        with self.lock:
+            self.outstanding[address] = max(0, self.outstanding.get(address, 0) - 1)
+            if ok:
+                previous = self.latency.get(address)
+                if previous is None:
+                    self.latency[address] = elapsed
+                else:
+                    self.latency[address] = self.alpha * elapsed + (1 - self.alpha) * previous
+
+    def stats(self):
+        """
+        Retorna, por dirección, las peticiones en curso y la latencia media observada
+        """
+        with self.lock:
+            addresses = set(self.outstanding) | set(self.latency)
+            return {str(addr): {'outstanding': self.outstanding.get(addr, 0), 'latency': self.latency.get(addr)}
+                    for addr in addresses}
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Metrics
+
+Metrics
+*******
+
+:Description: Metrics
+
+    Métricas de funcionamiento de los agentes, en el formato de texto de Prometheus, que se sirven en la entrada
+    /metrics de cada agente.
+
+    Se registran:
+
+        - el número de peticiones, su duración y el tamaño de las peticiones y las respuestas, por entrada (route) del
+          agente
+        - la duración y los errores de las peticiones HTTP que hace el agente (a otros agentes y a las APIs externas),
+          por destino (ver AgentUtil.HTTPPool)
+        - los aciertos, fallos y tamaño de las cachés registradas con register_cache
+
+    Los contadores e histogramas se guardan en memoria y su actualización solo cuesta un diccionario y un lock sin
+    contención, así que no afectan a la entrada /comm. El texto de Prometheus solo se genera al pedir /metrics.
+
+    Con varios workers (ver AgentUtil.Launcher) cada worker guarda periódicamente sus métricas en un fichero de un
+    directorio compartido, y la entrada /metrics suma las de todos ellos.
+
+    instrumentar una aplicación Flask (lo hace AgentUtil.Launcher.run_agent) con:
+
+    instrument_app(app)
+
+    registrar una caché (cualquier objeto con un método stats() como el de AgentUtil.Cache.TTLCache) con:
+
+    register_cache('vuelos', flights_cache)
+"""
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+# Límites (en segundos) de los intervalos de los histogramas de duración
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Límites (en bytes) de los intervalos de los histogramas de tamaño
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Cada cuántos segundos guarda cada worker sus métricas en el directorio compartido
+DUMP_INTERVAL = 1
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Métricas del proceso, por nombre
+REGISTRY = {}
+
+# Cachés registradas, por nombre
+CACHES = {}
+
+# Directorio compartido por los workers, None si el agente tiene un solo proceso
+_directory = None
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param labels: nombres de las etiquetas de la métrica
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def inc(self, *labels, amount=1):
+        """
+        Incrementa el contador de los valores de las etiquetas dados
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: límites superiores de los intervalos, en orden creciente
+        """
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        """
+        Anota un valor en el histograma de los valores de las etiquetas dados
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Número de valores de cada intervalo (el último es +Inf) y suma de los valores
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+
+HTTP_REQUESTS = Counter('agent_http_requests_total', 'Peticiones atendidas por el agente.',
+                        ('route', 'method', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('agent_http_request_seconds', 'Duración de las peticiones atendidas.', ('route',))
+HTTP_REQUEST_BYTES = Histogram('agent_http_request_bytes', 'Tamaño del cuerpo de las peticiones atendidas.',
+                               ('route',), SIZE_BUCKETS)
+HTTP_RESPONSE_BYTES = Histogram('agent_http_response_bytes', 'Tamaño del cuerpo de las respuestas.',
+                                ('route',), SIZE_BUCKETS)
+CLIENT_SECONDS = Histogram('agent_client_request_seconds',
+                           'Duración de las peticiones HTTP a otros agentes y APIs externas.', ('destination',))
+CLIENT_ERRORS = Counter('agent_client_errors_total',
+                        'Peticiones HTTP a otros agentes y APIs externas que han fallado.', ('destination', 'error'))
+
+
+def register_cache(name, cache):
+    """
+    Registra una caché para publicar sus contadores. El objeto ha de tener un método stats() que retorne un
+    diccionario con 'hits', 'misses' y 'size'
+    """
+    CACHES[name] = cache
+
+
+def snapshot():
+    """
+    Retorna las métricas del proceso como un diccionario que se puede guardar en JSON
+    """
+    metrics = {name: {'type': metric.type,
+                      'help': metric.help,
+                      'labels': list(metric.labels),
+                      'buckets': list(getattr(metric, 'buckets', ())),
+                      'values': metric.snapshot()}
+               for name, metric in REGISTRY.items()}
+    caches = {}
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        caches[name] = {key: stats.get(key, 0) for key in ('hits', 'misses', 'size')}
+    return {'metrics': metrics, 'caches': caches}
+
+
+def merge(snapshots):
+    """
+    Suma las métricas de varios procesos
+    """
+    merged = {'metrics': {}, 'caches': {}}
+    for snap in snapshots:
+        for name, metric in snap['metrics'].items():
+            target = merged['metrics'].setdefault(name, dict(metric, values={}))
+            for labels, value in metric['values']:
+                key = tuple(labels)
+                current = target['values'].get(key)
+                if current is None:
+                    target['values'][key] = json.loads(json.dumps(value))
+                elif metric['type'] == 'histogram':
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                else:
+                    target['values'][key] = current + value
+        for name, stats in snap['caches'].items():
+            target = merged['caches'].setdefault(name, {'hits': 0, 'misses': 0, 'size': 0})
+            for key in target:
+                target[key] += stats[key]
+
+    for metric in merged['metrics'].values():
+        metric['values'] = [[list(labels), value] for labels, value in metric['values'].items()]
+    return merged
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in pairs)
+
+
+def render(snap):
+    """
+    Retorna las métricas en el formato de texto de Prometheus
+    """
+    lines = []
+    for name, metric in sorted(snap['metrics'].items()):
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        for labels, value in sorted(metric['values']):
+            if metric['type'] == 'histogram':
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(metric['labels'], labels, [('le', bound)]),
+                                                     cumulative))
+                lines.append('%s_sum%s %r' % (name, format_labels(metric['labels'], labels), total))
+                lines.append('%s_count%s %d' % (name, format_labels(metric['labels'], labels), cumulative))
+            else:
+                lines.append('%s%s %r' % (name, format_labels(metric['labels'], labels), value))
+
+    if snap['caches']:
+        for key, kind, help in (('hits', 'counter', 'Aciertos de la caché.'),
+                                ('misses', 'counter', 'Fallos de la caché.'),
+                                ('size', 'gauge', 'Número de entradas de la caché.')):
+            name = 'agent_cache_%s%s' % (key, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for cache, stats in sorted(snap['caches'].items()):
+                lines.append('%s{cache="%s"} %d' % (name, cache, stats[key]))
+        lines.append('# HELP agent_cache_hit_ratio Proporción de aciertos de la caché.')
+        lines.append('# TYPE agent_cache_hit_ratio gauge')
+        for cache, stats in sorted(snap['caches'].items()):
+            total = stats['hits'] + stats['misses']
+            lines.append('agent_cache_hit_ratio{cache="%s"} %r' % (cache, stats['hits'] / total if total else 0.0))
+    return '\n'.join(lines) + '\n'
+
+
+def collect():
+    """
+    Retorna el texto de Prometheus con las métricas del agente (de todos sus workers, si tiene varios)
+    """
+    if _directory is None:
+        return render(snapshot())
+
+    dump()
+    snapshots = []
+    for path in glob.glob(os.path.join(_directory, 'metrics-*.json')):
+        try:
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            # El fichero de un worker que se está escribiendo en este momento
+            pass
+    return render(merge(snapshots))
+
+
+def dump():
+    """
+    Guarda las métricas del proceso en su fichero del directorio compartido
+    """
+    path = os.path.join(_directory, 'metrics-%d.json' % os.getpid())
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def dump_periodically():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        try:
+            dump()
+        except OSError:
+            pass
+
+
+def enable_multiprocess(directory):
+    """
+    Hace que cada proceso creado a partir de ahora con fork (los workers) empiece sus métricas desde cero y las
+    guarde periódicamente en el directorio, para que /metrics pueda sumar las de todos
+    """
+    global _directory
+
+    _directory = directory
+
+
+def reset_after_fork():
+    if _directory is None:
+        return
+    for metric in REGISTRY.values():
+        metric.lock = threading.Lock()
+        metric.values = {}
+    threading.Thread(target=dump_periodically, daemon=True, name='metrics').start()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+
+
+def after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+        HTTP_REQUEST_BYTES.observe(request.content_length or 0, route)
+        if not response.is_streamed:
+            HTTP_RESPONSE_BYTES.observe(response.content_length or 0, route)
+    return response
+
+
+def metrics():
+    """
+    Entrada /metrics
+    """
+    return Response(collect(), content_type=CONTENT_TYPE)
+
+
+def instrument_app(app):
+    """
+    Añade a la aplicación Flask la medida de las peticiones y la entrada /metrics
+    """
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
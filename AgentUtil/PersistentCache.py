@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: PersistentCache
+
+PersistentCache
+***************
+
+:Description: PersistentCache
+
+    Caché en disco (SQLite) con tiempo de vida (TTL) por entrada. Los valores se guardan en JSON, así que sirve para
+    guardar las respuestas de las APIs externas, y se mantienen aunque el agente se pare y se vuelva a poner en marcha.
+    Es segura para usarla desde varios hilos y desde los workers de AgentUtil.Launcher.
+
+    Tiene la misma interfaz que AgentUtil.Cache.TTLCache:
+
+    cache = SQLiteCache('tourpedia.sqlite', ttl=7 * 24 * 3600)
+
+    value = cache.get(key)
+    if value is None:
+        value = calcular(key)
+        cache.put(key, value)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+# Cachés abiertas en el proceso, para volver a abrirlas en los procesos creados con fork
+_caches = weakref.WeakSet()
+
+
+class SQLiteCache:
+    def __init__(self, path, ttl=None):
+        """
+        :param path: fichero de la base de datos, se crea si no existe
+        :param ttl: tiempo de vida (en segundos) de cada entrada, None para que no caduquen
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.open()
+        _caches.add(self)
+
+    def open(self):
+        """
+        Abre la conexión con la base de datos
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self.db.commit()
+
+    def get(self, key, default=None):
+        """
+        Retorna el valor de la clave si está en la caché y no ha caducado. Cuenta como acierto o fallo
+        """
+        with self.lock:
+            row = self.db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > time.time()):
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """
+        Guarda el valor de la clave
+
+        :param ttl: tiempo de vida de esta entrada, por defecto el de la caché
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                            (key, json.dumps(value), expires))
+            self.db.commit()
+
+    def invalidate(self, key):
+        """
+        Elimina la clave de la caché
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.db.commit()
+
+    def purge(self):
+        """
+        Elimina de la base de datos las entradas caducadas
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM cache')
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        """
+        Retorna los contadores de la caché
+        """
+        with self.lock:
+            size = self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            total = self.hits + self.misses
+            return {'size': size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0.0}
+
+
+def reopen_after_fork():
+    """
+    Vuelve a abrir las cachés en cada proceso creado con fork (por ejemplo los workers de AgentUtil.Launcher). Una
+    conexión de SQLite no se puede usar desde dos procesos, así que se abandona la heredada del padre sin cerrarla
+    """
+    for cache in list(_caches):
+        cache.open()
+
+
+os.register_at_fork(after_in_child=reopen_after_fork)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Ranking
+
+Ranking
+*******
+
+:Description: Ranking
+
+    Puntuación y ordenación de las opciones (billetes, hoteles, ...) retornadas por los agentes de información.
+
+    Cada opción se describe con un vector de criterios numéricos (precio, duración, estrellas, distancia, ...). Los
+    criterios se normalizan entre 0 y 1 (min-max) sobre todas las opciones, se invierten los que es mejor minimizar y
+    se combinan con una suma ponderada. Todo el cálculo se hace con operaciones vectoriales de NumPy sobre la matriz
+    opciones x criterios.
+
+    Los criterios se indican como una lista de (predicado, peso, sentido), donde el sentido es 'min' o 'max':
+
+    CRITERIOS = [(agn.Precio, 0.7, 'min'), (agn.Duracion, 0.3, 'min')]
+
+    ordenar las opciones de un grafo con:
+
+    ranked = rank_graph(res_graph, agn.Billete, CRITERIOS, k=5)
+
+    que retorna un grafo con las k mejores opciones, cada una con su posición (agn.Rank, empezando por 1) y su
+    puntuación (agn.Puntuacion).
+"""
+
+import re
+import warnings
+
+import numpy as np
+from rdflib import Graph, Literal, Namespace
+
+agn = Namespace("http://www.agentes.org#")
+
+NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?')
+
+
+def to_float(value):
+    """
+    Retorna el valor numérico de un literal (por ejemplo '123.45€' -> 123.45), o NaN si no tiene ninguno
+    """
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        match = NUMBER.search(str(value))
+        return float(match.group()) if match else np.nan
+
+
+def score(features, weights, senses):
+    """
+    Retorna la puntuación, entre 0 y 1, de cada opción
+
+    :param features: matriz (opciones x criterios) con los valores de cada criterio, NaN si no se conoce
+    :param weights: peso de cada criterio
+    :param senses: 'min' o 'max' para cada criterio, según si es mejor un valor bajo o alto
+    """
+    features = np.asarray(features, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    with warnings.catch_warnings():
+        # nanmin y nanmax avisan cuando ninguna opción tiene el valor de un criterio
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low = np.nanmin(features, axis=0)
+        high = np.nanmax(features, axis=0)
+        spread = high - low
+        normalized = (features - low) / np.where(spread > 0, spread, 1)
+
+    minimize = np.array([sense == 'min' for sense in senses])
+    normalized = np.where(minimize, 1.0 - normalized, normalized)
+    # Los criterios en los que todas las opciones tienen el mismo valor no sirven para distinguirlas, y los valores
+    # desconocidos se puntúan en la mitad del rango
+    normalized = np.where(spread > 0, normalized, 1.0)
+    normalized = np.where(np.isnan(features), 0.5, normalized)
+
+    return normalized @ weights / weights.sum()
+
+
+def rank(features, weights, senses, k=None):
+    """
+    Retorna los índices de las k mejores opciones, de mejor a peor, y la puntuación de todas ellas
+    """
+    scores = score(features, weights, senses)
+    order = np.argsort(-scores, kind='stable')
+    return order[:k], scores
+
+
+def rank_graph(gr, clase, criterios, k=None):
+    """
+    Retorna un grafo con las k mejores opciones de tipo clase (sujetos de agn.esUn clase) del grafo, con todas sus
+    propiedades, su posición (agn.Rank) y su puntuación (agn.Puntuacion). Si no hay ninguna opción el grafo es vacío
+
+    :param criterios: lista de (predicado, peso, sentido)
+    """
+    options = sorted(gr.subjects(predicate=agn.esUn, object=clase))
+    ranked = Graph()
+    if not options:
+        return ranked
+
+    features = [[to_float(gr.value(subject=option, predicate=predicate)) for predicate, _, _ in criterios]
+                for option in options]
+    order, scores = rank(features,
+                         [weight for _, weight, _ in criterios],
+                         [sense for _, _, sense in criterios],
+                         k)
+
+    for position, index in enumerate(order, start=1):
+        option = options[index]
+        for _, predicate, object in gr.triples((option, None, None)):
+            if predicate not in (agn.Rank, agn.Puntuacion):
+                ranked.add((option, predicate, object))
+        ranked.add((option, agn.Rank, Literal(position)))
+        ranked.add((option, agn.Puntuacion, Literal(round(float(scores[index]), 4))))
+    return ranked
+
+
+def best_ranked(gr, clase):
+    """
+    Retorna la opción de tipo clase con mejor posición (agn.Rank más bajo) del grafo. Las opciones sin posición van
+    después de las que la tienen. Retorna None si no hay ninguna
+    """
+    options = sorted(gr.subjects(predicate=agn.esUn, object=clase))
+    if not options:
+        return None
+    positions = np.array([to_float(gr.value(subject=option, predicate=agn.Rank)) for option in options])
+    return options[int(np.argmin(np.where(np.isnan(positions), np.inf, positions)))]
+
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: ScatterGather
+
+ScatterGather
+*************
+
+:Description: ScatterGather
+
+    Motor de scatter-gather para lanzar en paralelo varias peticiones bloqueantes (normalmente envíos de mensajes
+    ACL a otros agentes) dentro del mismo proceso y recoger sus resultados.
+
+    Utiliza un pool de hilos persistente, de manera que no se crea ningún proceso ni hilo nuevo por petición y los
+    resultados (por ejemplo, grafos RDF) se retornan directamente, sin necesidad de serializarlos.
+
+    crear el motor con:
+
+    motor = ScatterGather(max_workers=8)
+
+    lanzar las tareas con:
+
+    resultados = motor.run({'transporte': (pedirSeleccionTransporte, (origen, destino)),
+                            'alojamiento': (pedirSeleccionAlojamiento, (destino,))},
+                           timeout=30, timeouts={'alojamiento': 10})
+
+    Las ramas que no acaban a tiempo o que lanzan una excepción no aparecen en el diccionario de resultados. Con el
+    parámetro quorum se retorna en cuanto han acabado correctamente ese número de ramas. Si hay un tiempo límite en
+    curso (ver AgentUtil.Deadline), ninguna rama se espera más allá del límite.
+"""
+
+import contextvars
+import logging
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from AgentUtil.Deadline import remaining
+
+logger = logging.getLogger('log')
+
+# Motores del proceso, para volver a crear sus pools en los procesos creados con fork
+_engines = weakref.WeakSet()
+
+
+class ScatterGather:
+    def __init__(self, max_workers=None, name='scatter'):
+        """
+        Crea el pool de hilos persistente que ejecutará las ramas
+
+        :param max_workers: número máximo de hilos del pool
+        :param name: prefijo del nombre de los hilos
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        _engines.add(self)
+
+    def run(self, tasks, timeout=None, timeouts=None, quorum=None):
+        """
+        Ejecuta todas las tareas en paralelo y espera sus resultados
+
+        :param tasks: diccionario nombre -> (funcion, argumentos)
+        :param timeout: tiempo máximo (en segundos) por defecto de cada rama, None para esperar indefinidamente
+        :param timeouts: diccionario nombre -> tiempo máximo de esa rama, sobreescribe el valor por defecto. Los dos
+                         se acotan con el tiempo que queda hasta el límite de la petición en curso, si lo hay
+        :param quorum: si se indica, se retorna en cuanto este número de ramas ha acabado correctamente, sin esperar
+                       al resto
+        :return: diccionario nombre -> resultado de las ramas que han acabado correctamente
+        """
+        if timeouts is None:
+            timeouts = {}
+
+        start = time.monotonic()
+        left = remaining()
+        names = {}
+        limits = {}
+        for name, (func, args) in tasks.items():
+            # Cada rama se ejecuta en una copia del contexto actual, para que continúe la traza en curso (ver
+            # AgentUtil.Tracing) y respete su tiempo límite (ver AgentUtil.Deadline)
+            future = self.pool.submit(contextvars.copy_context().run, func, *args)
+            limit = timeouts.get(name, timeout)
+            if left is not None:
+                limit = max(0.0, left) if limit is None else max(0.0, min(limit, left))
+            names[future] = name
+            limits[future] = None if limit is None else start + limit
+
+        results = {}
+        pending = set(names)
+        while pending:
+            # Descartamos las ramas que han superado su tiempo máximo. Siguen ejecutándose en su hilo, pero no
+            # esperamos más su resultado
+            now = time.monotonic()
+            for future in [f for f in pending if not f.done() and limits[f] is not None and limits[f] <= now]:
+                pending.discard(future)
+                future.cancel()
+                logger.error("La rama '%s' no ha acabado en %.2f segundos.", names[future], limits[future] - start)
+            if not pending:
+                break
+
+            # Esperamos a que acabe alguna rama, como mucho hasta el siguiente tiempo máximo
+            deadlines = [limits[f] for f in pending if limits[f] is not None]
+            wait_time = max(0.0, min(deadlines) - now) if deadlines else None
+            done, _ = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                pending.discard(future)
+                try:
+                    results[names[future]] = future.result()
+                except Exception as e:
+                    logger.error("La rama '%s' ha fallado: %s", names[future], e)
+
+            if quorum is not None and len(results) >= quorum:
+                break
+
+        return results
+
+    def shutdown(self, wait=False):
+        """
+        Libera los hilos del pool
+        """
+        self.pool.shutdown(wait=wait)
+
+
+def reset_after_fork():
+    """
+    Crea pools nuevos en cada proceso creado con fork (por ejemplo los workers de AgentUtil.Launcher), ya que los
+    hilos del pool heredado no existen en el proceso hijo
+    """
+    for engine in list(_engines):
+        engine.pool = ThreadPoolExecutor(max_workers=engine.max_workers, thread_name_prefix=engine.name)
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: SingleFlight
+
+SingleFlight
+************
+
+:Description: SingleFlight
+
+    Agrupación de peticiones idénticas concurrentes (single-flight). Cuando llega una petición igual a otra que todavía
+    se está atendiendo, no se vuelve a hacer el trabajo (las peticiones a los gestores o a los agentes de información):
+    se espera a que acabe la primera y se retorna su mismo resultado. Si la primera lanza una excepción, todas las
+    peticiones agrupadas con ella la lanzan también. Las peticiones agrupadas no esperan más allá de su propio tiempo
+    límite (ver AgentUtil.Deadline), aunque la primera siga en curso.
+
+    Solo se agrupan las peticiones que se solapan en el tiempo; en cuanto acaba la primera, la siguiente petición
+    igual vuelve a hacer el trabajo (no es una caché).
+
+    crear el agrupador con:
+
+    single_flight = SingleFlight()
+
+    usarlo con:
+
+    res_graph = single_flight.do(request_key(req_graph, content), resolver.call, DSO.FlightsAgent, infoagent_search,
+                                 req_graph)
+
+    Los resultados se comparten entre los hilos que esperan, así que no se han de modificar.
+"""
+
+import logging
+import threading
+
+from AgentUtil.Deadline import DeadlineExceeded, remaining
+
+logger = logging.getLogger('log')
+
+
+class Call:
+    """
+    Petición en curso y su resultado, que comparten todas las peticiones agrupadas con ella
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name='singleflight'):
+        """
+        :param name: nombre del agrupador en los mensajes del log
+        """
+        self.name = name
+        self.calls = {}
+        self.executions = 0
+        self.shared = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Retorna func(*args, **kwargs). Si ya hay una llamada en curso con la misma clave, espera a que acabe y retorna
+        su resultado en lugar de volver a llamar a func
+
+        :param key: clave (hashable) que identifica las peticiones iguales, None para no agruparla con ninguna
+        :raise DeadlineExceeded: si se supera el tiempo límite esperando a la llamada en curso
+        """
+        if key is None:
+            return func(*args, **kwargs)
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executions += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            logger.info("[%s] Petición agrupada con otra igual en curso.", self.name)
+            left = remaining()
+            if not call.done.wait(None if left is None else max(0.0, left)):
+                raise DeadlineExceeded('Se ha superado el tiempo límite esperando a la petición agrupada')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+            if call.waiters:
+                logger.info("[%s] Resultado compartido con %d peticiones.", self.name, call.waiters)
+
+    def stats(self):
+        """
+        Retorna los contadores del agrupador
+        """
+        with self.lock:
+            total = self.executions + self.shared
+            return {'in_flight': len(self.calls),
+                    'executions': self.executions,
+                    'shared': self.shared,
+                    'shared_ratio': self.shared / total if total else 0.0}
+
+
+def request_key(gr, subject):
+    """
+    Retorna una clave con todas las propiedades del sujeto del grafo (normalmente el contenido de un mensaje de
+    petición) en N3, que es igual para dos peticiones con los mismos parámetros. Retorna None si no hay sujeto
+    """
+    if subject is None:
+        return None
+    return tuple(sorted((p.n3(), o.n3()) for _, p, o in gr.triples((subject, None, None))))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: Tracing
+
+Tracing
+*******
+
+:Description: Tracing
+
+    Trazas distribuidas de las peticiones que recorren la cadena de agentes (unificador -> gestores -> directorio ->
+    agentes de información -> APIs externas).
+
+    Cada tramo de trabajo es un span, con su identificador, el del span que lo ha originado y el identificador de la
+    traza a la que pertenece (el mismo para todos los spans de una petición de plan). El span actual se guarda en una
+    variable de contexto (contextvars), así que cada hilo (y cada rama de AgentUtil.ScatterGather) tiene el suyo.
+
+    Entre agentes, el contexto viaja en el sobre de los mensajes ACL: conversation-id lleva el identificador de la
+    traza e in-reply-to el del span que ha enviado el mensaje (ver AgentUtil.ACLMessages y AgentUtil.FlaskServer).
+
+    Los spans acabados se escriben, si se ha activado con enable_tracing, en un fichero JSONL (un span por línea) que
+    comparten todos los workers del agente, y también varios agentes, para analizarlo después con load_spans.
+
+    activar las trazas con:
+
+    enable_tracing('trazas.jsonl', 'GestorTransporte')
+
+    medir un tramo con:
+
+    with span('directory-lookup', agent_type=str(agent_type)) as s:
+        ...
+        s.set('cached', True)
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Fichero donde se escriben los spans (None si las trazas no están activadas) y nombre del agente que los genera
+TRACE_FILE = None
+SERVICE = None
+
+_fd = None
+_current = ContextVar('span', default=None)
+
+
+class Span:
+    """
+    Tramo de trabajo de una traza. La duración se mide con un reloj monótono
+    """
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'duration', 'attrs', 'error', '_t0')
+
+    def __init__(self, name, trace_id=None, parent_id=None, started=None, **attrs):
+        """
+        :param trace_id: identificador de la traza, si no se indica empieza una traza nueva
+        :param parent_id: identificador del span que ha originado este
+        :param started: instante de inicio (de time.perf_counter), si el span ha empezado antes de crearlo
+        """
+        now = time.perf_counter()
+        self._t0 = started if started is not None else now
+        self.trace_id = str(trace_id) if trace_id is not None else uuid.uuid4().hex
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = str(parent_id) if parent_id is not None else None
+        self.name = name
+        self.start = time.time() - (now - self._t0)
+        self.duration = None
+        self.attrs = attrs
+        self.error = None
+
+    def child(self, name, started=None, **attrs):
+        """
+        Retorna un span nuevo de la misma traza, originado por este
+        """
+        return Span(name, self.trace_id, self.span_id, started, **attrs)
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def finish(self, duration=None):
+        """
+        Acaba el span y lo exporta
+
+        :param duration: duración (en segundos), por defecto el tiempo transcurrido desde que se creó
+        """
+        self.duration = duration if duration is not None else time.perf_counter() - self._t0
+        export(self)
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'service': SERVICE,
+                'pid': os.getpid(),
+                'thread': threading.current_thread().name,
+                'start': self.start,
+                'duration_ms': round(self.duration * 1000, 3),
+                'attrs': self.attrs,
+                'error': self.error}
+
+
+def enable_tracing(path, service):
+    """
+    Activa la exportación de los spans al fichero JSONL indicado
+
+    :param service: nombre del agente, que se guarda en cada span
+    """
+    global TRACE_FILE, SERVICE, _fd
+
+    TRACE_FILE = path
+    SERVICE = service
+    # Con O_APPEND cada línea se escribe de una sola vez al final del fichero, aunque escriban varios procesos
+    _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def export(span):
+    """
+    Escribe el span en el fichero de trazas, si están activadas
+    """
+    if _fd is None:
+        return
+    line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n'
+    os.write(_fd, line.encode('utf-8'))
+
+
+def current_span():
+    """
+    Retorna el span actual del contexto, o None si no hay ninguno
+    """
+    return _current.get()
+
+
+def activate(span):
+    """
+    Hace que el span sea el actual del contexto. Retorna el token con el que se restaura el anterior (ver deactivate)
+    """
+    return _current.set(span)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Mide el bloque como un span hijo del span actual (o como el inicio de una traza nueva, si no hay ninguno), que es
+    el span actual mientras dura el bloque. Si el bloque lanza una excepción se anota en el span
+    """
+    parent = _current.get()
+    current = parent.child(name, **attrs) if parent is not None else Span(name, **attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as error:
+        current.error = type(error).__name__
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+def load_spans(path):
+    """
+    Retorna los spans guardados en un fichero de trazas, agrupados por traza y ordenados por su inicio
+
+    :return: diccionario trace_id -> lista de spans (diccionarios)
+    """
+    traces = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                traces.setdefault(record['trace_id'], []).append(record)
+    for spans in traces.values():
+        spans.sort(key=lambda record: record['start'])
+    return traces
@@ -7,9 +7,8 @@ Posteriormente, junta todas las partes del plan y se lo envia al usuario.
 import argparse
 import datetime
 import logging
-import multiprocessing
 import socket
-from multiprocessing import Process
+from itertools import islice
 
 from flask import Flask, request, render_template
 from rdflib import Graph, Namespace, Literal
@@ -19,18 +18,28 @@ from AgentUtil.ACLMessages import build_message, send_message, get_message_prope
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_UNIFICADOR, PUERTO_GESTOR_ALOJAMIENTO, \
     PUERTO_GESTOR_ACTIVIDADES, PUERTO_GESTOR_TRANSPORTE
+from AgentUtil.Deadline import EXCEEDED, MARGIN, deadline, remaining
 from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Ranking import best_ranked
+from AgentUtil.ScatterGather import ScatterGather
+from AgentUtil.SingleFlight import SingleFlight
+from AgentUtil.Tracing import enable_tracing, span
 from AgentUtil.Util import gethostname
-from Agents.GestorAlojamiento import GestorAlojamiento
 
 # Definimos los parámetros de la linea de comandos
 parser = argparse.ArgumentParser()
 parser.add_argument("--open", help="Define si el servidor está abierto al exterior o no.", action="store_true",
                     default=False)
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
+parser.add_argument("--timeout", type=float,
+                    help="Tiempo máximo (en segundos) de cada petición de plan, que se propaga a los gestores.")
 
 # Logging
 logger = config_logger(level=1)
@@ -50,6 +59,24 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'AgenteUnificador')
+
+if args.timeout is None:
+    timeout_gestores = 60
+else:
+    timeout_gestores = args.timeout
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
@@ -86,8 +113,19 @@ augraph = Graph()
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes. Las peticiones a los gestores se hacen desde hilos y workers diferentes, así que lo guardamos
+# en memoria compartida
+mss_cnt = SharedCounter()
+
+# Motor de scatter-gather (pool de hilos persistente) para hacer las peticiones a los gestores en paralelo
+scatter_gather = ScatterGather(max_workers=12, name='unificador')
+
+# Agrupa los planes con los mismos datos del formulario que se piden a la vez, para hacer una sola ronda de peticiones
+# a los gestores
+single_flight = SingleFlight(name='unificador')
+
+# Partes del plan, cada una la selecciona un gestor
+PARTES = ("transporte", "alojamiento", "actividades")
 
 
 # ENTRY POINTS
@@ -128,100 +166,77 @@ def peticionPlan():
     displayData = None
 
     try:
-        # Ejecuta la selección de transporte, alojamiento y actividades en tres procesos diferentes para obtener
-        # paralelismo. Los tres procesos comparten un objeto llamado 'return_dic'.
-        manager = multiprocessing.Manager()
-        return_dic = manager.dict()
-        p1 = Process(target=pedirSeleccionAlojamiento, args=(
-            ciudadDestino, fechaIda, fechaVuelta, presupuestoAloj, estrellas, nhabitaciones, npersonas, dcentro,
-            return_dic))
-        p2 = Process(target=pedirSeleccionActividades, args=(ciudadDestino, dias_de_viaje, dcentro, return_dic))
-        p3 = Process(target=pedirSeleccionTransporte,
-                     args=(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta, presupuestoVuelo, return_dic))
-
-        # Ejecuta los procesos
-        p1.start()
-        p2.start()
-        p3.start()
-
-        # Espera hasta que los procesos hijo acaben
-        p1.join()
-        p2.join()
-        p3.join()
-
-        # Extraemos por separado, del objeto compartido por los procesos 'return_dic', los grafos con los resultados de
-        # la selección de transporte, alojamiento y actividades.
-        graph_trans = return_dic["transporte"]
-        graph_aloj = return_dic["alojamiento"]
-        graph_act = return_dic["actividades"]
-
-        # Obtenemos la performativa de los mensajes en los tres casos
-        msgdic_trans = get_message_properties(graph_trans)
-        msgdic_aloj = get_message_properties(graph_aloj)
-        msgdic_act = get_message_properties(graph_act)
-
-        perf_trans = msgdic_trans["performative"]
-        perf_aloj = msgdic_aloj["performative"]
-        perf_act = msgdic_act["performative"]
-
-        if perf_trans == ACL.failure or perf_aloj == ACL.failure or perf_act == ACL.failure:
-            displayData = {
-                "error": 1,
-                "errorMessage": "Parámetros de entrada no válidos."
-            }
-        elif perf_trans == ACL.cancel or perf_aloj == ACL.cancel or perf_act == ACL.cancel:
-            displayData = {
-                "error": 1,
-                "errorMessage": "No se ha encontrado ningún agente de información."
-            }
+        # Ejecuta la selección de transporte, alojamiento y actividades en paralelo, en el pool de hilos del agente.
+        # Cada rama tiene su propio tiempo máximo de espera, de forma que un gestor lento no bloquea todo el plan.
+        # Si ya se está preparando un plan con los mismos datos del formulario, esperamos sus resultados.
+        # Cada petición de plan empieza una traza, que continúan los gestores y los agentes de información, y tiene un
+        # tiempo límite, que viaja en los mensajes (reply-by) y acota todas las peticiones que se hacen para atenderla.
+        with span('peticionPlan', ciudadOrigen=ciudadOrigen, ciudadDestino=ciudadDestino), \
+                deadline(timeout_gestores):
+            results = single_flight.do(tuple(sorted(request.form.items())), scatter_gather.run, {
+                "alojamiento": (pedirSeleccionAlojamiento, (ciudadDestino, fechaIda, fechaVuelta, presupuestoAloj,
+                                                            estrellas, nhabitaciones, npersonas, dcentro)),
+                "actividades": (pedirSeleccionActividades, (ciudadDestino, dias_de_viaje, dcentro)),
+                "transporte": (pedirSeleccionTransporte, (ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta,
+                                                          presupuestoVuelo))
+            }, timeout=timeout_gestores)
+
+            # Los gestores responden como muy tarde MARGIN segundos antes del límite (ver AgentUtil.Deadline), así
+            # que si no queda más tiempo, las ramas que faltan no han acabado a tiempo
+            timed_out = remaining() <= MARGIN
+
+        # Comprobamos que todos los gestores hayan respondido a tiempo. Los que no han acabado a tiempo responden con
+        # un 'failure' con contenido EXCEEDED, con los resultados parciales que tuvieran
+        missing = [name for name in PARTES if name not in results]
+        exceeded = [name for name in PARTES
+                    if name in results and get_message_properties(results[name]).get("content") == EXCEEDED]
+        if exceeded or (missing and timed_out):
+            # Mostramos las partes del plan de las que hay resultados, aunque sean parciales, y avisamos de las que
+            # faltan. Solo es un error si no hay ninguna
+            aviso = "Se ha superado el tiempo máximo del plan (%g s): no se ha completado la selección de %s." \
+                    % (timeout_gestores, ", ".join(sorted(missing + exceeded, key=PARTES.index)))
+            partes = {"transporte": datos_transporte(results["transporte"]) if "transporte" in results else None,
+                      "alojamiento": datos_alojamiento(results["alojamiento"]) if "alojamiento" in results else None,
+                      "actividades": datos_actividades(results["actividades"], dias_de_viaje)
+                      if "actividades" in results else None}
+            if not any(partes.values()):
+                raise Exception(aviso)
+            logger.info(aviso)
+            displayData = plan(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta, partes, aviso)
+        elif missing:
+            raise Exception("No se ha obtenido respuesta de selección de: " + ", ".join(missing) + ".")
         else:
-            gsearch = graph_trans.triples((None, agn.esUn, agn.Billete))
-            billete = next(gsearch)[0]
-            id_billete = graph_trans.value(subject=billete, predicate=agn.Id)
-            hora_salida_billete = graph_trans.value(subject=billete, predicate=agn.DiaHoraSalida)
-            hora_llegada_billete = graph_trans.value(subject=billete, predicate=agn.DiaHoraLlegada)
-            asiento_billete = graph_trans.value(subject=billete, predicate=agn.Asiento)
-            clase_billete = graph_trans.value(subject=billete, predicate=agn.Clase)
-            precio_billete = graph_trans.value(subject=billete, predicate=agn.Precio)
-
-            gsearch = graph_aloj.triples((None, agn.esUn, agn.Hotel))
-            alojamiento = next(gsearch)[0]
-            nombre_aloj = graph_aloj.value(subject=alojamiento, predicate=agn.Nombre)
-            direccion_aloj = graph_aloj.value(subject=alojamiento, predicate=agn.Direccion)
-            precio_aloj = graph_aloj.value(subject=alojamiento, predicate=agn.Precio)
-
-            gsearch = graph_act.triples((None, agn.esUn, agn.activity))
-            actividades_manana = []
-            actividades_tarde = []
-            actividades_noche = []
-            for i in range(dias_de_viaje * 3):
-                actividad = next(gsearch)[0]
-                if graph_act.value(subject=actividad, predicate=agn.horario) == Literal('mañana'):
-                    actividades_manana.append(str(graph_act.value(subject=actividad, predicate=agn.nombre)))
-                elif graph_act.value(subject=actividad, predicate=agn.horario) == Literal('tarde'):
-                    actividades_tarde.append(str(graph_act.value(subject=actividad, predicate=agn.nombre)))
-                elif graph_act.value(subject=actividad, predicate=agn.horario) == Literal('noche'):
-                    actividades_noche.append(str(graph_act.value(subject=actividad, predicate=agn.nombre)))
-
-            displayData = {
-                "error": 0,
-                "ciudadOrigen": ciudadOrigen,
-                "ciudadDestino": ciudadDestino,
-                "fechaIda": fechaIda,
-                "fechaVuelta": fechaVuelta,
-                "idBillete": id_billete,
-                "horaSalidaBillete": hora_salida_billete,
-                "horaLlegadaBillete": hora_llegada_billete,
-                "asientoBillete": asiento_billete,
-                "claseBillete": clase_billete,
-                "precioBillete": precio_billete,
-                "nombreAloj": nombre_aloj,
-                "direccionAloj": direccion_aloj,
-                "precioAloj": precio_aloj,
-                'actividadesManana': actividades_manana,
-                'actividadesTarde': actividades_tarde,
-                'actividadesNoche': actividades_noche
-            }
+            # Extraemos por separado los grafos con los resultados de la selección de transporte, alojamiento y
+            # actividades.
+            graph_trans = results["transporte"]
+            graph_aloj = results["alojamiento"]
+            graph_act = results["actividades"]
+
+            # Obtenemos la performativa de los mensajes en los tres casos
+            msgdic_trans = get_message_properties(graph_trans)
+            msgdic_aloj = get_message_properties(graph_aloj)
+            msgdic_act = get_message_properties(graph_act)
+
+            perf_trans = msgdic_trans["performative"]
+            perf_aloj = msgdic_aloj["performative"]
+            perf_act = msgdic_act["performative"]
+
+            if perf_trans == ACL.failure or perf_aloj == ACL.failure or perf_act == ACL.failure:
+                displayData = {
+                    "error": 1,
+                    "errorMessage": "Parámetros de entrada no válidos."
+                }
+            elif perf_trans == ACL.cancel or perf_aloj == ACL.cancel or perf_act == ACL.cancel:
+                displayData = {
+                    "error": 1,
+                    "errorMessage": "No se ha encontrado ningún agente de información."
+                }
+            else:
+                # Los gestores retornan las opciones ordenadas de mejor a peor, escogemos la primera
+                displayData = plan(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta,
+                                   {"transporte": datos_transporte(graph_trans),
+                                    "alojamiento": datos_alojamiento(graph_aloj),
+                                    "actividades": datos_actividades(graph_act, dias_de_viaje)})
     except Exception as e:
         logger.error(str(e))
         displayData = {
@@ -232,6 +247,76 @@ def peticionPlan():
         return render_template("processingPlan.html", displayData=displayData)
 
 
+def plan(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta, partes, aviso=None):
+    """
+    Retorna los datos de la página del plan de viaje. Las partes (transporte, alojamiento y actividades) que son None
+    se muestran como no disponibles, con el aviso indicado
+    """
+    displayData = {
+        "error": 0,
+        "aviso": aviso,
+        "ciudadOrigen": ciudadOrigen,
+        "ciudadDestino": ciudadDestino,
+        "fechaIda": fechaIda,
+        "fechaVuelta": fechaVuelta,
+    }
+    for parte, datos in partes.items():
+        displayData[parte] = datos is not None
+        displayData.update(datos or {})
+    return displayData
+
+
+def datos_transporte(graph_trans):
+    """
+    Retorna los datos del mejor billete de la respuesta del gestor de transporte, o None si no hay ninguno
+    """
+    billete = best_ranked(graph_trans, agn.Billete)
+    if billete is None:
+        return None
+    return {
+        "idBillete": graph_trans.value(subject=billete, predicate=agn.Id),
+        "horaSalidaBillete": graph_trans.value(subject=billete, predicate=agn.DiaHoraSalida),
+        "horaLlegadaBillete": graph_trans.value(subject=billete, predicate=agn.DiaHoraLlegada),
+        "asientoBillete": graph_trans.value(subject=billete, predicate=agn.Asiento),
+        "claseBillete": graph_trans.value(subject=billete, predicate=agn.Clase),
+        "precioBillete": graph_trans.value(subject=billete, predicate=agn.Precio)
+    }
+
+
+def datos_alojamiento(graph_aloj):
+    """
+    Retorna los datos del mejor hotel de la respuesta del gestor de alojamiento, o None si no hay ninguno
+    """
+    alojamiento = best_ranked(graph_aloj, agn.Hotel)
+    if alojamiento is None:
+        return None
+    return {
+        "nombreAloj": graph_aloj.value(subject=alojamiento, predicate=agn.Nombre),
+        "direccionAloj": graph_aloj.value(subject=alojamiento, predicate=agn.Direccion),
+        "precioAloj": graph_aloj.value(subject=alojamiento, predicate=agn.Precio)
+    }
+
+
+def datos_actividades(graph_act, dias_de_viaje):
+    """
+    Retorna las actividades (tres por día de viaje) de la respuesta del gestor de actividades, separadas por horario,
+    o None si no hay ninguna
+    """
+    actividades = list(islice(graph_act.subjects(predicate=agn.esUn, object=agn.activity), dias_de_viaje * 3))
+    if not actividades:
+        return None
+    horarios = {'mañana': [], 'tarde': [], 'noche': []}
+    for actividad in actividades:
+        horario = str(graph_act.value(subject=actividad, predicate=agn.horario))
+        if horario in horarios:
+            horarios[horario].append(str(graph_act.value(subject=actividad, predicate=agn.nombre)))
+    return {
+        'actividadesManana': horarios['mañana'],
+        'actividadesTarde': horarios['tarde'],
+        'actividadesNoche': horarios['noche']
+    }
+
+
 @app.route("/comm")
 def comunication():
     """
@@ -245,7 +330,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando servidor."
 
@@ -254,15 +338,20 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    scatter_gather.shutdown()
 
 
-def pedirSeleccionTransporte(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta, presupuestoVuelo, return_dic):
+def next_msgcnt():
     """
-    Retorna un grafo con la opción de transporte seleccionada según los criterios de búsqueda.
+    Retorna el número del siguiente mensaje e incrementa el contador. Es seguro llamarla desde varios hilos.
     """
-    global mss_cnt
+    return mss_cnt.next()
+
 
+def pedirSeleccionTransporte(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta, presupuestoVuelo):
+    """
+    Retorna un grafo con las mejores opciones de transporte según los criterios de búsqueda, ordenadas (agn.Rank).
+    """
     logger.info("Pide selección de transporte.")
 
     msg_graph = Graph()
@@ -283,23 +372,18 @@ def pedirSeleccionTransporte(ciudadOrigen, ciudadDestino, fechaIda, fechaVuelta,
                                            sender=AgenteUnificador.uri,
                                            receiver=GestorTransporte.uri,
                                            content=selection_req,
-                                           msgcnt=mss_cnt), GestorTransporte.address)
-
-    mss_cnt += 1
-
-    return_dic["transporte"] = res_graph
+                                           msgcnt=next_msgcnt()), GestorTransporte.address)
 
     logger.info("Recibe la selección de transporte.")
 
+    return res_graph
+
 
 def pedirSeleccionAlojamiento(ciudadDestino, fechaIda, fechaVuelta, presupuestoAloj, estrellas, nhabitaciones,
-                              npersonas, dcentro,
-                              return_dic):
+                              npersonas, dcentro):
     """
-    Retorna un grafo con la opción de alojamiento seleccionada según los criterios de búsqueda.
+    Retorna un grafo con las mejores opciones de alojamiento según los criterios de búsqueda, ordenadas (agn.Rank).
     """
-    global mss_cnt
-
     logger.info("Pide selección de alojamiento.")
 
     msg_graph = Graph()
@@ -323,22 +407,19 @@ def pedirSeleccionAlojamiento(ciudadDestino, fechaIda, fechaVuelta, presupuestoA
                         sender=AgenteUnificador.uri,
                         receiver=GestorAlojamiento.uri,
                         content=selection_req,
-                        msgcnt=mss_cnt)
+                        msgcnt=next_msgcnt())
 
     res_graph = send_message(msg, GestorAlojamiento.address)
 
-    mss_cnt += 1
-
     logger.info("Recibe la selección de alojamiento.")
 
-    return_dic["alojamiento"] = res_graph
+    return res_graph
 
 
-def pedirSeleccionActividades(ciudadDestino, diasDeViaje, radius, return_dic):
+def pedirSeleccionActividades(ciudadDestino, diasDeViaje, radius):
     """
     Retorna un grafo con el conjunto de actividades seleccionadas según los criterios de búsqueda.
     """
-    global mss_cnt
     logger.info("Pide selección de actividades.")
 
     msg_graph = Graph()
@@ -356,18 +437,16 @@ def pedirSeleccionActividades(ciudadDestino, diasDeViaje, radius, return_dic):
                         sender=AgenteUnificador.uri,
                         receiver=GestorActividades.uri,
                         content=selection_req,
-                        msgcnt=mss_cnt)
+                        msgcnt=next_msgcnt())
 
     res_graph = send_message(msg, GestorActividades.address)
 
-    mss_cnt += 1
-
     logger.info("Recibe la selección de actividades.")
 
-    return_dic['actividades'] = res_graph
+    return res_graph
 
 
 if __name__ == "__main__":
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info("The end.")
@@ -3,7 +3,8 @@
 Agente que lleva el registro de otros agentes.
 
 Utiliza un registro simple, que guarda en un grafo de estado RDF. El registro no es persistente y se mantiene
-mientras el agente está ejecutándose.
+mientras el agente está ejecutándose. Junto al grafo se mantienen unos índices en memoria, por URI y por tipo de
+agente, que son los que se usan para responder las búsquedas.
 
 Las acciones que se pueden utilizar están definidas en la ontología directory-service-ontology.owl.
 """
@@ -11,9 +12,10 @@ Las acciones que se pueden utilizar están definidas en la ontología directory-
 import argparse
 import logging
 import socket
+import threading
 
-from flask import Flask, request, render_template
-from rdflib import Graph, RDF, Namespace, RDFS
+from flask import Flask, render_template
+from rdflib import Graph, RDF, Namespace, RDFS, Literal
 from rdflib.namespace import FOAF
 
 from AgentUtil.ACL import ACL
@@ -21,8 +23,10 @@ from AgentUtil.ACLMessages import build_message, get_message_properties
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_DIRECTORIO
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -30,6 +34,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--open", help="Define si el servidor está abierto al exterior o no.", action="store_true",
                     default=False)
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
+# El directorio no tiene la opción --workers: el registro de agentes se guarda en la memoria del proceso, así que
+# solo puede haber uno
+parser.add_argument("--threads", type=int, help="Número de hilos del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -51,6 +59,14 @@ if args.port is None:
 else:
     port = args.port
 
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'DirectoryAgent')
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
@@ -73,15 +89,25 @@ dsgraph.bind("rdfs", RDFS)
 dsgraph.bind("foaf", FOAF)
 dsgraph.bind("dso", DSO)
 
+# Índices del registro: URI del agente -> datos del agente, y tipo de agente -> URIs de los agentes de ese tipo
+# (por orden de registro). Se actualizan a la vez que el grafo, protegidos por un lock.
+agents_by_uri = {}
+agents_by_type = {}
+
+# Número de veces que cada agente se ha dado como primera opción en una búsqueda. Se usa para repartir las búsquedas
+# entre los agentes del mismo tipo y se envía a los clientes como indicación de la carga de cada agente.
+agents_assigned = {}
+dslock = threading.Lock()
+
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
 
 
 # ENTRY POINTS
-@app.route("/Register")
+@app.route("/Register", methods=['GET', 'POST'])
 def register():
     """
     Entry point del agente que recibe los mensajes de registro y búsqueda.
@@ -101,61 +127,82 @@ def register():
         agn_type = msg_graph.value(subject=content, predicate=DSO.AgentType)
 
         # Añadimos la información en el grafo de registro vinculándola a la URI del agente y registrándola
-        # como tipo FOAF.Agent
-        dsgraph.add((agn_uri, RDF.type, FOAF.Agent))
-        dsgraph.add((agn_uri, FOAF.name, agn_name))
-        dsgraph.add((agn_uri, DSO.Address, agn_add))
-        dsgraph.add((agn_uri, DSO.AgentType, agn_type))
+        # como tipo FOAF.Agent. Si el agente ya estaba registrado se sustituyen sus datos.
+        with dslock:
+            dsgraph.add((agn_uri, RDF.type, FOAF.Agent))
+            dsgraph.set((agn_uri, FOAF.name, agn_name))
+            dsgraph.set((agn_uri, DSO.Address, agn_add))
+            dsgraph.set((agn_uri, DSO.AgentType, agn_type))
+
+            # Actualizamos los índices
+            old = agents_by_uri.get(agn_uri)
+            if old is not None and agn_uri in agents_by_type.get(old['type'], []):
+                agents_by_type[old['type']].remove(agn_uri)
+            agents_by_uri[agn_uri] = {'name': agn_name, 'address': agn_add, 'type': agn_type}
+            agents_by_type.setdefault(agn_type, []).append(agn_uri)
 
         # Retornamos un mensaje de confirmación
         return build_message(Graph(),
                              ACL.confirm,
                              sender=DirectoryAgent.uri,
                              receiver=agn_uri,
-                             msgcnt=mss_cnt)
+                             msgcnt=msgcnt)
 
     def process_search():
-        # Solo consideramos la búsqueda por tipo de agente. Buscamos una coincidencia exacta y retornamos
-        # la primera de las posibilidades, si hubiera más de una.
+        # Solo consideramos la búsqueda por tipo de agente. Buscamos una coincidencia exacta en el índice por tipo y
+        # retornamos todos los agentes de ese tipo, con el número de veces que se ha asignado cada uno. Los datos del
+        # menos asignado se ponen también directamente en el objeto de respuesta, para los agentes que solo
+        # necesitan uno.
         logger.info("Petición de búsqueda recibida.")
 
         # Extraemos del campo 'content' el tipo de agente buscado
         agn_type = msg_graph.value(subject=content, predicate=DSO.AgentType)
 
-        # Hacemos la búsqueda del agente con el tipo especificado en el grafo de estado del Directory Service
-        search = dsgraph.triples((None, DSO.AgentType, agn_type))
-
-        if search is not None:
-            agn_uri = next(search)[0]
-            agn_add = dsgraph.value(subject=agn_uri, predicate=DSO.Address)
+        # Hacemos la búsqueda del agente con el tipo especificado en el índice del Directory Service
+        with dslock:
+            candidates = [(uri, agents_by_uri[uri], agents_assigned.get(uri, 0))
+                          for uri in agents_by_type.get(agn_type, [])]
+            candidates.sort(key=lambda cand: cand[2])
+            if candidates:
+                agents_assigned[candidates[0][0]] = candidates[0][2] + 1
 
+        if candidates:
             res_graph = Graph()
             res_graph.bind("dso", DSO)
             res_obj = agn["Directory-Response"]
-            res_graph.add((res_obj, DSO.Address, agn_add))
+
+            agn_uri, agn_data, _ = candidates[0]
+            res_graph.add((res_obj, DSO.Address, agn_data['address']))
             res_graph.add((res_obj, DSO.Uri, agn_uri))
 
-            # Retornamos un mensaje de respuesta, de tipo 'inform', con el objeto encontrado
+            # Añadimos todos los candidatos
+            for i, (cand_uri, cand_data, cand_assigned) in enumerate(candidates):
+                cand_obj = agn["Directory-Response-" + str(i)]
+                res_graph.add((res_obj, agn.candidato, cand_obj))
+                res_graph.add((cand_obj, DSO.Uri, cand_uri))
+                res_graph.add((cand_obj, DSO.Address, cand_data['address']))
+                res_graph.add((cand_obj, FOAF.name, cand_data['name']))
+                res_graph.add((cand_obj, agn.asignaciones, Literal(cand_assigned)))
+
+            # Retornamos un mensaje de respuesta, de tipo 'inform', con los objetos encontrados
             return build_message(res_graph,
                                  ACL.inform,
                                  sender=DirectoryAgent.uri,
                                  receiver=agn_uri,
                                  content=res_obj,
-                                 msgcnt=mss_cnt)
+                                 msgcnt=msgcnt)
         else:
             # Si no encontramos nada retornamos un mensaje de respuesta, de tipo 'inform', sin contenido
             return build_message(Graph(),
                                  ACL.inform,
                                  sender=DirectoryAgent.uri,
-                                 msgcnt=mss_cnt)
+                                 msgcnt=msgcnt)
 
     global dsgraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    msg_graph = Graph()
-    msg_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    msg_graph = get_message()
 
     msgdic = get_message_properties(msg_graph)
 
@@ -165,13 +212,13 @@ def register():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=DirectoryAgent.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif msgdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=DirectoryAgent.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
         # Extraemos el objeto del campo 'content', que ha de ser una acción de la ontología de registro
         content = msgdic["content"]
@@ -189,10 +236,9 @@ def register():
             res_graph = build_message(Graph(),
                                       ACL["not-understood"],
                                       sender=DirectoryAgent.uri,
-                                      msgcnt=mss_cnt)
+                                      msgcnt=msgcnt)
 
-    mss_cnt += 1
-    return res_graph.serialize(format="xml")
+    return message_response(res_graph)
 
 
 @app.route("/Info")
@@ -201,10 +247,11 @@ def info():
     Entrada que da información del estado del servicio de directorio. Retorna una página web (código HTML)
     que podemos visualizar en el navegador.
     """
-    global dsgraph
-    global mss_cnt
+    # La página se construye a partir de los índices, sin serializar el grafo de registro
+    with dslock:
+        agents = [(uri, data['name'], data['type'], data['address']) for uri, data in agents_by_uri.items()]
 
-    return render_template("info.html", nmess=mss_cnt, graph=dsgraph.serialize(format="turtle"))
+    return render_template("info.html", nmess=mss_cnt.value, agents=agents)
 
 
 @app.route("/Stop")
@@ -212,7 +259,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando servidor."
 
@@ -225,6 +271,6 @@ def tidyup():
 
 
 if __name__ == "__main__":
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, threads=threads, on_shutdown=tidyup)
     logger.info("The end.")
@@ -9,7 +9,7 @@ import logging
 import socket
 from multiprocessing import Queue
 
-from flask import Flask, request
+from flask import Flask
 from rdflib import Graph, RDF, Namespace, RDFS, Literal
 from rdflib.namespace import FOAF
 
@@ -18,19 +18,34 @@ from AgentUtil.ACLMessages import build_message, send_message, get_message_prope
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_GESTOR_ACTIVIDADES, PUERTO_DIRECTORIO
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, DeadlineExceeded
+from AgentUtil.DirectoryResolver import DirectoryResolver, AgentNotFound
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.GraphBuilder import copy_graph
+from AgentUtil.Launcher import run_agent, SharedCounter
+from AgentUtil.LoadBalancer import LoadBalancer, STRATEGIES
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.SingleFlight import SingleFlight, request_key
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parametros de la linea de comandos
 parser = argparse.ArgumentParser()
 parser.add_argument('--open', help="Define si el servidor est abierto al exterior o no", action='store_true',
                     default=False)
+parser.add_argument('--workers', type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument('--threads', type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument('--trace', help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument('--verbose', help="Genera un log de la comunicacion del servidor web", action='store_true',
                     default=False)
 parser.add_argument('--port', type=int, help="Puerto de comunicacion del agente")
 parser.add_argument('--dhost', help="Host del agente de directorio")
 parser.add_argument('--dport', type=int, help="Puerto de comunicacion del agente de directorio")
+parser.add_argument("--dttl", type=float,
+                    help="Tiempo (en segundos) que se guardan las respuestas del agente de directorio.")
+parser.add_argument("--balanceo", choices=STRATEGIES, default="round-robin",
+                    help="Estrategia de reparto de las peticiones entre los agentes de información.")
 
 # Logging
 logger = config_logger(level=1)
@@ -44,6 +59,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'GestorActividades')
+
 if args.open:
     hostname = '0.0.0.0'
     hostaddr = gethostname()
@@ -55,6 +83,11 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.dttl is None:
+    dttl = 60
+else:
+    dttl = args.dttl
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -68,8 +101,8 @@ if not args.verbose:
 
 agn = Namespace("http://www.agentes.org#")
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
 
 GestorActividades = Agent('GestorActividades',
                           agn.GestorActividades,
@@ -94,6 +127,9 @@ gagraph.bind('dso', DSO)
 
 cola1 = Queue()
 
+# Agrupa las peticiones iguales que llegan a la vez, para hacer una sola petición al agente de información
+single_flight = SingleFlight(name='actividades')
+
 # Flask stuff
 app = Flask(__name__)
 if not args.verbose:
@@ -102,7 +138,7 @@ if not args.verbose:
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entry point de comunicación con el agente.
@@ -110,14 +146,12 @@ def comunicacion():
     Retorna un objeto que representa una selección de actividades de entre un conjunto de opciones posibles.
     """
     global gagraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info('Recibe petición de selección de actividades.')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    req_graph = Graph()
-    req_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    req_graph = get_message()
 
     reqdic = get_message_properties(req_graph)
 
@@ -127,36 +161,50 @@ def comunicacion():
         res_graph = build_message(Graph(),
                                   ACL['not-understood'],
                                   sender=GestorActividades.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif reqdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=GestorActividades.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        # Busca en el directorio un agente de vuelos
-        res_graph = directory_search(DSO.TravelServiceAgent)
-
-        # Obtiene la dirección del agente en la respuesta
-        msg = res_graph.value(predicate=RDF.type, object=ACL.FipaAclMessage)
-        content = res_graph.value(subject=msg, predicate=ACL.content)
-        agn_addr = res_graph.value(subject=content, predicate=DSO.Address)
-        agn_uri = res_graph.value(subject=content, predicate=DSO.Uri)
-
-        # Envía una mensaje de tipo ACL.request al agente de información de vuelos
-        res_graph = infoagent_search(agn_addr, agn_uri, req_graph)
-
-        res_graph = build_message(res_graph,
-                                  ACL["confirm"],
-                                  sender=GestorActividades.uri,
-                                  msgcnt=mss_cnt)
-
-    mss_cnt += 1
+        reason = None
+        try:
+            # Busca en el directorio (o en la caché de respuestas del directorio) un agente de información y le
+            # envía un mensaje de tipo ACL.request. Si ya hay en curso una petición con los mismos parámetros,
+            # espera su respuesta en lugar de hacer otra
+            res_graph, partial = single_flight.do(request_key(req_graph, reqdic.get("content")),
+                                                  resolver.call, DSO.TravelServiceAgent, infoagent_search, req_graph)
+            # El agente de información no ha acabado a tiempo, respondemos con las actividades que hay
+            if partial:
+                reason = EXCEEDED
+        except AgentNotFound:
+            res_graph = None
+        except DeadlineExceeded:
+            # Se ha superado el tiempo límite de la petición (ver AgentUtil.Deadline) sin tener la respuesta del
+            # agente de información, respondemos con un 'failure' sin resultados
+            logger.error("Se ha superado el tiempo límite de la petición.")
+            res_graph, reason = Graph(), EXCEEDED
+
+        if res_graph is None:
+            # Si no hay ningún agente de información registrado, cancelamos la petición
+            res_graph = build_message(Graph(),
+                                      ACL.cancel,
+                                      sender=GestorActividades.uri,
+                                      msgcnt=msgcnt)
+        else:
+            # El grafo del resultado lo comparten todas las peticiones agrupadas por single_flight, así que
+            # construimos la respuesta sobre una copia para no añadirle el sobre de cada una
+            res_graph = build_message(copy_graph(res_graph),
+                                      ACL["confirm"] if len(res_graph) and reason is None else ACL.failure,
+                                      sender=GestorActividades.uri,
+                                      content=reason,
+                                      msgcnt=msgcnt)
 
     logger.info('Responde a la petición.')
 
-    return res_graph.serialize(format='xml')
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -164,7 +212,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando Servidor"
 
@@ -181,7 +228,7 @@ def directory_search(agent_type):
     Busca en el servicio de registro un agente del tipo 'agent_type'. Para ello manda un mensaje
     de tipo ACL.request con una acción Search del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
     logger.info("Busca en el servicio de directorio un agente del tipo 'TravelServiceAgent'.")
 
     msg_graph = Graph()
@@ -198,9 +245,8 @@ def directory_search(agent_type):
                         sender=GestorActividades.uri,
                         receiver=DirectoryAgent.uri,
                         content=obj,
-                        msgcnt=mss_cnt)
+                        msgcnt=msgcnt)
     res_graph = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
     logger.info("Recibe información de un agente del tipo 'TravelServiceAgent'.")
 
     return res_graph
@@ -210,8 +256,10 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
     """
     Hace una petición de búsqueda al agente de información de actividades (con sus respectivas restricciones) y obtiene
     el resultado. Para ello manda un mensaje de tipo ACL.request con una acción Search del agente de información.
+    Retorna el grafo con las actividades seleccionadas y si son parciales porque el agente de información ha superado
+    el tiempo límite de la petición (ver AgentUtil.Deadline).
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Hace una petición al servicio de información de actividades.")
 
@@ -240,50 +288,47 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
                         sender=GestorActividades.uri,
                         receiver=agn_uri,
                         content=search_req,
-                        msgcnt=mss_cnt)
+                        msgcnt=msgcnt)
     
     res_graph = send_message(msg, agn_addr)
 
-    selected_grapth = Graph()
-    gsearch = res_graph.triples((None, agn.esUn, agn.activity))
-    for i in range(int(diasDeViaje)):
-        # Seleccionamos actividad de mañana
-        actividad = next(gsearch)[0]
-        nombre_act = res_graph.value(subject=actividad, predicate=agn.nombre)
-        id_act = res_graph.value(subject=actividad, predicate=agn.id)
+    logger.info("Recibe respuesta a la petición al servicio de información de actividades.")
 
-        activity_obj = agn[id_act]
-        selected_grapth.add((activity_obj, agn.esUn, agn.activity))
-        selected_grapth.add((activity_obj, agn.nombre, Literal(nombre_act)))
-        selected_grapth.add((activity_obj, agn.horario, Literal('mañana')))
+    # Si el agente de información responde con un 'failure' no hay actividades que seleccionar, a menos que sea
+    # porque ha superado el tiempo límite, en cuyo caso seleccionamos entre las que tenga
+    msgdic = get_message_properties(res_graph) or {}
+    partial = msgdic.get("performative") == ACL.failure and msgdic.get("content") == EXCEEDED
+    if msgdic.get("performative") != ACL.confirm and not partial:
+        logger.info("El agente de información no ha encontrado actividades.")
+        return Graph(), False
 
-        # Seleccionamos actividad de tarde
-        actividad = next(gsearch)[0]
+    # Seleccionamos una actividad de mañana, una de tarde y una de noche para cada día del viaje
+    selected_grapth = Graph()
+    gsearch = res_graph.triples((None, agn.esUn, agn.activity))
+    for horario in ('mañana', 'tarde', 'noche') * int(diasDeViaje):
+        triple = next(gsearch, None)
+        if triple is None:
+            # No hay actividades para todo el viaje, nos quedamos con las que hay
+            break
+        actividad = triple[0]
         nombre_act = res_graph.value(subject=actividad, predicate=agn.nombre)
         id_act = res_graph.value(subject=actividad, predicate=agn.id)
 
         activity_obj = agn[id_act]
         selected_grapth.add((activity_obj, agn.esUn, agn.activity))
         selected_grapth.add((activity_obj, agn.nombre, Literal(nombre_act)))
-        selected_grapth.add((activity_obj, agn.horario, Literal('tarde')))
-        
-        # Seleccionamos actividad de noche
-        actividad = next(gsearch)[0]
-        nombre_act = res_graph.value(subject=actividad, predicate=agn.nombre)
-        id_act = res_graph.value(subject=actividad, predicate=agn.id)
+        selected_grapth.add((activity_obj, agn.horario, Literal(horario)))
 
-        activity_obj = agn[id_act]
-        selected_grapth.add((activity_obj, agn.esUn, agn.activity))
-        selected_grapth.add((activity_obj, agn.nombre, Literal(nombre_act)))
-        selected_grapth.add((activity_obj, agn.horario, Literal('noche')))
+    return selected_grapth, partial
 
-    mss_cnt += 1
-    logger.info("Recibe respuesta a la petición al servicio de información de actividades.")
 
-    return selected_grapth
+# Resolver de agentes de información, con caché de las respuestas del directorio y reparto de las peticiones entre
+# todos los agentes de información registrados
+resolver = DirectoryResolver(directory_search, ttl=dttl, balancer=LoadBalancer(args.balanceo))
+register_cache('directorio', resolver)
 
 
 if __name__ == '__main__':
-    # Ponemos en marcha el servidor
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info('The End')
@@ -2,13 +2,16 @@
 """
 Agente que busca en el directorio un agente de información de alojamientos y, una vez obtenida su dirección, le hace
 una petición de búsqueda de alojamiento (con sus respectivas restricciones).
+
+Con la opción --fanout, en lugar de preguntar a un solo agente, pregunta en paralelo a todos los agentes de
+información de alojamiento registrados y junta sus respuestas.
 """
 
 import argparse
 import logging
 import socket
 
-from flask import Flask, request
+from flask import Flask
 from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import RDF
 
@@ -17,8 +20,17 @@ from AgentUtil.ACLMessages import build_message, send_message, get_message_prope
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_GESTOR_ALOJAMIENTO, PUERTO_DIRECTORIO
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, DeadlineExceeded, expired
+from AgentUtil.DirectoryResolver import DirectoryResolver, AgentNotFound
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.Launcher import run_agent, SharedCounter
+from AgentUtil.LoadBalancer import LoadBalancer, STRATEGIES
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.Ranking import rank_graph
+from AgentUtil.ScatterGather import ScatterGather
+from AgentUtil.SingleFlight import SingleFlight, request_key
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -28,6 +40,20 @@ parser.add_argument("--open", help="Define si el servidor está abierto al exter
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
 parser.add_argument("--dhost", help="Host del agente de directorio.")
 parser.add_argument("--dport", type=int, help="Puerto de comunicación del agente de directorio.")
+parser.add_argument("--dttl", type=float,
+                    help="Tiempo (en segundos) que se guardan las respuestas del agente de directorio.")
+parser.add_argument("--balanceo", choices=STRATEGIES, default="round-robin",
+                    help="Estrategia de reparto de las peticiones entre los agentes de información.")
+parser.add_argument("--fanout", help="Pregunta en paralelo a todos los agentes de información de alojamiento.",
+                    action="store_true", default=False)
+parser.add_argument("--quorum", type=int,
+                    help="En modo fanout, responde en cuanto este número de agentes de información ha respondido.")
+parser.add_argument("--deadline", type=float,
+                    help="En modo fanout, tiempo máximo (en segundos) de espera de los agentes de información.")
+parser.add_argument("--topk", type=int, help="Número de opciones que se retornan, ordenadas de mejor a peor.")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -49,6 +75,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'GestorAlojamiento')
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -59,12 +98,31 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.dttl is None:
+    dttl = 60
+else:
+    dttl = args.dttl
+
+if args.deadline is None:
+    deadline = 30
+else:
+    deadline = args.deadline
+
+if args.topk is None:
+    topk = 5
+else:
+    topk = args.topk
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
 
 agn = Namespace("http://www.agentes.org#")
 
+# Criterios con los que se ordenan los hoteles: (predicado, peso, 'min' si es mejor un valor bajo o 'max' si es
+# mejor uno alto)
+CRITERIOS_HOTEL = [(agn.Precio, 0.5, 'min'), (agn.Estrellas, 0.3, 'max'), (agn.Distancia, 0.2, 'min')]
+
 # Datos del agente gestor de alojamiento
 GestorAlojamiento = Agent("GestorAlojamiento",
                           agn.GestorAlojamiento,
@@ -80,30 +138,34 @@ DirectoryAgent = Agent("DirectoryAgent",
 # Grafo de estado del agente
 gagraph = Graph()
 
+# Pool de hilos para preguntar en paralelo a los agentes de información en modo fanout
+scatter_gather = ScatterGather(max_workers=16, name='alojamiento')
+
+# Agrupa las peticiones iguales que llegan a la vez, para hacer una sola búsqueda de alojamiento
+single_flight = SingleFlight(name='alojamiento')
+
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entry point de comunicación con el agente.
 
-    Retorna un objeto que representa la selección de un alojamiento entre un conjunto de opciones posibles.
+    Retorna las mejores opciones de alojamiento entre un conjunto de opciones posibles, ordenadas de mejor a peor.
     """
     global gagraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Recibe petición de selección de alojamiento.")
 
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    req_graph = Graph()
-    req_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    req_graph = get_message()
 
     reqdic = get_message_properties(req_graph)
 
@@ -113,35 +175,55 @@ def comunicacion():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=GestorAlojamiento.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif reqdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=GestorAlojamiento.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        # Busca en el directorio un agente de alojamientos
-        res_graph = directory_search(DSO.HotelsAgent)
+        # Si ya hay en curso una petición con los mismos parámetros, espera su respuesta en lugar de hacer otra
+        key = request_key(req_graph, reqdic.get("content"))
+        try:
+            if args.fanout:
+                # Pregunta a todos los agentes de información de alojamiento a la vez
+                res_graph, partial = single_flight.do(key, fanout_search, req_graph)
+            else:
+                # Busca en el directorio (o en la caché de respuestas del directorio) un agente de información y le
+                # envía un mensaje de tipo ACL.request
+                res_graph = single_flight.do(key, resolver.call, DSO.HotelsAgent, infoagent_search, req_graph)
+                partial = partial_response(res_graph)
+        except AgentNotFound:
+            res_graph = None
+        except DeadlineExceeded:
+            # Se ha superado el tiempo límite de la petición (ver AgentUtil.Deadline) sin tener la respuesta del
+            # agente de información, respondemos con un 'failure' sin resultados
+            logger.error("Se ha superado el tiempo límite de la petición.")
+            res_graph, partial = Graph(), True
+
+        if res_graph is None:
+            # Si no hay ningún agente de información registrado, cancelamos la petición
+            res_graph = build_message(Graph(),
+                                      ACL.cancel,
+                                      sender=GestorAlojamiento.uri,
+                                      msgcnt=msgcnt)
+        else:
+            # Ordena todos los hoteles recibidos según su precio, sus estrellas y su distancia al centro, y retorna
+            # los topk mejores
+            ranked_graph = rank_graph(res_graph, agn.Hotel, CRITERIOS_HOTEL, k=topk)
+
+            # Si el grafo está vacío, ningún agente de información ha encontrado alojamiento. Si los resultados son
+            # parciales porque se ha superado el tiempo límite, se retornan los que hay con un 'failure'
+            res_graph = build_message(ranked_graph,
+                                      ACL["confirm"] if len(ranked_graph) and not partial else ACL.failure,
+                                      sender=GestorAlojamiento.uri,
+                                      content=EXCEEDED if partial else None,
+                                      msgcnt=msgcnt)
 
-        # Obtiene la dirección del agente en la respuesta
-        msg = res_graph.value(predicate=RDF.type, object=ACL.FipaAclMessage)
-        content = res_graph.value(subject=msg, predicate=ACL.content)
-        agn_addr = res_graph.value(subject=content, predicate=DSO.Address)
-        agn_uri = res_graph.value(subject=content, predicate=DSO.Uri)
-
-        # Envía una mensaje de tipo ACL.request al agente de información de alojamientos
-        res_graph = infoagent_search(agn_addr, agn_uri, req_graph)
-
-        res_graph = build_message(res_graph,
-                                  ACL["confirm"],
-                                  sender=GestorAlojamiento.uri,
-                                  msgcnt=mss_cnt)
-
-    mss_cnt += 1
     logger.info("Responde a la petición.")
 
-    return res_graph.serialize(format='xml')
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -149,7 +231,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando Servidor"
 
@@ -158,7 +239,7 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    scatter_gather.shutdown()
 
 
 def directory_search(agent_type):
@@ -166,7 +247,7 @@ def directory_search(agent_type):
     Busca en el servicio de registro un agente del tipo 'agent_type'. Para ello manda un mensaje
     de tipo ACL.request con una acción Search del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Busca en el servicio de directorio un agente del tipo 'HotelsAgent'.")
 
@@ -186,10 +267,9 @@ def directory_search(agent_type):
                                            sender=GestorAlojamiento.uri,
                                            receiver=DirectoryAgent.uri,
                                            content=obj,
-                                           msgcnt=mss_cnt),
+                                           msgcnt=msgcnt),
                              DirectoryAgent.address)
 
-    mss_cnt += 1
     logger.info("Recibe información de un agente del tipo 'HotelsAgent'.")
 
     return res_graph
@@ -200,7 +280,7 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
     Hace una petición de búsqueda al agente de información de alojamiento (con sus respectivas restricciones) y obtiene
     el resultado. Para ello manda un mensaje de tipo ACL.request con una acción Search del agente de información.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Hace una petición al servicio de información de alojamiento.")
 
@@ -241,17 +321,81 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
                         sender=GestorAlojamiento.uri,
                         receiver=agn_uri,
                         content=search_req,
-                        msgcnt=mss_cnt)
+                        msgcnt=msgcnt)
     logger.info(agn_addr)
     res_graph = send_message(msg, agn_addr)
 
-    mss_cnt += 1
     logger.info("Recibe respuesta a la petición al servicio de información de alojamiento.")
 
     return res_graph
 
 
+def partial_response(gr):
+    """
+    Indica si la respuesta de un agente de información es un 'failure' porque se ha superado el tiempo límite de la
+    petición, con los resultados parciales que tenía (ver AgentUtil.Deadline)
+    """
+    msgdic = get_message_properties(gr)
+    return msgdic.get("performative") == ACL.failure and msgdic.get("content") == EXCEEDED
+
+
+def fanout_search(req_graph):
+    """
+    Hace la petición de búsqueda a todos los agentes de información de alojamiento registrados en paralelo y retorna
+    un grafo con todos los hoteles encontrados, sin repetidos. Espera como mucho 'deadline' segundos (o hasta el tiempo
+    límite de la petición) y, si se ha indicado un quorum, retorna en cuanto ese número de agentes ha respondido.
+
+    Los agentes que responden con un 'failure' (salvo si es por el tiempo límite, con resultados parciales) o que no
+    responden a tiempo no aportan hoteles. Si ninguno encuentra nada el grafo retornado es vacío.
+
+    :return: el grafo con los hoteles y si los resultados son parciales, porque se ha superado el tiempo límite de la
+             petición antes de que respondan los agentes necesarios o porque alguno ha respondido con resultados
+             parciales
+    """
+    logger.info("Hace una petición a todos los servicios de información de alojamiento.")
+
+    candidates = resolver.candidates(DSO.HotelsAgent)
+    tasks = {str(agn_addr): (resolver.call_agent, (agn_addr, agn_uri, infoagent_search, req_graph))
+             for agn_addr, agn_uri in candidates}
+    results = scatter_gather.run(tasks, timeout=deadline, quorum=args.quorum)
+
+    # Juntamos los hoteles de todas las respuestas. Consideramos que dos hoteles son el mismo si tienen la misma URI o
+    # el mismo nombre (los hoteles sin nombre solo por la URI)
+    merged = Graph()
+    seen = set()
+    seen_names = set()
+    needed = len(candidates) if args.quorum is None else min(args.quorum, len(candidates))
+    partial = expired() and len(results) < needed
+    for agn_addr, gr in results.items():
+        if partial_response(gr):
+            logger.info("El agente %s ha respondido con resultados parciales.", agn_addr)
+            partial = True
+        elif get_message_properties(gr).get("performative") == ACL.failure:
+            logger.info("El agente %s no ha encontrado alojamiento.", agn_addr)
+            continue
+        for hotel in gr.subjects(predicate=agn.esUn, object=agn.Hotel):
+            nombre = gr.value(subject=hotel, predicate=agn.Nombre)
+            nombre = str(nombre).strip().lower() if nombre is not None else None
+            if hotel in seen or nombre in seen_names:
+                continue
+            seen.add(hotel)
+            if nombre is not None:
+                seen_names.add(nombre)
+            for _, predicate, object in gr.triples((hotel, None, None)):
+                merged.add((hotel, predicate, object))
+
+    logger.info("Recibe respuesta de %d de %d servicios de información de alojamiento.", len(results), len(candidates))
+
+    return merged, partial
+
+
+# Resolver de agentes de información, con caché de las respuestas del directorio y reparto de las peticiones entre
+# todos los agentes de información registrados
+resolver = DirectoryResolver(directory_search, ttl=dttl, balancer=LoadBalancer(args.balanceo))
+register_cache('directorio', resolver)
+
+
 if __name__ == '__main__':
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info("The end.")
@@ -8,7 +8,7 @@ import argparse
 import logging
 import socket
 
-from flask import Flask, request
+from flask import Flask
 from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import RDF
 
@@ -17,8 +17,16 @@ from AgentUtil.ACLMessages import build_message, send_message, get_message_prope
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_GESTOR_TRANSPORTE, PUERTO_DIRECTORIO
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, DeadlineExceeded
+from AgentUtil.DirectoryResolver import DirectoryResolver, AgentNotFound
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.Launcher import run_agent, SharedCounter
+from AgentUtil.LoadBalancer import LoadBalancer, STRATEGIES
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.Ranking import rank_graph
+from AgentUtil.SingleFlight import SingleFlight, request_key
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -28,6 +36,14 @@ parser.add_argument("--open", help="Define si el servidor está abierto al exter
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
 parser.add_argument("--dhost", help="Host del agente de directorio.")
 parser.add_argument("--dport", type=int, help="Puerto de comunicación del agente de directorio.")
+parser.add_argument("--dttl", type=float,
+                    help="Tiempo (en segundos) que se guardan las respuestas del agente de directorio.")
+parser.add_argument("--balanceo", choices=STRATEGIES, default="round-robin",
+                    help="Estrategia de reparto de las peticiones entre los agentes de información.")
+parser.add_argument("--topk", type=int, help="Número de opciones que se retornan, ordenadas de mejor a peor.")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -49,6 +65,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'GestorTransporte')
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -59,12 +88,26 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.dttl is None:
+    dttl = 60
+else:
+    dttl = args.dttl
+
+if args.topk is None:
+    topk = 5
+else:
+    topk = args.topk
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
 
 agn = Namespace("http://www.agentes.org#")
 
+# Criterios con los que se ordenan los billetes: (predicado, peso, 'min' si es mejor un valor bajo o 'max' si es
+# mejor uno alto)
+CRITERIOS_BILLETE = [(agn.Precio, 0.7, 'min'), (agn.Duracion, 0.3, 'min')]
+
 # Datos del agente gestor de transporte
 GestorTransporte = Agent("GestorTransporte",
                          agn.GestorTransporte,
@@ -83,27 +126,29 @@ gtgraph = Graph()
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
+
+# Agrupa las peticiones iguales que llegan a la vez, para hacer una sola petición al agente de información
+single_flight = SingleFlight(name='transporte')
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunication():
     """
     Entry point de comunicación con el agente.
 
-    Retorna un objeto que representa la selección de un billete de vuelo de entre un conjunto de opciones posibles.
+    Retorna las mejores opciones de billete de vuelo de entre un conjunto de opciones posibles, ordenadas de mejor a
+    peor.
     """
     global gtgraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Recibe petición de selección de transporte.")
 
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    req_graph = Graph()
-    req_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    req_graph = get_message()
 
     reqdic = get_message_properties(req_graph)
 
@@ -113,44 +158,53 @@ def comunication():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=GestorTransporte.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif reqdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=GestorTransporte.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        # Busca en el directorio un agente de vuelos
-        res_graph = directory_search(DSO.FlightsAgent)
-
-        # Obtiene la dirección del agente en la respuesta
-        msg = res_graph.value(predicate=RDF.type, object=ACL.FipaAclMessage)
-        content = res_graph.value(subject=msg, predicate=ACL.content)
-        agn_addr = res_graph.value(subject=content, predicate=DSO.Address)
-        agn_uri = res_graph.value(subject=content, predicate=DSO.Uri)
-
-        # Envía una mensaje de tipo ACL.request al agente de información de vuelos
-        res_graph = infoagent_search(agn_addr, agn_uri, req_graph)
-
-        # Selecciona un billete cualquiera del conjunto de billetes recibido, que cumplen con las restricciones
-        # de búsqueda. Es una selección simple que no tiene en cuenta otra preferencias del usuario, como su
-        # historial de compra pasado.
-        gsearch = res_graph.triples((None, agn.esUn, agn.Billete))
-        billete = next(gsearch)[0]
-        aux_graph = Graph()
-        for subject, predicate, object in res_graph.triples((billete, None, None)):
-            aux_graph.add((billete, predicate, object))
-
-        res_graph = build_message(aux_graph,
-                                  ACL["confirm"],
-                                  sender=GestorTransporte.uri,
-                                  msgcnt=mss_cnt)
+        reason = None
+        try:
+            # Busca en el directorio (o en la caché de respuestas del directorio) un agente de información y le
+            # envía un mensaje de tipo ACL.request. Si ya hay en curso una petición con los mismos parámetros,
+            # espera su respuesta en lugar de hacer otra
+            res_graph = single_flight.do(request_key(req_graph, reqdic.get("content")),
+                                         resolver.call, DSO.FlightsAgent, infoagent_search, req_graph)
+            # El agente de información no ha acabado a tiempo
+            if get_message_properties(res_graph).get("content") == EXCEEDED:
+                reason = EXCEEDED
+        except AgentNotFound:
+            res_graph = None
+        except DeadlineExceeded:
+            # Se ha superado el tiempo límite de la petición (ver AgentUtil.Deadline) sin tener la respuesta del
+            # agente de información, respondemos con un 'failure' sin resultados
+            logger.error("Se ha superado el tiempo límite de la petición.")
+            res_graph, reason = Graph(), EXCEEDED
+
+        if res_graph is None:
+            # Si no hay ningún agente de información registrado, cancelamos la petición
+            res_graph = build_message(Graph(),
+                                      ACL.cancel,
+                                      sender=GestorTransporte.uri,
+                                      msgcnt=msgcnt)
+        else:
+            # Ordena todos los billetes recibidos, que cumplen con las restricciones de búsqueda, según su precio y
+            # su duración, y retorna los topk mejores. Así el unificador puede escoger otro billete sin tener que
+            # volver a hacer la búsqueda.
+            ranked_graph = rank_graph(res_graph, agn.Billete, CRITERIOS_BILLETE, k=topk)
+
+            res_graph = build_message(ranked_graph,
+                                      ACL["confirm"] if len(ranked_graph) else ACL.failure,
+                                      sender=GestorTransporte.uri,
+                                      content=reason,
+                                      msgcnt=msgcnt)
 
-    mss_cnt += 1
     logger.info("Responde a la petición.")
 
-    return res_graph.serialize(format='xml')
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -158,7 +212,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando servidor."
 
@@ -175,7 +228,7 @@ def directory_search(agent_type):
     Busca en el servicio de registro un agente del tipo 'agent_type'. Para ello manda un mensaje
     de tipo ACL.request con una acción Search del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Busca en el servicio de directorio un agente del tipo 'FlightsAgent'.")
 
@@ -195,10 +248,9 @@ def directory_search(agent_type):
                                            sender=GestorTransporte.uri,
                                            receiver=DirectoryAgent.uri,
                                            content=obj,
-                                           msgcnt=mss_cnt),
+                                           msgcnt=msgcnt),
                              DirectoryAgent.address)
 
-    mss_cnt += 1
     logger.info("Recibe información de un agente del tipo 'FlightsAgent'.")
 
     return res_graph
@@ -209,7 +261,7 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
     Hace una petición de búsqueda al agente de información de transporte (con sus respectivas restricciones) y obtiene
     el resultado. Para ello manda un mensaje de tipo ACL.request con una acción Search del agente de información.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Hace una petición al servicio de información de vuelos.")
 
@@ -244,15 +296,20 @@ def infoagent_search(agn_addr, agn_uri, req_graph):
                                            sender=GestorTransporte.uri,
                                            receiver=agn_uri,
                                            content=search_req,
-                                           msgcnt=mss_cnt), agn_addr)
+                                           msgcnt=msgcnt), agn_addr)
 
-    mss_cnt += 1
     logger.info("Recibe respuesta a la petición al servicio de información de vuelos.")
 
     return res_graph
 
 
+# Resolver de agentes de información, con caché de las respuestas del directorio y reparto de las peticiones entre
+# todos los agentes de información registrados
+resolver = DirectoryResolver(directory_search, ttl=dttl, balancer=LoadBalancer(args.balanceo))
+register_cache('directorio', resolver)
+
+
 if __name__ == "__main__":
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info("The end.")
@@ -7,21 +7,27 @@ import argparse
 import logging
 import socket
 
-from amadeus import Client, ResponseError
-from flask import Flask, request
+from amadeus import ResponseError
+from flask import Flask
 from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import FOAF, RDF
 
 from AgentUtil.ACL import ACL
 from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
-from AgentUtil.APIKeys import AMADEUS_KEY, AMADEUS_SECRET
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_INFO_ACTIVIDADES, PUERTO_DIRECTORIO
-from AgentUtil.Coordenadas import COORDENADAS
+from AgentUtil.AmadeusClient import get_amadeus_client, close_amadeus_client, amadeus_options
+from AgentUtil.Cache import TTLCache
+from AgentUtil.Coordenadas import COORDENADAS, distancia
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, expired
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.GraphBuilder import new_graph, add_entities
 from AgentUtil.IATACodes import convert_to_IATA
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -31,6 +37,13 @@ parser.add_argument("--open", help="Define si el servidor está abierto al exter
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
 parser.add_argument("--dhost", help="Host del agente de directorio.")
 parser.add_argument("--dport", type=int, help="Puerto de comunicación del agente de directorio.")
+parser.add_argument("--amadeus", help="URL de la API Amadeus (por defecto la de pruebas de Amadeus).")
+parser.add_argument("--cttl", type=float,
+                    help="Tiempo (en segundos) que se guardan las actividades obtenidas de Amadeus.")
+parser.add_argument("--csize", type=int, help="Número máximo de ciudades guardadas en la caché de actividades.")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -52,6 +65,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'InfoActividades')
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -62,15 +88,31 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.amadeus is None:
+    amadeus_url = None
+else:
+    amadeus_url = args.amadeus
+
+if args.cttl is None:
+    cttl = 24 * 3600
+else:
+    cttl = args.cttl
+
+if args.csize is None:
+    csize = 64
+else:
+    csize = args.csize
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
 
 agn = Namespace("http://www.agentes.org#")
 
-# Datos del agente de información de actividades
+# Datos del agente de información de actividades. La URI incluye el puerto para que se puedan registrar varias
+# instancias del agente en el directorio y repartir las peticiones entre ellas.
 InfoActividades = Agent("InfoActividades",
-                        agn.InfoActividades,
+                        agn["InfoActividades-%d" % port],
                         "http://%s:%d/comm" % (hostaddr, port),
                         "http://%s:%d/Stop" % (hostaddr, port))
 
@@ -86,12 +128,24 @@ igraph = Graph()
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
+
+# Cliente de la API Amadeus, compartido por todas las peticiones (ver AgentUtil.AmadeusClient)
+amadeus = get_amadeus_client(**amadeus_options(amadeus_url))
+
+# Radios de búsqueda (en kilómetros) con los que se hacen las peticiones a Amadeus. El radio pedido se redondea al
+# siguiente de la lista, y el máximo es el que admite la API
+RADIUS_BUCKETS = [1, 2, 5, 10, 20]
+
+# Caché de actividades por ciudad. Para cada ciudad se guarda el resultado de la búsqueda con el radio más grande que
+# se ha hecho, y las búsquedas con un radio menor se responden filtrando por distancia al centro de la ciudad
+activities_cache = TTLCache(maxsize=csize, ttl=cttl)
+register_cache('actividades', activities_cache)
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entry point de comunicación con el agente.
@@ -102,13 +156,11 @@ def comunicacion():
     acciones se reciben en un mensaje de tipo ACL.request.
     """
     global igraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Petición de información de actividades recibida.")
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    msg_graph = Graph()
-    msg_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    msg_graph = get_message()
 
     msgdic = get_message_properties(msg_graph)
 
@@ -118,21 +170,19 @@ def comunicacion():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoActividades.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif msgdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoActividades.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        res_graph = infoActividades(msg_graph, msgdic)
-
-    mss_cnt += 1
+        res_graph = infoActividades(msg_graph, msgdic, msgcnt)
 
     logger.info("El agente de información de actividades responde a la petición.")
 
-    return res_graph.serialize(format="xml")
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -140,7 +190,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando Servidor"
 
@@ -149,56 +198,92 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    close_amadeus_client()
 
 
-def infoActividades(msg_graph, msgdic):
+def infoActividades(msg_graph, msgdic, msgcnt):
     """
     Devuelve un mensaje en formato FIPA-ACL, de tipo 'inform', que contiene el resultado de la búsqueda de actividades
     hecha en la API Amadeus con los criterio de búsqueda que hay en el grafo msg_graph, pasado como parámetro. En caso
     de producirse un error, la función retorna un mensaje FIPA-ACL de tipo 'failure'.
     """
-    res_graph = Graph()
+    res_graph = new_graph()
 
     # Extraemos los campos de búsqueda del contenido del mensaje, una vez que este está expresado como un grafo
     search_req = agn["GestorActividades-InfoSearch"]
 
     ciudadDestino = msg_graph.value(subject=search_req, predicate=agn.ciudadDestino)
-    ciudadIATA = convert_to_IATA(str(ciudadDestino))
     radius = msg_graph.value(subject=search_req, predicate=agn.radius)
 
-    amadeus = Client(
-        client_id=AMADEUS_KEY,
-        client_secret=AMADEUS_SECRET
-    )
-
     try:
-        # Hace la búsqueda a la API Amadeus a través de su librería y guarda el resultado en formato JSON (accesible
-        # como si fuera un diccionario Python)   
-        response = amadeus.shopping.activities.get(latitude=COORDENADAS[str(ciudadIATA)]['latitude'],
-                                                   longitude=COORDENADAS[str(ciudadIATA)]['longitude'],
-                                                   radius=radius)
-
-        for activity in response.data:
-            activity_obj = agn[activity['id']]
-            res_graph.add((activity_obj, agn.esUn, agn.activity))
-            res_graph.add((activity_obj, agn.nombre, Literal(activity['name'])))
-            res_graph.add((activity_obj, agn.id, Literal(activity['id'])))
+        ciudadIATA = convert_to_IATA(str(ciudadDestino))
+
+        # Obtiene las actividades de la caché o, si no están, de la API Amadeus
+        activities = search_activities(str(ciudadIATA), 1 if radius is None else float(radius))
+
+        add_entities(res_graph, [(agn[activity['id']], {agn.esUn: agn.activity,
+                                                        agn.nombre: activity['name'],
+                                                        agn.id: activity['id']})
+                                 for activity in activities])
 
         res_graph = build_message(res_graph,
                                   ACL['confirm'],
                                   sender=InfoActividades.uri,
-                                  msgcnt=mss_cnt,
+                                  msgcnt=msgcnt,
                                   receiver=msgdic['sender'])
     except ResponseError as error:
         logger.info(error)
-        res_graph = build_message(res_graph,
+        # Si la llamada a la API ha superado el tiempo límite de la petición (ver AgentUtil.Deadline), la librería
+        # de Amadeus lo retorna como un error de red más, así que lo indicamos como motivo del 'failure'
+        res_graph = build_message(new_graph(),
                                   ACL["failure"],
                                   sender=InfoActividades.uri,
+                                  content=EXCEEDED if expired() else None,
                                   receiver=msgdic['sender'],
-                                  msgcnt=mss_cnt)
-    finally:
-        return res_graph
+                                  msgcnt=msgcnt)
+    except Exception:
+        # Cualquier otro error (por ejemplo, una ciudad de la que no tenemos coordenadas) también se responde con un
+        # 'failure'
+        logger.exception("Error inesperado en la búsqueda de actividades.")
+        res_graph = build_message(new_graph(),
+                                  ACL["failure"],
+                                  sender=InfoActividades.uri,
+                                  receiver=msgdic['sender'],
+                                  msgcnt=msgcnt)
+    return res_graph
+
+
+def search_activities(ciudadIATA, radius):
+    """
+    Retorna la lista de actividades de la API Amadeus (en formato JSON, accesible como si fuera un diccionario
+    Python) a menos de radius kilómetros del centro de la ciudad. Si en la caché ya está el resultado de una búsqueda
+    en esa ciudad con un radio igual o mayor, se filtra por distancia sin volver a llamar a la API. Los errores de la
+    API no se guardan
+    """
+    latitude = COORDENADAS[ciudadIATA]['latitude']
+    longitude = COORDENADAS[ciudadIATA]['longitude']
+    bucket = next((bucket for bucket in RADIUS_BUCKETS if bucket >= radius), RADIUS_BUCKETS[-1])
+
+    cached = activities_cache.get(ciudadIATA)
+    if cached is not None and cached[0] >= bucket:
+        cached_radius, activities = cached
+    else:
+        # Hace la búsqueda a la API Amadeus a través de su librería
+        response = amadeus.shopping.activities.get(latitude=latitude, longitude=longitude, radius=bucket)
+        cached_radius, activities = bucket, response.data
+        activities_cache.put(ciudadIATA, (cached_radius, activities))
+
+    stats = activities_cache.stats()
+    logger.info("Caché de actividades: %d aciertos, %d fallos (%.0f%% de aciertos).",
+                stats['hits'], stats['misses'], 100 * stats['hit_ratio'])
+
+    if cached_radius <= radius:
+        return activities
+    # Las actividades sin coordenadas se mantienen, ya que no se puede saber a qué distancia están
+    return [activity for activity in activities
+            if 'geoCode' not in activity or
+            distancia(latitude, longitude, float(activity['geoCode']['latitude']),
+                      float(activity['geoCode']['longitude'])) <= radius]
 
 
 def registrar_actividades():
@@ -206,7 +291,7 @@ def registrar_actividades():
     Envia un mensaje de registro al servicio de registro usando una performativa 'Request' con
     una acción 'Register' del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Registro agente información de actividades.")
 
@@ -231,9 +316,8 @@ def registrar_actividades():
                       sender=InfoActividades.uri,
                       receiver=DirectoryAgent.uri,
                       content=reg_obj,
-                      msgcnt=mss_cnt),
+                      msgcnt=msgcnt),
         DirectoryAgent.address)
-    mss_cnt += 1
 
     return gr
 
@@ -244,6 +328,6 @@ if __name__ == '__main__':
     except:
         logger.info("DirectoryAgent no localizado.")
 
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info('The End')
@@ -7,20 +7,24 @@ import argparse
 import logging
 import socket
 
-from amadeus import Client, ResponseError
-from flask import Flask, request
+from amadeus import ResponseError
+from flask import Flask
 from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import FOAF, RDF
 
 from AgentUtil.ACL import ACL
 from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
-from AgentUtil.APIKeys import AMADEUS_KEY, AMADEUS_SECRET
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_INFO_ALOJAMIENTO_AMADEUS, PUERTO_DIRECTORIO
+from AgentUtil.AmadeusClient import get_amadeus_client, close_amadeus_client, amadeus_options
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, expired
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.GraphBuilder import new_graph, add_entities
 from AgentUtil.IATACodes import convert_to_IATA
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -30,6 +34,10 @@ parser.add_argument("--open", help="Define si el servidor está abierto al exter
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
 parser.add_argument("--dhost", help="Host del agente de directorio.")
 parser.add_argument("--dport", type=int, help="Puerto de comunicación del agente de directorio.")
+parser.add_argument("--amadeus", help="URL de la API Amadeus (por defecto la de pruebas de Amadeus).")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -51,6 +59,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'InfoAlojamientoAmadeus')
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -61,15 +82,21 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.amadeus is None:
+    amadeus_url = None
+else:
+    amadeus_url = args.amadeus
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
 
 agn = Namespace("http://www.agentes.org#")
 
-# Datos del agente de información de alojamiento
+# Datos del agente de información de alojamiento. La URI incluye el puerto para que se puedan registrar varias
+# instancias del agente en el directorio y repartir las peticiones entre ellas.
 InfoAmadeus = Agent("InfoAmadeus",
-                    agn.InfoAmadeus,
+                    agn["InfoAmadeus-%d" % port],
                     "http://%s:%d/comm" % (hostaddr, port),
                     "http://%s:%d/Stop" % (hostaddr, port))
 
@@ -85,12 +112,18 @@ igraph = Graph()
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
+
+# Cliente de la API Amadeus, compartido por todas las peticiones (ver AgentUtil.AmadeusClient)
+amadeus = get_amadeus_client(**amadeus_options(amadeus_url))
+
+# Número máximo de hoteles de la ciudad de los que se piden ofertas
+MAX_HOTELES = 20
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entry point de comunicación con el agente.
@@ -101,14 +134,12 @@ def comunicacion():
     acciones se reciben en un mensaje de tipo ACL.request.
     """
     global igraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Petición de información de alojamiento recibida.")
 
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    msg_graph = Graph()
-    msg_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    msg_graph = get_message()
 
     msgdic = get_message_properties(msg_graph)
 
@@ -118,21 +149,19 @@ def comunicacion():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAmadeus.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif msgdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAmadeus.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        res_graph = infoHoteles(msg_graph, msgdic)
-
-    mss_cnt += 1
+        res_graph = infoHoteles(msg_graph, msgdic, msgcnt)
 
     logger.info("El agente de información de alojamiento responde a la petición.")
 
-    return res_graph.serialize(format="xml")
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -140,7 +169,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando Servidor"
 
@@ -149,16 +177,16 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    close_amadeus_client()
 
 
-def infoHoteles(msg_graph, msgdic):
+def infoHoteles(msg_graph, msgdic, msgcnt):
     """
     Retorna un mensaje en formato FIPA-ACL, de tipo 'inform', que contiene el resultado de la búsqueda de alojamientos hecha
     en la API Amadeus con los criterio de búsqueda que hay en el grafo msg_graph, pasado como parámetro. En caso de
     producirse un error, la función retorna un mensaje FIPA-ACL de tipo 'failure'.
     """
-    res_graph = Graph()
+    res_graph = new_graph()
     # Extraemos los campos de búsqueda del contenido del mensaje, una vez que este está expresado como un grafo
     search_req = agn["GestorAlojamiento-InfoSearch"]
     destinationCity = msg_graph.value(subject=search_req, predicate=agn.destinationCity)
@@ -171,51 +199,73 @@ def infoHoteles(msg_graph, msgdic):
     adults = msg_graph.value(subject=search_req, predicate=agn.adults)
     radius = msg_graph.value(subject=search_req, predicate=agn.radius)
 
-    amadeus = Client(
-        client_id=AMADEUS_KEY,
-        client_secret=AMADEUS_SECRET
-    )
-
     try:
-        # Hace la búsqueda a la API Amadeus a través de su librería y guarda el resultado en formato JSON (accesible
-        # como si fuera un diccionario Python)
-        response = amadeus.shopping.hotel_offers.get(cityCode=str(destinationIATA),
-                                                     checkInDate=str(checkInDate),
-                                                     checkOutDate=str(checkOutDate),
-                                                     roomQuantity=int(roomQuantity),
-                                                     adults=int(adults),
-                                                     radius=int(radius),
-                                                     ratings=int(ratings),
-                                                     priceRange=hotelBudget,
-                                                     currency='EUR',
-                                                     view='LIGHT',
-                                                     )
-        h = response.data[0]
-        hotel = h['hotel']['hotelId']
-        address = h['hotel']['address']['lines'][0] + ', ' + h['hotel']['address']['cityName'] + ', ' + \
-                  h['hotel']['address']['postalCode']
-        price = h['offers'][0]['price']['total'] + '€'
-        hotel_obj = agn[hotel]
-        res_graph.add((hotel_obj, agn.esUn, agn.Hotel))
-        res_graph.add((hotel_obj, agn.Nombre, Literal(h['hotel']['name'])))
-        res_graph.add((hotel_obj, agn.Direccion, Literal(address)))
-        res_graph.add((hotel_obj, agn.Precio, Literal(price)))
+        # Hace la búsqueda a la API Amadeus a través de su librería, en dos pasos: primero los hoteles de la ciudad
+        # (con sus estrellas y su distancia al centro) y después las ofertas de los MAX_HOTELES primeros para las
+        # fechas pedidas. Las respuestas son JSON, accesible como si fuera un diccionario Python
+        response = amadeus.reference_data.locations.hotels.by_city.get(cityCode=str(destinationIATA),
+                                                                       radius=int(radius),
+                                                                       radiusUnit='KM',
+                                                                       ratings=str(int(ratings)))
+        hoteles_ciudad = {h['hotelId']: h for h in response.data[:MAX_HOTELES]}
+
+        hoteles = []
+        if hoteles_ciudad:
+            response = amadeus.shopping.hotel_offers_search.get(hotelIds=','.join(hoteles_ciudad),
+                                                                checkInDate=str(checkInDate),
+                                                                checkOutDate=str(checkOutDate),
+                                                                roomQuantity=int(roomQuantity),
+                                                                adults=int(adults),
+                                                                priceRange=str(hotelBudget),
+                                                                currency='EUR',
+                                                                bestRateOnly='true',
+                                                                )
+            # Retornamos todos los hoteles con ofertas, con los datos que necesita el gestor para ordenarlos (precio,
+            # estrellas y distancia al centro)
+            for h in response.data:
+                if not h.get('offers'):
+                    continue
+                hotel = h['hotel']
+                ciudad = hoteles_ciudad.get(hotel['hotelId'], {})
+                addr = ciudad.get('address', {})
+                address = ', '.join(part for part in (', '.join(addr.get('lines', [])), addr.get('cityName'),
+                                                      addr.get('postalCode')) if part) or hotel.get('cityCode')
+                distance = ciudad.get('distance', {}).get('value')
+                hoteles.append((agn[hotel['hotelId']], {
+                    agn.esUn: agn.Hotel,
+                    agn.Nombre: hotel.get('name', ciudad.get('name')),
+                    agn.Direccion: address,
+                    agn.Precio: h['offers'][0]['price']['total'] + '€',
+                    agn.Estrellas: int(ciudad['rating']) if ciudad.get('rating') is not None else None,
+                    agn.Distancia: float(distance) if distance is not None else None
+                }))
+        add_entities(res_graph, hoteles)
 
         res_graph = build_message(res_graph,
                                   ACL["inform"],
                                   sender=InfoAmadeus.uri,
                                   receiver=msgdic['sender'],
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
 
     except ResponseError as error:
         logger.info(error)
-        res_graph = build_message(res_graph,
+        # Si la llamada a la API ha superado el tiempo límite de la petición (ver AgentUtil.Deadline), la librería
+        # de Amadeus lo retorna como un error de red más, así que lo indicamos como motivo del 'failure'
+        res_graph = build_message(new_graph(),
+                                  ACL["failure"],
+                                  sender=InfoAmadeus.uri,
+                                  content=EXCEEDED if expired() else None,
+                                  receiver=msgdic['sender'],
+                                  msgcnt=msgcnt)
+    except Exception:
+        # Cualquier otro error (por ejemplo, una respuesta con otro formato) también se responde con un 'failure'
+        logger.exception("Error inesperado en la búsqueda de alojamiento.")
+        res_graph = build_message(new_graph(),
                                   ACL["failure"],
                                   sender=InfoAmadeus.uri,
                                   receiver=msgdic['sender'],
-                                  msgcnt=mss_cnt)
-    finally:
-        return res_graph
+                                  msgcnt=msgcnt)
+    return res_graph
 
 
 def registrar_hoteles():
@@ -223,7 +273,7 @@ def registrar_hoteles():
     Envia un mensaje de registro al servicio de registro usando una performativa 'Request' con
     una acción 'Register' del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Registro agente información de alojamiento.")
 
@@ -245,9 +295,8 @@ def registrar_hoteles():
                       sender=InfoAmadeus.uri,
                       receiver=DirectoryAgent.uri,
                       content=reg_obj,
-                      msgcnt=mss_cnt),
+                      msgcnt=msgcnt),
         DirectoryAgent.address)
-    mss_cnt += 1
 
     return gr
 
@@ -258,6 +307,6 @@ if __name__ == '__main__':
     except:
         logger.info("DirectoryAgent no localizado.")
 
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info('The End')
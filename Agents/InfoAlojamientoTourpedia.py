@@ -6,9 +6,9 @@ Agente de información de alojamiento. Se registra en el directorio de agentes c
 import argparse
 import logging
 import socket
+import threading
 
-import requests
-from flask import Flask, request
+from flask import Flask
 from rdflib import Graph, RDF, Namespace, Literal
 from rdflib.namespace import FOAF
 
@@ -17,8 +17,17 @@ from AgentUtil.ACLMessages import build_message, send_message, get_message_prope
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_INFO_ALOJAMIENTO_TOURPEDIA, PUERTO_DIRECTORIO
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, expired
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.GraphBuilder import new_graph, add_entities
+from AgentUtil.HTTPPool import http_request
+from AgentUtil.IATACodes import IATA
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.PersistentCache import SQLiteCache
+from AgentUtil.ScatterGather import ScatterGather
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 TOURPEDIA_END_POINT = 'http://tour-pedia.org/api/'
@@ -27,11 +36,20 @@ TOURPEDIA_END_POINT = 'http://tour-pedia.org/api/'
 parser = argparse.ArgumentParser()
 parser.add_argument('--open', help="Define si el servidor est abierto al exterior o no", action='store_true',
                     default=False)
+parser.add_argument('--workers', type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument('--threads', type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument('--trace', help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument('--verbose', help="Genera un log de la comunicacion del servidor web", action='store_true',
                         default=False)
 parser.add_argument('--port', type=int, help="Puerto de comunicacion del agente")
 parser.add_argument('--dhost', help="Host del agente de directorio")
 parser.add_argument('--dport', type=int, help="Puerto de comunicacion del agente de directorio")
+parser.add_argument('--tourpedia', help="URL de la API de Tourpedia (por defecto %s)" % TOURPEDIA_END_POINT)
+parser.add_argument('--cache', help="Fichero de la cache de consultas a Tourpedia")
+parser.add_argument('--cttl', type=float, help="Tiempo (en segundos) que se guardan las consultas a Tourpedia")
+parser.add_argument('--topk', type=int, help="Numero de hoteles que se retornan en cada busqueda")
+parser.add_argument('--nowarm', help="No precarga la cache con las ciudades conocidas al arrancar", action='store_true',
+                    default=False)
 
 # Logging
 logger = config_logger(level=1)
@@ -45,6 +63,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'InfoAlojamientoTourpedia')
+
 if args.open:
     hostname = '0.0.0.0'
     hostaddr = gethostname()
@@ -61,6 +92,26 @@ if args.dhost is None:
 else:
     dhostname = args.dhost
 
+if args.tourpedia is None:
+    tourpedia_url = TOURPEDIA_END_POINT
+else:
+    tourpedia_url = args.tourpedia
+
+if args.cache is None:
+    cache_file = 'tourpedia-cache.sqlite'
+else:
+    cache_file = args.cache
+
+if args.cttl is None:
+    cttl = 7 * 24 * 3600
+else:
+    cttl = args.cttl
+
+if args.topk is None:
+    topk = 1
+else:
+    topk = args.topk
+
 # Flask stuff
 app = Flask(__name__)
 if not args.verbose:
@@ -69,12 +120,13 @@ if not args.verbose:
 
 agn = Namespace("http://www.agentes.org#")
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
 
-# Datos del agente de información de alojamiento
+# Datos del agente de información de alojamiento. La URI incluye el puerto para que se puedan registrar varias
+# instancias del agente en el directorio y repartir las peticiones entre ellas.
 InfoAlojamientoTourpedia = Agent('InfoAlojamientoTourpedia',
-                       agn.InfoAlojamientoTourpedia,
+                       agn['InfoAlojamientoTourpedia-%d' % port],
                        'http://%s:%d/comm' % (hostaddr, port),
                        'http://%s:%d/Stop' % (hostaddr, port))
 
@@ -87,6 +139,14 @@ DirectoryAgent = Agent('DirectoryAgent',
 # Global triplestore graph
 igraph = Graph()
 
+# Cache en disco de las consultas a Tourpedia (listas de alojamientos por ciudad y detalles de cada alojamiento). Los
+# datos de Tourpedia casi no cambian, asi que se guardan entre ejecuciones del agente
+tourpedia_cache = SQLiteCache(cache_file, ttl=cttl)
+register_cache('tourpedia', tourpedia_cache)
+
+# Pool de hilos con el que se piden en paralelo los detalles de los hoteles
+scatter_gather = ScatterGather(max_workers=max(topk, 4), name='tourpedia')
+
 # Flask stuff
 app = Flask(__name__)
 if not args.verbose:
@@ -95,7 +155,7 @@ if not args.verbose:
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entry point de comunicación con el agente.
@@ -106,14 +166,12 @@ def comunicacion():
     acciones se reciben en un mensaje de tipo ACL.request.
     """
     global igraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Petición de información de alojamiento recibida.")
     
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    msg_graph = Graph()
-    msg_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    msg_graph = get_message()
 
     msgdic = get_message_properties(msg_graph)
 
@@ -123,21 +181,19 @@ def comunicacion():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAlojamientoTourpedia.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif msgdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAlojamientoTourpedia.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        res_graph = infoHoteles(msg_graph, msgdic)
-
-    mss_cnt += 1
+        res_graph = infoHoteles(msg_graph, msgdic, msgcnt)
 
     logger.info("El agente de información de alojamiento responde a la petición.")
 
-    return res_graph.serialize(format="xml")
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -145,7 +201,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando Servidor"
 
@@ -154,52 +209,107 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    scatter_gather.shutdown()
+    tourpedia_cache.close()
 
 
-def infoHoteles(gm, msgdic):
-    busqueda = agn["ConsultarOpcionesAlojamiento"]
+def infoHoteles(gm, msgdic, msgcnt):
+    # Los campos de búsqueda están en el objeto del contenido del mensaje, con el mismo formato que las peticiones
+    # que reciben el resto de agentes de información de alojamiento
+    busqueda = msgdic['content']
 
-    ciudadDestino = gm.value(subject= busqueda, predicate= agn.ciudadDestino)
+    ciudadDestino = gm.value(subject= busqueda, predicate= agn.destinationCity)
 
-    gr = Graph()
+    gr = new_graph()
     try:
-        response = requests.get(TOURPEDIA_END_POINT+ 'getPlaces',
-                    params={'location': ciudadDestino, 'category': 'accommodation', 'name' : 'Hotel'})
-
-        hoteles = response.json()
-        h = hoteles[0]
-        hotelID = h['id']
-        r = requests.get(h['details']) # usamos la llamada a la API ya codificada en el atributo
-        detalles_hotel = r.json()
-        hotel_obj = agn[hotelID]
-        gr.add((hotel_obj, agn.esUn, agn.Hotel))
-        gr.add((hotel_obj, agn.Nombre, Literal(detalles_hotel['name'])))
-        gr.add((hotel_obj, agn.Direccion, Literal(h['address'])))
-        gr.add((hotel_obj, agn.Precio, Literal('Not available')))
+        hoteles = get_places(str(ciudadDestino))[:topk]
+
+        # Pedimos a la vez los detalles de los topk primeros hoteles, de forma que la búsqueda tarda lo mismo que
+        # una sola llamada. Los hoteles de los que no se obtienen los detalles no se retornan
+        detalles = scatter_gather.run({str(i): (get_details, (h['details'],)) for i, h in enumerate(hoteles)})
+        if not detalles:
+            raise LookupError(ciudadDestino)
+
+        # Si se ha superado el tiempo límite de la petición (ver AgentUtil.Deadline) antes de tener todos los
+        # detalles, retornamos los hoteles que los tienen con un 'failure'
+        parcial = expired() and len(detalles) < len(hoteles)
+
+        # La posición (agn.Rank) es la del hotel en la lista de Tourpedia
+        add_entities(gr, [(agn[str(h['id'])], {agn.esUn: agn.Hotel,
+                                               agn.Nombre: detalles[str(i)]['name'],
+                                               agn.Direccion: h['address'],
+                                               agn.Precio: 'Not available',
+                                               agn.Rank: i + 1})
+                          for i, h in enumerate(hoteles) if str(i) in detalles])
 
         gr = build_message(gr,
-                        ACL['confirm'],
+                        ACL['failure'] if parcial else ACL['confirm'],
                         sender=InfoAlojamientoTourpedia.uri,
-                        msgcnt=mss_cnt,
+                        content=EXCEEDED if parcial else None,
+                        msgcnt=msgcnt,
                         receiver=msgdic['sender'], )
     except:
         logger.info('Location not found on database')
         gr = build_message(gr,
                             ACL['failure'],
                             sender=InfoAlojamientoTourpedia.uri,
-                            msgcnt=mss_cnt,
+                            content=EXCEEDED if expired() else None,
+                            msgcnt=msgcnt,
                             receiver=msgdic['sender'], )
     finally:
         return gr
 
 
+def get_places(ciudad):
+    """
+    Retorna la lista de hoteles de Tourpedia en la ciudad, de la cache si ya se ha consultado antes
+    """
+    key = 'places:' + ciudad
+    hoteles = tourpedia_cache.get(key)
+    if hoteles is None:
+        response = http_request('GET', tourpedia_url + 'getPlaces',
+                                params={'location': ciudad, 'category': 'accommodation', 'name': 'Hotel'})
+        response.raise_for_status()
+        hoteles = response.json()
+        tourpedia_cache.put(key, hoteles)
+    return hoteles
+
+
+def get_details(url):
+    """
+    Retorna los detalles de un hotel de Tourpedia, de la cache si ya se han consultado antes. La url es la llamada a
+    la API que viene codificada en el atributo 'details' de cada hotel
+    """
+    key = 'details:' + url
+    detalles = tourpedia_cache.get(key)
+    if detalles is None:
+        response = http_request('GET', url)
+        response.raise_for_status()
+        detalles = response.json()
+        tourpedia_cache.put(key, detalles)
+    return detalles
+
+
+def warm_cache():
+    """
+    Precarga en la cache los hoteles de las ciudades conocidas (las del diccionario IATA) y los detalles de los topk
+    primeros de cada ciudad, que son los que se retornan en las busquedas
+    """
+    for ciudad in IATA:
+        try:
+            for h in get_places(ciudad)[:topk]:
+                get_details(h['details'])
+        except Exception as error:
+            logger.info('No se ha podido precargar %s: %s', ciudad, error)
+    logger.info('Cache de Tourpedia precargada: %d entradas.', tourpedia_cache.stats()['size'])
+
+
 def register_message():
     """
     Envia un mensaje de registro al servicio de registro usando una performativa 'Request' con
     una acción 'Register' del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info('Nos registramos')
 
@@ -221,9 +331,8 @@ def register_message():
                       sender=InfoAlojamientoTourpedia.uri,
                       receiver=DirectoryAgent.uri,
                       content=reg_obj,
-                      msgcnt=mss_cnt),
+                      msgcnt=msgcnt),
         DirectoryAgent.address)
-    mss_cnt += 1
 
     return gr
 
@@ -234,6 +343,10 @@ if __name__ == '__main__':
     except:
         logger.info("DirectoryAgent no localizado.")
 
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Precargamos la cache en segundo plano, para no retrasar la puesta en marcha del servidor
+    if not args.nowarm:
+        threading.Thread(target=warm_cache, daemon=True).start()
+
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info('The End')
@@ -7,20 +7,27 @@ import argparse
 import logging
 import socket
 
-from amadeus import Client, ResponseError
-from flask import Flask, request
+from amadeus import ResponseError
+from flask import Flask
 from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import FOAF, RDF
 
 from AgentUtil.ACL import ACL
 from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
-from AgentUtil.APIKeys import AMADEUS_KEY, AMADEUS_SECRET
 from AgentUtil.Agent import Agent
 from AgentUtil.AgentsPorts import PUERTO_INFO_TRANSPORTE, PUERTO_DIRECTORIO
+from AgentUtil.AmadeusClient import get_amadeus_client, close_amadeus_client, amadeus_options
+from AgentUtil.Cache import TTLCache
 from AgentUtil.DSO import DSO
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.Deadline import EXCEEDED, expired
+from AgentUtil.FlaskServer import shutdown_server, get_message, message_response
+from AgentUtil.FlightOffers import parse_offers, filter_offers, offers_graph
+from AgentUtil.GraphBuilder import new_graph
 from AgentUtil.IATACodes import convert_to_IATA
+from AgentUtil.Launcher import run_agent, SharedCounter
 from AgentUtil.Logging import config_logger
+from AgentUtil.Metrics import register_cache
+from AgentUtil.Tracing import enable_tracing
 from AgentUtil.Util import gethostname
 
 # Definimos los parámetros de la linea de comandos
@@ -30,6 +37,13 @@ parser.add_argument("--open", help="Define si el servidor está abierto al exter
 parser.add_argument("--port", type=int, help="Puerto de comunicación del agente.")
 parser.add_argument("--dhost", help="Host del agente de directorio.")
 parser.add_argument("--dport", type=int, help="Puerto de comunicación del agente de directorio.")
+parser.add_argument("--amadeus", help="URL de la API Amadeus (por defecto la de pruebas de Amadeus).")
+parser.add_argument("--cttl", type=float,
+                    help="Tiempo (en segundos) que se guardan las ofertas de vuelos obtenidas de Amadeus.")
+parser.add_argument("--csize", type=int, help="Número máximo de búsquedas de vuelos guardadas en la caché.")
+parser.add_argument("--workers", type=int, help="Número de procesos del servidor del agente.")
+parser.add_argument("--threads", type=int, help="Número de hilos de cada proceso del servidor del agente.")
+parser.add_argument("--trace", help="Fichero JSONL en el que se guardan los spans de las trazas del agente.")
 parser.add_argument("--verbose", help="Genera un log de la comunicación del servidor web.", action="store_true",
                     default=False)
 
@@ -51,6 +65,19 @@ if args.port is None:
 else:
     port = args.port
 
+if args.workers is None:
+    workers = 1
+else:
+    workers = args.workers
+
+if args.threads is None:
+    threads = 32
+else:
+    threads = args.threads
+
+if args.trace is not None:
+    enable_tracing(args.trace, 'InfoTransporte')
+
 if args.dhost is None:
     dhostname = socket.gethostname()
 else:
@@ -61,15 +88,31 @@ if args.dport is None:
 else:
     dport = args.dport
 
+if args.amadeus is None:
+    amadeus_url = None
+else:
+    amadeus_url = args.amadeus
+
+if args.cttl is None:
+    cttl = 300
+else:
+    cttl = args.cttl
+
+if args.csize is None:
+    csize = 256
+else:
+    csize = args.csize
+
 if not args.verbose:
     log = logging.getLogger("werkzeug")
     log.setLevel(logging.ERROR)
 
 agn = Namespace("http://www.agentes.org#")
 
-# Datos del agente de información de transporte
+# Datos del agente de información de transporte. La URI incluye el puerto para que se puedan registrar varias
+# instancias del agente en el directorio y repartir las peticiones entre ellas.
 InfoAgent = Agent("TransportInfoAgent",
-                  agn.AgentInfo,
+                  agn["AgentInfo-%d" % port],
                   "http://%s:%d/comm" % (hostaddr, port),
                   "http://%s:%d/Stop" % (hostaddr, port))
 
@@ -85,12 +128,20 @@ igraph = Graph()
 # Instanciamos el servidor Flask
 app = Flask(__name__)
 
-# Contador de mensajes
-mss_cnt = 0
+# Contador de mensajes, compartido por todos los workers del servidor
+mss_cnt = SharedCounter()
+
+# Cliente de la API Amadeus, compartido por todas las peticiones (ver AgentUtil.AmadeusClient)
+amadeus = get_amadeus_client(**amadeus_options(amadeus_url))
+
+# Caché de las ofertas de vuelos de Amadeus por origen, destino y fecha de salida. Se guardan todas las ofertas, sin
+# filtrar por presupuesto, para que sirvan a todas las búsquedas de la misma ruta y fecha
+flights_cache = TTLCache(maxsize=csize, ttl=cttl)
+register_cache('vuelos', flights_cache)
 
 
 # ENTRY POINTS
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunication():
     """
     Entry point de comunicación con el agente.
@@ -101,14 +152,12 @@ def comunication():
     acciones se reciben en un mensaje de tipo ACL.request.
     """
     global igraph
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Petición de información de transporte recibida.")
 
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args["content"]
-    msg_graph = Graph()
-    msg_graph.parse(data=message)
+    # Extraemos el mensaje como un grafo, en el formato en que nos lo hayan enviado
+    msg_graph = get_message()
 
     msgdic = get_message_properties(msg_graph)
 
@@ -118,21 +167,19 @@ def comunication():
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAgent.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     elif msgdic["performative"] != ACL.request:
         # Si la performativa no es de tipo 'request', respondemos que no hemos entendido el mensaje
         res_graph = build_message(Graph(),
                                   ACL["not-understood"],
                                   sender=InfoAgent.uri,
-                                  msgcnt=mss_cnt)
+                                  msgcnt=msgcnt)
     else:
-        res_graph = get_flights(msg_graph, msgdic)
-
-    mss_cnt += 1
+        res_graph = get_flights(msg_graph, msgdic, msgcnt)
 
     logger.info("El agente de información de transporte responde a la petición.")
 
-    return res_graph.serialize(format="xml")
+    return message_response(res_graph)
 
 
 @app.route("/Stop")
@@ -140,7 +187,6 @@ def stop():
     """
     Entrada que para el agente.
     """
-    tidyup()
     shutdown_server()
     return "Parando servidor."
 
@@ -149,82 +195,87 @@ def tidyup():
     """
     Acciones previas a parar el agente.
     """
-    pass
+    close_amadeus_client()
 
 
-def get_flights(msg_graph, msgdic):
+def get_flights(msg_graph, msgdic, msgcnt):
     """
     Retorna un mensaje en formato FIPA-ACL, de tipo 'inform', que contiene el resultado de la búsqueda de vuelos hecha
     en la API Amadeus con los criterio de búsqueda que hay en el grafo msg_graph, pasado como parámetro. En caso de
     producirse un error, la función retorna un mensaje FIPA-ACL de tipo 'failure'.
     """
-    res_graph = Graph()
+    res_graph = new_graph()
 
     # Extraemos los campos de búsqueda del contenido del mensaje, una vez que este está expresado como un grafo
     search_req = agn["GestorTransporte-InfoSearch"]
     originLocationName = msg_graph.value(subject=search_req, predicate=agn.originCity)
-    originLocationCode = convert_to_IATA(str(originLocationName))
     destinationLocationName = msg_graph.value(subject=search_req, predicate=agn.destinationCity)
-    destinationLocationCode = convert_to_IATA(str(destinationLocationName))
     departureDate = msg_graph.value(subject=search_req, predicate=agn.departureDate)
     budget = msg_graph.value(subject=search_req, predicate=agn.budget)
 
-    amadeus = Client(
-        client_id=AMADEUS_KEY,
-        client_secret=AMADEUS_SECRET
-    )
-
     try:
-        # Hace la búsqueda a la API Amadeus a través de su librería y guarda el resultado en formato JSON (accesible
-        # como si fuera un diccionario Python)
-        response = amadeus.shopping.flight_offers_search.get(
-            originLocationCode=originLocationCode,
-            destinationLocationCode=destinationLocationCode,
-            departureDate=departureDate,
-            adults=1)
+        originLocationCode = convert_to_IATA(str(originLocationName))
+        destinationLocationCode = convert_to_IATA(str(destinationLocationName))
 
-        for ticket in response.data:
-            # La librería de Amadeus no deja filtrar por presupuesto directamente, así que lo hacemos manualmente
-            # una vez obtenemos los resultados
-            if float(ticket["price"]["total"]) <= float(budget):
-                # Extrae los campos que nos interesan de la respuesta dada por la API.
-                #
-                # Para determinar la fecha de salida y la fecha de llegada solo consideramos el primer segmento del
-                # vuelo, en el caso de un vuelo con escalas. Solo consideramos una tipo (clase) de billete, en el
-                # caso que haya más de uno.
-                ticketId = int(ticket["id"])
-                departureDate = ticket["itineraries"][0]["segments"][0]["departure"]["at"]
-                arrivalDate = ticket["itineraries"][0]["segments"][0]["arrival"]["at"]
-                ticketClass = ticket["travelerPricings"][0]["fareOption"]
-                ticketPrice = float(ticket["price"]["total"])
-
-                # Construye el grafo que enviaremos como respuesta al agente
-                ticket_obj = agn["Billete" + str(ticketId)]
-                res_graph.add((ticket_obj, agn.esUn, agn.Billete))
-                res_graph.add((ticket_obj, agn.Id, Literal(ticketId)))
-                res_graph.add((ticket_obj, agn.origenBillete, Literal(originLocationName)))
-                res_graph.add((ticket_obj, agn.destinoBillete, Literal(destinationLocationName)))
-                res_graph.add((ticket_obj, agn.DiaHoraSalida, Literal(departureDate)))
-                res_graph.add((ticket_obj, agn.DiaHoraLlegada, Literal(arrivalDate)))
-                res_graph.add((ticket_obj, agn.Asiento, Literal("A23")))  # Asiento inventado
-                res_graph.add((ticket_obj, agn.Clase, Literal(ticketClass)))
-                res_graph.add((ticket_obj, agn.Precio, Literal(ticketPrice)))
-
-                res_graph = build_message(res_graph,
-                                          ACL["inform"],
-                                          sender=InfoAgent.uri,
-                                          receiver=msgdic['sender'],
-                                          msgcnt=mss_cnt)
+        # Obtiene las ofertas de vuelos de la caché o, si no están, de la API Amadeus
+        offers = search_offers(originLocationCode, destinationLocationCode, str(departureDate))
+
+        # La librería de Amadeus no deja filtrar por presupuesto directamente, así que lo hacemos sobre la columna
+        # de precios de las ofertas una vez obtenemos los resultados
+        offers = filter_offers(offers, budget)
+
+        # Construye el grafo que enviaremos como respuesta al agente, con todos los billetes a la vez
+        res_graph = offers_graph(offers, originLocationName, destinationLocationName, res_graph)
+        res_graph = build_message(res_graph,
+                                  ACL["inform"],
+                                  sender=InfoAgent.uri,
+                                  receiver=msgdic['sender'],
+                                  msgcnt=msgcnt)
 
     except ResponseError as error:
         logger.info(error)
-        res_graph = build_message(res_graph,
+        # Si la llamada a la API ha superado el tiempo límite de la petición (ver AgentUtil.Deadline), la librería
+        # de Amadeus lo retorna como un error de red más, así que lo indicamos como motivo del 'failure'
+        res_graph = build_message(new_graph(),
                                   ACL["failure"],
                                   sender=InfoAgent.uri,
+                                  content=EXCEEDED if expired() else None,
                                   receiver=msgdic['sender'],
-                                  msgcnt=mss_cnt)
-    finally:
-        return res_graph
+                                  msgcnt=msgcnt)
+    except Exception:
+        # Cualquier otro error (por ejemplo, una ciudad sin código IATA o un presupuesto que no es un número) también
+        # se responde con un 'failure'
+        logger.exception("Error inesperado en la búsqueda de vuelos.")
+        res_graph = build_message(new_graph(),
+                                  ACL["failure"],
+                                  sender=InfoAgent.uri,
+                                  receiver=msgdic['sender'],
+                                  msgcnt=msgcnt)
+    return res_graph
+
+
+def search_offers(originLocationCode, destinationLocationCode, departureDate):
+    """
+    Retorna las ofertas de vuelos de la API Amadeus para la ruta y la fecha dadas, como un array estructurado (ver
+    AgentUtil.FlightOffers). Si la búsqueda ya se ha hecho hace menos de cttl segundos, se retorna el
+    resultado guardado en la caché sin volver a llamar a la API. Los errores de la API no se guardan
+    """
+    key = (originLocationCode, destinationLocationCode, departureDate)
+    offers = flights_cache.get(key)
+    if offers is None:
+        # Hace la búsqueda a la API Amadeus a través de su librería
+        response = amadeus.shopping.flight_offers_search.get(
+            originLocationCode=originLocationCode,
+            destinationLocationCode=destinationLocationCode,
+            departureDate=departureDate,
+            adults=1)
+        offers = parse_offers(response.data)
+        flights_cache.put(key, offers)
+
+    stats = flights_cache.stats()
+    logger.info("Caché de vuelos: %d aciertos, %d fallos (%.0f%% de aciertos).",
+                stats['hits'], stats['misses'], 100 * stats['hit_ratio'])
+    return offers
 
 
 def register_message():
@@ -232,7 +283,7 @@ def register_message():
     Envia un mensaje de registro al servicio de registro usando una performativa 'Request' con
     una acción 'Register' del servicio de directorio.
     """
-    global mss_cnt
+    msgcnt = mss_cnt.next()
 
     logger.info("Registro agente información de transporte.")
 
@@ -257,10 +308,9 @@ def register_message():
                       sender=InfoAgent.uri,
                       receiver=DirectoryAgent.uri,
                       content=reg_obj,
-                      msgcnt=mss_cnt),
+                      msgcnt=msgcnt),
         DirectoryAgent.address)
 
-    mss_cnt += 1
     return res_graph
 
 
@@ -270,6 +320,6 @@ if __name__ == '__main__':
     except:
         logger.info("DirectoryAgent no localizado.")
 
-    # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port)
+    # Ponemos en marcha el servidor del agente, que ejecuta tidyup al pararse
+    run_agent(app, hostname, port, workers=workers, threads=threads, on_shutdown=tidyup)
     logger.info('The end')
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks de las operaciones de AgentUtil.ACLMessages que se hacen en cada salto entre agentes, sobre mensajes
+con la forma y el tamaño de los que intercambian los agentes (Benchmarks.GrafosEjemplo): una petición, las respuestas
+de hoteles y actividades y respuestas de vuelos con cientos de ofertas.
+
+Operaciones:
+
+    - sobre-grafo: build_message sobre el grafo del contenido (añadir el sobre ACL)
+    - sobre-aclmsg: crear el ACLMessage equivalente con el contenido como payload
+    y, para cada formato de WIRE_FORMATS:
+    - serializar: serialize_message
+    - parsear: parse_message
+    - sobre: parse_envelope (leer solo el sobre)
+    - propiedades: get_message_properties sobre el mensaje ya parseado
+    - salto: lo que cuesta en CPU enviar y recibir el mensaje en un salto (serializar, comprimir si toca, descomprimir,
+      parsear y leer el sobre), sin la red
+
+Cada medida se repite varias veces (cada repetición con tantas llamadas como hagan falta para durar al menos
+--tiempo segundos) y se guarda la mediana y el mínimo del tiempo por llamada. Los resultados se pueden guardar en JSON,
+junto con el commit y las versiones de Python y rdflib, y comparar con los de otra ejecución para detectar regresiones.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchACL --salida acl-antes.json
+    python -m Benchmarks.BenchACL --comparar acl-antes.json --umbral 0.1
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import rdflib
+from rdflib import Graph
+from rdflib.namespace import RDF
+
+from AgentUtil.ACL import ACL
+from AgentUtil.ACLMessages import WIRE_FORMATS, ACLMessage, COMPRESSION, COMPRESSION_MIN_SIZE, build_message, \
+    compress, decompress, get_message_properties, parse_envelope, parse_message, serialize_message
+from Benchmarks.GrafosEjemplo import grafo_peticion, grafo_vuelos, grafo_hoteles, grafo_actividades
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeticiones", type=int, default=5, help="Número de repeticiones de cada medida.")
+parser.add_argument("--tiempo", type=float, default=0.05, help="Duración mínima (en segundos) de cada repetición.")
+parser.add_argument("--mensajes", nargs='+', help="Mensajes que se miden (por defecto todos).")
+parser.add_argument("--formatos", nargs='+', help="Formatos que se miden (por defecto todos los de WIRE_FORMATS).")
+parser.add_argument("--salida", help="Fichero JSON en el que se guardan los resultados.")
+parser.add_argument("--comparar", help="Fichero JSON con resultados anteriores con los que se comparan.")
+parser.add_argument("--umbral", type=float, default=0.1,
+                    help="Empeoramiento relativo de la mediana a partir del cual se marca una regresión.")
+
+# Mensajes de ejemplo, de menor a mayor
+MENSAJES = {
+    'peticion': grafo_peticion,
+    'hoteles-20': lambda: grafo_hoteles(20),
+    'actividades-100': lambda: grafo_actividades(100),
+    'vuelos-100': lambda: grafo_vuelos(100),
+    'vuelos-250': lambda: grafo_vuelos(250),
+    'vuelos-1000': lambda: grafo_vuelos(1000),
+}
+
+
+def ronda(func, preparar, number):
+    """
+    Retorna el tiempo de number llamadas a func. Si se indica preparar, cada llamada recibe un argumento nuevo creado
+    con preparar() antes de empezar a medir
+    """
+    argumentos = [preparar() for _ in range(number)] if preparar is not None else None
+    gc_activo = gc.isenabled()
+    gc.disable()
+    try:
+        inicio = time.perf_counter()
+        if argumentos is None:
+            for _ in range(number):
+                func()
+        else:
+            for argumento in argumentos:
+                func(argumento)
+        return time.perf_counter() - inicio
+    finally:
+        if gc_activo:
+            gc.enable()
+
+
+def medir(func, repeticiones, tiempo, preparar=None):
+    """
+    Retorna la mediana y el mínimo (en microsegundos) del tiempo por llamada a func
+    """
+    number = 1
+    while True:
+        t = ronda(func, preparar, number)
+        if t >= tiempo:
+            break
+        number *= 2
+    tiempos = [t / number] + [ronda(func, preparar, number) / number for _ in range(repeticiones - 1)]
+    return statistics.median(tiempos) * 10 ** 6, min(tiempos) * 10 ** 6
+
+
+def sin_sobre(gr):
+    """
+    Retorna el grafo del contenido del mensaje (sin las tripletas del sobre) y las propiedades del sobre
+    """
+    uri = gr.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+    contenido = Graph()
+    for triple in gr:
+        if triple[0] != uri:
+            contenido.add(triple)
+    return contenido, get_message_properties(gr)
+
+
+def salto(gr, format):
+    """
+    Trabajo de CPU de enviar el mensaje a otro agente y leerlo allí (ver send_message y FlaskServer.get_message)
+    """
+    data = serialize_message(gr, format)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    encoding = None
+    if len(data) >= COMPRESSION_MIN_SIZE:
+        data = compress(data, COMPRESSION)
+        encoding = COMPRESSION
+    msg = parse_message(decompress(data, encoding), format)
+    return get_message_properties(msg)
+
+
+def casos(gr, formatos):
+    """
+    Genera las medidas del mensaje como (formato, operacion, func, preparar, bytes)
+    """
+    contenido, sobre = sin_sobre(gr)
+    payload = list(contenido)
+
+    def copia():
+        nuevo = Graph()
+        for triple in payload:
+            nuevo.add(triple)
+        return nuevo
+
+    yield ('-', 'sobre-grafo',
+           lambda g: build_message(g, sobre['performative'], sender=sobre['sender'], receiver=sobre.get('receiver'),
+                                   content=sobre.get('content')),
+           copia, None)
+    yield ('-', 'sobre-aclmsg',
+           lambda: ACLMessage(sobre['performative'], sender=sobre['sender'], receiver=sobre.get('receiver'),
+                              content=sobre.get('content'), payload=payload),
+           None, None)
+
+    for format in formatos:
+        data = serialize_message(gr, format)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        mensaje = parse_message(data, format)
+        # Los argumentos por defecto fijan los valores de este formato en cada función
+        yield format, 'serializar', lambda f=format: serialize_message(gr, f), None, len(data)
+        yield format, 'parsear', lambda d=data, f=format: parse_message(d, f), None, len(data)
+        yield format, 'sobre', lambda d=data, f=format: parse_envelope(d, f), None, len(data)
+        yield format, 'propiedades', lambda m=mensaje: get_message_properties(m), None, len(data)
+        yield format, 'salto', lambda f=format: salto(gr, f), None, len(data)
+
+
+def entorno():
+    """
+    Retorna los datos de la ejecución que se guardan con los resultados
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        modificado = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, modificado = None, None
+    return {'commit': commit,
+            'modificado': modificado,
+            'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'rdflib': rdflib.__version__,
+            'plataforma': platform.platform()}
+
+
+def cargar_anteriores(path):
+    """
+    Retorna los resultados de un fichero JSON como diccionario (mensaje, formato, operacion) -> resultado
+    """
+    with open(path, encoding='utf-8') as f:
+        anteriores = json.load(f)
+    return anteriores['entorno'], {(r['mensaje'], r['formato'], r['operacion']): r for r in anteriores['resultados']}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    formatos = args.formatos if args.formatos is not None else list(WIRE_FORMATS)
+    mensajes = args.mensajes if args.mensajes is not None else list(MENSAJES)
+
+    base = None
+    if args.comparar is not None:
+        entorno_base, base = cargar_anteriores(args.comparar)
+        print('Comparando con %s (commit %s, %s)' % (args.comparar, entorno_base['commit'], entorno_base['fecha']))
+
+    print('%-16s %8s %-9s %-13s %10s %12s %12s %8s' % ('mensaje', 'triples', 'formato', 'operacion', 'bytes',
+                                                       'mediana(us)', 'min(us)', 'cambio'))
+    resultados = []
+    regresiones = 0
+    for nombre in mensajes:
+        gr = MENSAJES[nombre]()
+        for format, operacion, func, preparar, size in casos(gr, formatos):
+            mediana, minimo = medir(func, args.repeticiones, args.tiempo, preparar)
+            resultados.append({'mensaje': nombre, 'triples': len(gr), 'formato': format, 'operacion': operacion,
+                               'bytes': size, 'mediana_us': round(mediana, 2), 'min_us': round(minimo, 2)})
+
+            cambio = ''
+            anterior = base.get((nombre, format, operacion)) if base is not None else None
+            if anterior is not None:
+                ratio = mediana / anterior['mediana_us']
+                cambio = '%+.0f%%' % ((ratio - 1) * 100)
+                if ratio > 1 + args.umbral:
+                    cambio += ' <-- regresión'
+                    regresiones += 1
+            print('%-16s %8d %-9s %-13s %10s %12.1f %12.1f %8s' % (nombre, len(gr), format, operacion,
+                                                                   size if size is not None else '-', mediana,
+                                                                   minimo, cambio))
+
+    if args.salida is not None:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump({'entorno': entorno(), 'resultados': resultados}, f, indent=1, ensure_ascii=False)
+        print('Resultados guardados en %s' % args.salida)
+
+    if base is not None:
+        print('%d regresiones de más del %.0f%%' % (regresiones, args.umbral * 100))
+        sys.exit(1 if regresiones else 0)
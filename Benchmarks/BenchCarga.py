@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga de todo el sistema de agentes, sin usar las APIs reales.
+
+Arranca en local los nueve agentes en sus puertos por defecto (AgentUtil.AgentsPorts), con las APIs de Amadeus y
+Tourpedia sustituidas por Benchmarks.ServidoresFalsos, y envía peticiones de plan (el formulario de la entrada POST /
+de AgenteUnificador) a un ritmo fijo durante el tiempo indicado. Las peticiones se envían en el instante que les toca
+aunque las anteriores no hayan acabado (carga abierta), y su latencia se mide desde ese instante, de forma que las
+esperas en la cola del cliente también cuentan.
+
+Al acabar muestra:
+
+    - el throughput de las peticiones de plan, cuántas han fallado (agrupadas por el error) y la latencia (p50, p95,
+      p99) de las correctas y, por separado, de las fallidas
+    - para cada tramo de las trazas de los agentes (ver AgentUtil.Tracing): el número de spans por segundo y la
+      latencia (p50, p95, p99) de cada entrada de cada agente, de las peticiones HTTP de cada agente a los demás y a
+      las APIs, y del resto de tramos medidos
+
+Las peticiones de calentamiento (las primeras, que llenan las cachés de los agentes) no se cuentan.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchCarga --rps 5 --duracion 30 --latencia 0.05 --jitter 0.02 --errores 0.01
+"""
+
+import argparse
+import datetime
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+
+from AgentUtil.AgentsPorts import PUERTO_DIRECTORIO, PUERTO_INFO_TRANSPORTE, PUERTO_INFO_ALOJAMIENTO_AMADEUS, \
+    PUERTO_INFO_ALOJAMIENTO_TOURPEDIA, PUERTO_INFO_ACTIVIDADES, PUERTO_GESTOR_TRANSPORTE, PUERTO_GESTOR_ALOJAMIENTO, \
+    PUERTO_GESTOR_ACTIVIDADES, PUERTO_UNIFICADOR
+from AgentUtil.IATACodes import IATA
+from AgentUtil.Tracing import load_spans
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rps", type=float, default=5, help="Peticiones de plan por segundo.")
+parser.add_argument("--duracion", type=float, default=30, help="Duración (en segundos) de la prueba.")
+parser.add_argument("--calentamiento", type=int, default=5, help="Peticiones de calentamiento, que no se cuentan.")
+parser.add_argument("--variantes", type=int, default=20,
+                    help="Número de formularios distintos que se envían (con menos, más aciertos en las cachés).")
+parser.add_argument("--concurrencia", type=int, default=64, help="Número máximo de peticiones en curso.")
+parser.add_argument("--workers", type=int, default=1, help="Número de workers de cada agente (menos el directorio).")
+parser.add_argument("--threads", type=int, default=32, help="Número de hilos de cada worker de los agentes.")
+parser.add_argument("--puerto-apis", type=int, default=9600, help="Puerto de las APIs falsas.")
+parser.add_argument("--latencia", type=float, default=0.05, help="Retardo medio (en segundos) de las APIs falsas.")
+parser.add_argument("--jitter", type=float, default=0.02, help="Variación máxima del retardo de las APIs falsas.")
+parser.add_argument("--errores", type=float, default=0.0, help="Proporción de llamadas a las APIs que fallan.")
+parser.add_argument("--grabaciones", help="Directorio con respuestas grabadas de las APIs (ver ServidoresFalsos).")
+parser.add_argument("--timeout", type=float, help="Tiempo máximo (en segundos) de cada plan en AgenteUnificador.")
+parser.add_argument("--logs", help="Directorio donde se guardan los logs y las trazas (por defecto uno temporal).")
+parser.add_argument("--semilla", type=int, default=0, help="Semilla de los formularios.")
+
+# Agentes por orden de arranque: nombre, puerto y si usan las APIs (amadeus, tourpedia)
+AGENTES = [
+    ('DirectorioAgentes', PUERTO_DIRECTORIO, None),
+    ('InfoTransporte', PUERTO_INFO_TRANSPORTE, 'amadeus'),
+    ('InfoAlojamientoAmadeus', PUERTO_INFO_ALOJAMIENTO_AMADEUS, 'amadeus'),
+    ('InfoAlojamientoTourpedia', PUERTO_INFO_ALOJAMIENTO_TOURPEDIA, 'tourpedia'),
+    ('InfoActividades', PUERTO_INFO_ACTIVIDADES, 'amadeus'),
+    ('GestorTransporte', PUERTO_GESTOR_TRANSPORTE, None),
+    ('GestorAlojamiento', PUERTO_GESTOR_ALOJAMIENTO, None),
+    ('GestorActividades', PUERTO_GESTOR_ACTIVIDADES, None),
+    ('AgenteUnificador', PUERTO_UNIFICADOR, None),
+]
+
+# Mensaje de error de la página de resultado de AgenteUnificador (templates/processingPlan.html), o el aviso de los
+# planes incompletos porque se ha superado el tiempo máximo
+ERROR_PLAN = re.compile(r'<p style="color: darkred">([^<]*)</p>')
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sesión HTTP de cada hilo del cliente
+_local = threading.local()
+
+
+def esperar_puerto(host, port, proceso, limite=30):
+    """
+    Espera a que el servidor acepte conexiones en el puerto
+    """
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        if proceso.poll() is not None:
+            raise RuntimeError('El proceso del puerto %d ha acabado al arrancar' % port)
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('El puerto %d no responde después de %d segundos' % (port, limite))
+
+
+def arrancar(args, host, directorio):
+    """
+    Arranca las APIs falsas y los agentes, y retorna la lista de procesos (en orden de arranque). Si alguno no
+    arranca, para los que ya se han arrancado
+    """
+    env = dict(os.environ, PYTHONPATH=RAIZ)
+    trazas = os.path.join(directorio, 'trazas.jsonl')
+    procesos = []
+
+    def lanzar(nombre, cmd, port):
+        log = open(os.path.join(directorio, nombre + '.log'), 'w')
+        proceso = subprocess.Popen(cmd, cwd=RAIZ, env=env, stdout=log, stderr=subprocess.STDOUT)
+        procesos.append(proceso)
+        esperar_puerto(host, port, proceso)
+
+    cmd = [sys.executable, '-m', 'Benchmarks.ServidoresFalsos', '--port', str(args.puerto_apis),
+           '--latencia', str(args.latencia), '--jitter', str(args.jitter), '--errores', str(args.errores)]
+    if args.grabaciones is not None:
+        cmd += ['--grabaciones', os.path.abspath(args.grabaciones)]
+    try:
+        lanzar('ServidoresFalsos', cmd, args.puerto_apis)
+
+        apis = 'http://%s:%d' % (host, args.puerto_apis)
+        for nombre, port, api in AGENTES:
+            cmd = [sys.executable, os.path.join('Agents', nombre + '.py'), '--trace', trazas,
+                   '--threads', str(args.threads)]
+            if nombre != 'DirectorioAgentes':
+                # El registro del directorio está en la memoria de su proceso, así que solo puede tener un worker
+                cmd += ['--workers', str(args.workers)]
+            if api == 'amadeus':
+                cmd += ['--amadeus', apis]
+            elif api == 'tourpedia':
+                cmd += ['--tourpedia', apis + '/api/', '--nowarm', '--cache',
+                        os.path.join(directorio, 'tourpedia.sqlite')]
+            if nombre == 'AgenteUnificador' and args.timeout is not None:
+                cmd += ['--timeout', str(args.timeout)]
+            lanzar(nombre, cmd, port)
+    except Exception:
+        parar(procesos)
+        raise
+
+    # Los agentes de información se registran en el directorio al arrancar
+    time.sleep(1)
+    return procesos
+
+
+def parar(procesos):
+    """
+    Para los procesos en orden inverso al de arranque
+    """
+    for proceso in reversed(procesos):
+        if proceso.poll() is None:
+            proceso.send_signal(signal.SIGTERM)
+    for proceso in reversed(procesos):
+        try:
+            proceso.wait(timeout=40)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+
+
+def formularios(n, semilla):
+    """
+    Retorna n formularios de petición de plan distintos
+    """
+    rnd = random.Random(semilla)
+    ciudades = list(IATA)
+    res = []
+    for _ in range(n):
+        origen, destino = rnd.sample(ciudades, 2)
+        ida = datetime.date(2021, 6, 1) + datetime.timedelta(days=rnd.randrange(60))
+        vuelta = ida + datetime.timedelta(days=rnd.randrange(2, 6))
+        res.append({'ciudadOrigen': origen, 'ciudadDestino': destino,
+                    'fechaIda': ida.isoformat(), 'fechaVuelta': vuelta.isoformat(),
+                    'presupuestoVuelo': str(rnd.randrange(200, 900)),
+                    'npersonas': str(rnd.randrange(1, 4)), 'nhabitaciones': '1',
+                    'estrellas': str(rnd.randrange(1, 6)), 'dcentro': str(rnd.randrange(2, 20)),
+                    'presupuestoAloj': str(rnd.randrange(100, 1000))})
+    return res
+
+
+def peticion(url, formulario, programada):
+    """
+    Envía una petición de plan y retorna la latencia desde el instante programado y el error (None si es correcta)
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    try:
+        r = session.post(url, data=formulario, timeout=120)
+        if r.status_code != 200:
+            error = 'HTTP %d' % r.status_code
+        else:
+            # La página de resultado muestra el mensaje de error del plan, si lo hay
+            error = ERROR_PLAN.search(r.text)
+            error = error.group(1).strip() if error is not None else None
+    except requests.RequestException as e:
+        error = type(e).__name__
+    return time.perf_counter() - programada, error
+
+
+def carga(url, forms, rps, duracion, concurrencia):
+    """
+    Envía int(rps * duracion) peticiones a ritmo fijo y retorna sus resultados y el tiempo total
+    """
+    total = int(rps * duracion)
+    with ThreadPoolExecutor(concurrencia) as pool:
+        inicio = time.perf_counter()
+        futures = []
+        for i in range(total):
+            programada = inicio + i / rps
+            espera = programada - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            futures.append(pool.submit(peticion, url, forms[i % len(forms)], programada))
+        resultados = [future.result() for future in futures]
+    return resultados, time.perf_counter() - inicio
+
+
+def percentiles(valores):
+    return np.percentile(np.asarray(valores) * 1000, [50, 95, 99])
+
+
+def nombre_tramo(record, host_ports):
+    """
+    Retorna el nombre con el que se agrupa un span: las peticiones HTTP se agrupan por destino
+    """
+    if record['name'] != 'http':
+        return record['name']
+    netloc = urlsplit(record['attrs'].get('url', '')).netloc
+    port = int(netloc.rsplit(':', 1)[1]) if ':' in netloc else None
+    return 'http -> %s' % host_ports.get(port, netloc)
+
+
+def informe_tramos(trazas, duracion, host_ports):
+    tramos = {}
+    for spans in load_spans(trazas).values():
+        for record in spans:
+            key = (record['service'] or '?', nombre_tramo(record, host_ports))
+            tramos.setdefault(key, []).append(record['duration_ms'] / 1000)
+
+    print()
+    print('%-26s %-34s %8s %8s %10s %10s %10s' % ('agente', 'tramo', 'spans', 'spans/s', 'p50(ms)', 'p95(ms)',
+                                                  'p99(ms)'))
+    for (servicio, tramo), duraciones in sorted(tramos.items()):
+        p50, p95, p99 = percentiles(duraciones)
+        print('%-26s %-34s %8d %8.1f %10.1f %10.1f %10.1f' % (servicio, tramo, len(duraciones),
+                                                              len(duraciones) / duracion, p50, p95, p99))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    host = socket.gethostname()
+    directorio = args.logs if args.logs is not None else tempfile.mkdtemp(prefix='carga-')
+    os.makedirs(directorio, exist_ok=True)
+    trazas = os.path.join(directorio, 'trazas.jsonl')
+    if os.path.exists(trazas):
+        os.remove(trazas)
+
+    host_ports = {port: nombre for nombre, port, _ in AGENTES}
+    host_ports[args.puerto_apis] = 'APIs falsas'
+
+    procesos = arrancar(args, host, directorio)
+    try:
+        url = 'http://%s:%d/' % (host, PUERTO_UNIFICADOR)
+        forms = formularios(args.variantes, args.semilla)
+        for formulario in forms[:args.calentamiento]:
+            peticion(url, formulario, time.perf_counter())
+        # Los agentes escriben las trazas con O_APPEND, así que se puede vaciar el fichero mientras lo tienen abierto
+        open(trazas, 'w').close()
+
+        resultados, duracion = carga(url, forms, args.rps, args.duracion, args.concurrencia)
+    finally:
+        parar(procesos)
+
+    # Las peticiones fallidas suelen acabar antes (o, con timeouts, mucho después) que las correctas, así que su
+    # latencia se muestra aparte para que no desvirtúe la de los planes
+    correctas = [latencia for latencia, error in resultados if error is None]
+    fallidas = [latencia for latencia, error in resultados if error is not None]
+    errores = {}
+    for _, error in resultados:
+        if error is not None:
+            errores[error] = errores.get(error, 0) + 1
+    fallos = len(fallidas)
+    print('Peticiones: %d en %.1f s (%.2f/s, objetivo %.2f/s)' % (len(resultados), duracion,
+                                                                 len(resultados) / duracion, args.rps))
+    print('Errores: %d (%.1f%%)' % (fallos, 100.0 * fallos / len(resultados) if resultados else 0.0))
+    for error, n in sorted(errores.items(), key=lambda item: -item[1]):
+        print('    %5d  %s' % (n, error))
+    for nombre, latencias in (('correctos', correctas), ('fallidos', fallidas)):
+        if latencias:
+            p50, p95, p99 = percentiles(latencias)
+            print('Latencia de los planes %s: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' % (nombre, p50, p95, p99))
+    informe_tramos(trazas, duracion, host_ports)
+
+    # El directorio temporal se conserva si ha habido fallos, para poder consultar los logs
+    if args.logs is None and fallos == 0:
+        shutil.rmtree(directorio, ignore_errors=True)
+    else:
+        print()
+        print('Logs y trazas en %s' % directorio)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark del coste de serializar y parsear los mensajes ACL en cada uno de los formatos de AgentUtil.ACLMessages
+(WIRE_FORMATS), sobre grafos con la forma de los mensajes de vuelos, hoteles y actividades.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchFormatos --repeticiones 20
+"""
+
+import argparse
+import gzip
+import timeit
+
+from AgentUtil.ACLMessages import WIRE_FORMATS, serialize_message, parse_message
+from Benchmarks.GrafosEjemplo import GRAFOS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeticiones", type=int, default=20, help="Número de repeticiones de cada medida.")
+
+
+def medir(gr, format, repeticiones):
+    """
+    Retorna el tiempo medio (en ms) de serializar y de parsear el grafo en el formato dado, y el tamaño del mensaje
+    sin comprimir y comprimido con gzip. En el formato ACL_JSON el mensaje se lee como un ACLMessage, sin construir
+    el grafo
+    """
+    data = serialize_message(gr, format)
+
+    t_ser = timeit.timeit(lambda: serialize_message(gr, format), number=repeticiones) / repeticiones
+    t_parse = timeit.timeit(lambda: parse_message(data, format), number=repeticiones) / repeticiones
+
+    return t_ser * 1000, t_parse * 1000, len(data), len(gzip.compress(data, compresslevel=5))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print('%-12s %-8s %8s %12s %10s %10s %10s' %
+          ('grafo', 'formato', 'triples', 'serial.(ms)', 'parse(ms)', 'bytes', 'gzip'))
+    for nombre, crear_grafo in GRAFOS.items():
+        gr = crear_grafo()
+        for format in WIRE_FORMATS:
+            t_ser, t_parse, size, gz_size = medir(gr, format, args.repeticiones)
+            print('%-12s %-8s %8d %12.2f %10.2f %10d %10d' % (nombre, format, len(gr), t_ser, t_parse, size, gz_size))
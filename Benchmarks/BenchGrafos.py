@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del coste por entidad (billete, hotel o actividad) de construir los grafos de respuesta de los agentes de
+información.
+
+Compara la forma original (Graph.add de cada tripleta sobre el store por defecto de rdflib) con
+AgentUtil.GraphBuilder (las entidades como diccionarios, añadidas con Graph.addN sobre el store Memory). Las
+entidades son las de los grafos de ejemplo de Benchmarks.GrafosEjemplo.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchGrafos --repeticiones 20
+"""
+
+import argparse
+import timeit
+
+from rdflib import Graph, Literal, Namespace
+
+from AgentUtil.GraphBuilder import new_graph, add_entities
+from Benchmarks.GrafosEjemplo import grafo_vuelos, grafo_hoteles, grafo_actividades
+
+agn = Namespace("http://www.agentes.org#")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeticiones", type=int, default=20, help="Número de repeticiones de cada medida.")
+
+
+def entidades(gr, clase):
+    """
+    Retorna las entidades de tipo clase del grafo como (sujeto, diccionario predicado -> valor en Python), que es
+    como las tienen los agentes de información después de leer la respuesta de la API
+    """
+    return [(s, {p: o.toPython() if isinstance(o, Literal) else o for _, p, o in gr.triples((s, None, None))})
+            for s in gr.subjects(predicate=agn.esUn, object=clase)]
+
+
+def original(ents):
+    gr = Graph()
+    for subject, properties in ents:
+        for predicate, value in properties.items():
+            gr.add((subject, predicate, value if not isinstance(value, (str, int, float)) else Literal(value)))
+    return gr
+
+
+def bulk(ents):
+    return add_entities(new_graph(), ents)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print('%-12s %9s %14s %14s %8s' % ('entidad', 'entidades', 'add (us/ent)', 'addN (us/ent)', 'mejora'))
+    for nombre, gr, clase in [('billete', grafo_vuelos(), agn.Billete),
+                              ('hotel', grafo_hoteles(200), agn.Hotel),
+                              ('actividad', grafo_actividades(), agn.activity)]:
+        ents = entidades(gr, clase)
+        assert len(original(ents)) == len(bulk(ents))
+        t_add = timeit.timeit(lambda: original(ents), number=args.repeticiones) / args.repeticiones / len(ents)
+        t_bulk = timeit.timeit(lambda: bulk(ents), number=args.repeticiones) / args.repeticiones / len(ents)
+        print('%-12s %9d %14.1f %14.1f %7.1fx' % (nombre, len(ents), t_add * 1e6, t_bulk * 1e6, t_add / t_bulk))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark de la extracción del sobre de los mensajes ACL (AgentUtil.ACLMessages), sobre mensajes con la forma
+de los que intercambian los agentes (Benchmarks.GrafosEjemplo).
+
+Compara:
+
+    - get_message_properties con una consulta msg.value por propiedad (la implementación anterior) y con una sola
+      pasada sobre las tripletas del mensaje, tanto sobre un grafo como sobre un ACLMessage
+    - parsear el mensaje entero y sacar su sobre con parse_envelope, que solo lee el sobre, en N-Triples y ACL_JSON
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchSobre --repeticiones 200
+"""
+
+import argparse
+import timeit
+
+from rdflib.namespace import RDF
+
+from AgentUtil.ACL import ACL
+from AgentUtil.ACLMessages import ENVELOPE, ACL_JSON, get_message_properties, parse_envelope, parse_message, \
+    serialize_message
+from Benchmarks.GrafosEjemplo import GRAFOS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeticiones", type=int, default=200, help="Número de repeticiones de cada medida.")
+
+
+def propiedades_por_consulta(msg):
+    """
+    Implementación anterior de get_message_properties, con una consulta por cada propiedad del sobre
+    """
+    msgdic = {}
+    valid = msg.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+    if valid is not None:
+        for key in ENVELOPE:
+            val = msg.value(subject=valid, predicate=ENVELOPE[key])
+            if val is not None:
+                msgdic[key] = val
+    return msgdic
+
+
+def medir(func, repeticiones):
+    """
+    Retorna el tiempo medio (en microsegundos) de una llamada a func
+    """
+    return timeit.timeit(func, number=repeticiones) / repeticiones * 10 ** 6
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print('%-12s %8s %-10s %14s %14s %8s' % ('mensaje', 'triples', 'caso', 'antes(us)', 'ahora(us)', 'mejora'))
+    for nombre, crear_grafo in GRAFOS.items():
+        gr = crear_grafo()
+        nt = serialize_message(gr, 'nt')
+        js = serialize_message(gr, ACL_JSON)
+        recibido = parse_message(nt, 'nt')
+        mensaje = parse_message(js, ACL_JSON)
+        mensaje.index()
+
+        casos = [
+            ('grafo', lambda: propiedades_por_consulta(recibido), lambda: get_message_properties(recibido)),
+            ('aclmsg', lambda: propiedades_por_consulta(mensaje), lambda: get_message_properties(mensaje)),
+            ('sobre-nt', lambda: get_message_properties(parse_message(nt, 'nt')), lambda: parse_envelope(nt, 'nt')),
+            ('sobre-json', lambda: get_message_properties(parse_message(js, ACL_JSON)),
+             lambda: parse_envelope(js, ACL_JSON)),
+        ]
+        for caso, antes, ahora in casos:
+            assert antes() == ahora()
+            t_antes = medir(antes, args.repeticiones)
+            t_ahora = medir(ahora, args.repeticiones)
+            print('%-12s %8d %-10s %14.1f %14.1f %7.1fx' % (nombre, len(gr), caso, t_antes, t_ahora, t_antes / t_ahora))
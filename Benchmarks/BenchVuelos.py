@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del tratamiento de las ofertas de vuelos en InfoTransporte: filtrado por presupuesto y construcción del
+grafo de respuesta a partir de una respuesta de Amadeus con 250 ofertas.
+
+Compara la versión original (un bucle sobre las ofertas en JSON que añade las tripletas una a una y construye el
+sobre ACL dentro del bucle) con la de AgentUtil.FlightOffers (array estructurado de NumPy, filtrado y ordenación por
+columnas y todas las tripletas de una vez). Se mide también el caso en que las ofertas ya están en la caché de
+InfoTransporte, que guarda el array ya convertido.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.BenchVuelos --ofertas 250 --repeticiones 50
+"""
+
+import argparse
+import timeit
+
+from rdflib import Graph, Literal, Namespace
+
+from AgentUtil.ACL import ACL
+from AgentUtil.ACLMessages import build_message
+from AgentUtil.FlightOffers import parse_offers, filter_offers, offers_graph
+from Benchmarks.GrafosEjemplo import respuesta_vuelos
+
+agn = Namespace("http://www.agentes.org#")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ofertas", type=int, default=250, help="Número de ofertas de la respuesta de Amadeus.")
+parser.add_argument("--presupuesto", type=float, default=500, help="Presupuesto de la búsqueda.")
+parser.add_argument("--repeticiones", type=int, default=50, help="Número de repeticiones de cada medida.")
+
+
+def original(offers, budget):
+    """
+    Versión original de InfoTransporte.get_flights
+    """
+    res_graph = Graph()
+    for ticket in offers:
+        if float(ticket["price"]["total"]) <= float(budget):
+            ticketId = int(ticket["id"])
+            departureDate = ticket["itineraries"][0]["segments"][0]["departure"]["at"]
+            arrivalDate = ticket["itineraries"][0]["segments"][0]["arrival"]["at"]
+            ticketClass = ticket["travelerPricings"][0]["fareOption"]
+            ticketPrice = float(ticket["price"]["total"])
+
+            ticket_obj = agn["Billete" + str(ticketId)]
+            res_graph.add((ticket_obj, agn.esUn, agn.Billete))
+            res_graph.add((ticket_obj, agn.Id, Literal(ticketId)))
+            res_graph.add((ticket_obj, agn.origenBillete, Literal('Barcelona')))
+            res_graph.add((ticket_obj, agn.destinoBillete, Literal('Paris')))
+            res_graph.add((ticket_obj, agn.DiaHoraSalida, Literal(departureDate)))
+            res_graph.add((ticket_obj, agn.DiaHoraLlegada, Literal(arrivalDate)))
+            res_graph.add((ticket_obj, agn.Asiento, Literal("A23")))
+            res_graph.add((ticket_obj, agn.Clase, Literal(ticketClass)))
+            res_graph.add((ticket_obj, agn.Precio, Literal(ticketPrice)))
+
+            res_graph = build_message(res_graph, ACL["inform"], sender=agn.AgentInfo, receiver=agn.GestorTransporte)
+    return res_graph
+
+
+def columnar(offers, budget):
+    """
+    Versión con AgentUtil.FlightOffers, sin caché (las ofertas se convierten en cada búsqueda)
+    """
+    return cached(parse_offers(offers), budget)
+
+
+def cached(parsed, budget):
+    """
+    Versión con AgentUtil.FlightOffers, con las ofertas ya convertidas en la caché
+    """
+    res_graph = offers_graph(filter_offers(parsed, budget), 'Barcelona', 'Paris')
+    return build_message(res_graph, ACL["inform"], sender=agn.AgentInfo, receiver=agn.GestorTransporte)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    offers = respuesta_vuelos(args.ofertas)
+    parsed = parse_offers(offers)
+
+    print('%d ofertas, presupuesto %.0f, %d billetes en el presupuesto' %
+          (len(offers), args.presupuesto, len(filter_offers(parsed, args.presupuesto))))
+    print('%-28s %10s %10s' % ('versión', 'ms', 'triples'))
+    for nombre, funcion, datos in [('original', original, offers),
+                                   ('array estructurado', columnar, offers),
+                                   ('array estructurado (caché)', cached, parsed)]:
+        t = timeit.timeit(lambda: funcion(datos, args.presupuesto), number=args.repeticiones) / args.repeticiones
+        print('%-28s %10.2f %10d' % (nombre, t * 1000, len(funcion(datos, args.presupuesto))))
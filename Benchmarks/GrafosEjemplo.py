@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Grafos de ejemplo, con la misma forma que los que intercambian los agentes, para usar en los benchmarks.
+
+Los datos son sintéticos pero realistas: un billete de vuelo, un hotel o una actividad tienen las mismas propiedades
+(y por tanto el mismo número de tripletas) que las que construyen los agentes de información.
+"""
+
+import random
+
+from rdflib import Graph, Namespace, Literal
+
+from AgentUtil.ACL import ACL
+from AgentUtil.ACLMessages import build_message
+
+agn = Namespace("http://www.agentes.org#")
+
+CIUDADES = ['Barcelona', 'Paris', 'Amsterdam', 'Berlin', 'Dubai', 'London', 'Rome']
+
+
+def grafo_vuelos(n=250, seed=0):
+    """
+    Retorna un mensaje 'inform' con n billetes, como el que retorna InfoTransporte
+    """
+    rnd = random.Random(seed)
+    gr = Graph()
+    for i in range(n):
+        hora = rnd.randrange(6, 22)
+        billete = agn["Billete" + str(i + 1)]
+        gr.add((billete, agn.esUn, agn.Billete))
+        gr.add((billete, agn.Id, Literal(i + 1)))
+        gr.add((billete, agn.origenBillete, Literal('Barcelona')))
+        gr.add((billete, agn.destinoBillete, Literal(rnd.choice(CIUDADES[1:]))))
+        gr.add((billete, agn.DiaHoraSalida, Literal('2021-06-10T%02d:%02d:00' % (hora, rnd.randrange(60)))))
+        gr.add((billete, agn.DiaHoraLlegada, Literal('2021-06-10T%02d:%02d:00' % (hora + 2, rnd.randrange(60)))))
+        gr.add((billete, agn.Asiento, Literal("A23")))
+        gr.add((billete, agn.Clase, Literal(rnd.choice(['STANDARD', 'FLEX', 'BUSINESS']))))
+        gr.add((billete, agn.Precio, Literal(round(rnd.uniform(40, 900), 2))))
+    return build_message(gr, ACL.inform, sender=agn.AgentInfo, receiver=agn.GestorTransporte)
+
+
+def grafo_hoteles(n=20, seed=0):
+    """
+    Retorna un mensaje 'inform' con n hoteles, como el que retornan los agentes de información de alojamiento
+    """
+    rnd = random.Random(seed)
+    gr = Graph()
+    for i in range(n):
+        hotel = agn["HOTEL%04d" % i]
+        gr.add((hotel, agn.esUn, agn.Hotel))
+        gr.add((hotel, agn.Nombre, Literal('Hotel %s %d' % (rnd.choice(['Plaza', 'Central', 'Royal', 'Park']), i))))
+        gr.add((hotel, agn.Direccion, Literal('Calle %d, %s, 080%02d' % (rnd.randrange(200), 'BARCELONA', i % 100))))
+        gr.add((hotel, agn.Precio, Literal('%.2f€' % rnd.uniform(60, 400))))
+    return build_message(gr, ACL.inform, sender=agn.InfoAmadeus, receiver=agn.GestorAlojamiento)
+
+
+def grafo_actividades(n=100, seed=0):
+    """
+    Retorna un mensaje 'confirm' con n actividades, como el que retorna InfoActividades
+    """
+    rnd = random.Random(seed)
+    gr = Graph()
+    for i in range(n):
+        ident = str(rnd.randrange(10 ** 6, 10 ** 7))
+        actividad = agn[ident]
+        gr.add((actividad, agn.esUn, agn.activity))
+        gr.add((actividad, agn.nombre, Literal('Visita guiada número %d por el centro histórico' % i)))
+        gr.add((actividad, agn.id, Literal(ident)))
+    return build_message(gr, ACL.confirm, sender=agn.InfoActividades, receiver=agn.GestorActividades)
+
+
+def grafo_peticion():
+    """
+    Retorna un mensaje 'request' pequeño, como las peticiones de búsqueda que hacen los gestores
+    """
+    gr = Graph()
+    search_req = agn["GestorTransporte-InfoSearch"]
+    gr.add((search_req, agn.originCity, Literal('Barcelona')))
+    gr.add((search_req, agn.destinationCity, Literal('Paris')))
+    gr.add((search_req, agn.departureDate, Literal('2021-06-10')))
+    gr.add((search_req, agn.comebackDate, Literal('2021-06-15')))
+    gr.add((search_req, agn.budget, Literal('300')))
+    return build_message(gr, ACL.request, sender=agn.GestorTransporte, receiver=agn.AgentInfo, content=search_req)
+
+
+def respuesta_vuelos(n=250, seed=0):
+    """
+    Retorna una lista de n ofertas de vuelos con el mismo formato JSON que response.data de la búsqueda
+    amadeus.shopping.flight_offers_search (solo los campos que usa InfoTransporte y algunos más, para que el tamaño
+    de cada oferta sea realista)
+    """
+    rnd = random.Random(seed)
+    offers = []
+    for i in range(n):
+        hora = rnd.randrange(6, 20)
+        minutos = rnd.randrange(60, 300)
+        salida = '2021-06-10T%02d:%02d:00' % (hora, rnd.randrange(60))
+        llegada = '2021-06-10T%02d:%02d:00' % (hora + minutos // 60, rnd.randrange(60))
+        precio = '%.2f' % rnd.uniform(40, 900)
+        offers.append({
+            'type': 'flight-offer',
+            'id': str(i + 1),
+            'source': 'GDS',
+            'numberOfBookableSeats': rnd.randrange(1, 9),
+            'itineraries': [{
+                'duration': 'PT%dH%dM' % (minutos // 60, minutos % 60),
+                'segments': [{
+                    'departure': {'iataCode': 'BCN', 'terminal': '1', 'at': salida},
+                    'arrival': {'iataCode': 'CDG', 'terminal': '2', 'at': llegada},
+                    'carrierCode': rnd.choice(['VY', 'AF', 'IB']),
+                    'number': str(rnd.randrange(1000, 9999)),
+                    'duration': 'PT%dH%dM' % (minutos // 60, minutos % 60),
+                    'numberOfStops': 0
+                }]
+            }],
+            'price': {'currency': 'EUR', 'total': precio, 'base': precio, 'grandTotal': precio},
+            'travelerPricings': [{
+                'travelerId': '1',
+                'fareOption': rnd.choice(['STANDARD', 'FLEX', 'BUSINESS']),
+                'travelerType': 'ADULT',
+                'price': {'currency': 'EUR', 'total': precio, 'base': precio}
+            }]
+        })
+    return offers
+
+
+GRAFOS = {
+    'peticion': grafo_peticion,
+    'vuelos': grafo_vuelos,
+    'hoteles': grafo_hoteles,
+    'actividades': grafo_actividades
+}
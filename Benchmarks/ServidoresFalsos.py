@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Servidor que sustituye a las APIs de Amadeus y de Tourpedia en las pruebas de carga (Benchmarks.BenchCarga), para
+medir el rendimiento de los agentes sin gastar la cuota de las APIs reales.
+
+Atiende, en el mismo puerto, las llamadas que hacen los agentes de información:
+
+    - Amadeus (con InfoTransporte, InfoActividades e InfoAlojamientoAmadeus arrancados con --amadeus http://host:puerto):
+      el token OAuth, la búsqueda de vuelos, la de actividades, la lista de hoteles de una ciudad y la de ofertas de
+      hoteles
+    - Tourpedia (con InfoAlojamientoTourpedia arrancado con --tourpedia http://host:puerto/api/): la lista de
+      alojamientos de una ciudad y los detalles de cada uno
+
+Las respuestas tienen la misma forma que las de las APIs reales y se generan a partir de los parámetros de la llamada,
+así que la misma llamada obtiene siempre la misma respuesta. Si se indica un directorio de grabaciones, las llamadas a
+una ruta de la que hay un fichero (la ruta sin la primera barra y con '_' en lugar de '/', por ejemplo
+v2_shopping_flight-offers.json o api_getPlaces.json) retornan su contenido tal cual.
+
+A cada llamada (menos a la del token) se le añade un retardo de latencia ± jitter segundos y falla con un error 500 con
+la probabilidad indicada.
+
+Se ejecuta desde la raíz del repositorio con:
+
+    python -m Benchmarks.ServidoresFalsos --port 9600 --latencia 0.05 --jitter 0.02 --errores 0.01
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import time
+
+from flask import Flask, Response, abort, request
+
+from AgentUtil.Launcher import run_agent
+from Benchmarks.GrafosEjemplo import respuesta_vuelos
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=9600, help="Puerto del servidor.")
+parser.add_argument("--latencia", type=float, default=0.05, help="Retardo medio (en segundos) de cada llamada.")
+parser.add_argument("--jitter", type=float, default=0.02, help="Variación máxima (en segundos) del retardo.")
+parser.add_argument("--errores", type=float, default=0.0, help="Proporción de llamadas que fallan con un error 500.")
+parser.add_argument("--grabaciones", help="Directorio con respuestas grabadas que se retornan tal cual.")
+parser.add_argument("--ofertas", type=int, default=250, help="Número de ofertas de vuelos de cada búsqueda.")
+parser.add_argument("--threads", type=int, default=64, help="Número de hilos del servidor.")
+
+app = Flask(__name__)
+
+# Configuración, que se cambia con los parámetros de la línea de comandos
+latencia = 0.05
+jitter = 0.02
+errores = 0.0
+grabaciones = None
+ofertas = 250
+
+AMADEUS_JSON = 'application/vnd.amadeus+json'
+
+
+def generador():
+    """
+    Retorna un generador de números aleatorios que depende solo de la llamada (ruta y parámetros)
+    """
+    return random.Random(request.path + '?' + '&'.join(sorted('%s=%s' % item for item in request.args.items())))
+
+
+def respuesta(datos, mimetype='application/json'):
+    return Response(json.dumps(datos), mimetype=mimetype)
+
+
+@app.before_request
+def simular_api():
+    """
+    Añade el retardo y los errores a las llamadas, y retorna la grabación de la ruta si la hay
+    """
+    if request.path == '/v1/security/oauth2/token' or request.path == '/metrics':
+        return None
+    time.sleep(max(0.0, latencia + random.uniform(-jitter, jitter)))
+    if random.random() < errores:
+        abort(500)
+    if grabaciones is not None:
+        fichero = os.path.join(grabaciones, request.path.strip('/').replace('/', '_') + '.json')
+        if os.path.exists(fichero):
+            with open(fichero, 'rb') as f:
+                return Response(f.read(), mimetype=AMADEUS_JSON if request.path.startswith('/v') else
+                                'application/json')
+    return None
+
+
+@app.route('/v1/security/oauth2/token', methods=['POST'])
+def token():
+    return respuesta({'type': 'amadeusOAuth2Token', 'access_token': os.urandom(16).hex(), 'expires_in': 1799,
+                      'state': 'approved'})
+
+
+@app.route('/v2/shopping/flight-offers', methods=['GET', 'POST'])
+def vuelos():
+    return respuesta({'data': respuesta_vuelos(ofertas, seed=generador().randrange(2 ** 32))}, AMADEUS_JSON)
+
+
+@app.route('/v1/shopping/activities')
+def actividades():
+    rnd = generador()
+    latitude = float(request.args.get('latitude', 0))
+    longitude = float(request.args.get('longitude', 0))
+    data = [{'type': 'activity',
+             'id': str(rnd.randrange(10 ** 6, 10 ** 7)),
+             'name': 'Actividad %d' % i,
+             'shortDescription': 'Descripción de la actividad %d' % i,
+             'geoCode': {'latitude': '%.6f' % (latitude + rnd.uniform(-0.05, 0.05)),
+                         'longitude': '%.6f' % (longitude + rnd.uniform(-0.05, 0.05))},
+             'price': {'currencyCode': 'EUR', 'amount': '%.2f' % rnd.uniform(5, 120)},
+             'rating': '%.1f' % rnd.uniform(3, 5)}
+            for i in range(60)]
+    return respuesta({'data': data}, AMADEUS_JSON)
+
+
+@app.route('/v1/reference-data/locations/hotels/by-city')
+def hoteles_ciudad():
+    rnd = generador()
+    ciudad = request.args.get('cityCode', 'BCN')
+    radio = float(request.args.get('radius', 5))
+    estrellas = [int(r) for r in request.args.get('ratings', '').split(',') if r]
+    data = [{'chainCode': 'XX',
+             'iataCode': ciudad,
+             'name': 'Hotel %s %d' % (ciudad, i),
+             'hotelId': '%s%05d' % (ciudad, i),
+             'geoCode': {'latitude': round(rnd.uniform(-90, 90), 5), 'longitude': round(rnd.uniform(-180, 180), 5)},
+             'address': {'countryCode': 'ES'},
+             'distance': {'value': round(rnd.uniform(0.1, radio), 2), 'unit': 'KM'},
+             'rating': rnd.choice(estrellas) if estrellas else rnd.randrange(1, 6)}
+            for i in range(30)]
+    return respuesta({'data': data}, AMADEUS_JSON)
+
+
+@app.route('/v3/shopping/hotel-offers')
+def hoteles():
+    rnd = generador()
+    data = [{'type': 'hotel-offers',
+             'hotel': {'hotelId': ident, 'name': 'Hotel %s' % ident, 'cityCode': ident[:3]},
+             'available': True,
+             'offers': [{'id': os.urandom(5).hex(), 'price': {'currency': 'EUR',
+                                                               'total': '%.2f' % rnd.uniform(40, 400)}}]}
+            for ident in request.args.get('hotelIds', '').split(',') if ident]
+    return respuesta({'data': data}, AMADEUS_JSON)
+
+
+@app.route('/api/getPlaces')
+def alojamientos():
+    rnd = generador()
+    ciudad = request.args.get('location', '')
+    base = request.host_url + 'api/getPlaceDetails?id='
+    lugares = []
+    for i in range(40):
+        ident = rnd.randrange(10 ** 5, 10 ** 6)
+        lugares.append({'id': ident,
+                        'name': 'Hotel %s %d' % (ciudad, i),
+                        'address': 'Calle %d, %s' % (rnd.randrange(1, 200), ciudad),
+                        'category': 'accommodation',
+                        'location': ciudad,
+                        'lat': rnd.uniform(-90, 90),
+                        'lng': rnd.uniform(-180, 180),
+                        'details': base + str(ident),
+                        'reviews': base + str(ident)})
+    return respuesta(lugares)
+
+
+@app.route('/api/getPlaceDetails')
+def detalles():
+    ident = request.args.get('id', '0')
+    rnd = generador()
+    return respuesta({'id': int(ident),
+                      'name': 'Hotel %s' % ident,
+                      'address': 'Calle %d' % rnd.randrange(1, 200),
+                      'category': 'accommodation',
+                      'description': {'en': 'Hotel de pruebas %s' % ident},
+                      'numReviews': rnd.randrange(500)})
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    latencia = args.latencia
+    jitter = args.jitter
+    errores = args.errores
+    grabaciones = args.grabaciones
+    ofertas = args.ofertas
+
+    run_agent(app, socket.gethostname(), args.port, threads=args.threads)